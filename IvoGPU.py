@@ -25,11 +25,18 @@ import numpy as np
 from numpy.random import randint
 import pyopencl as cl
 import pyopencl.array as cl_array
-import sys, os, errno, argparse, time, ConfigParser
+import sys, os, errno, argparse, time, ConfigParser, glob, re
+from collections import deque
 import seqload
+import tracing
+import distributed
+import benchsuite
 from changeGauge import zeroGauge, zeroJGauge, fieldlessGaugeEven
-from mcmcGPU import setupGPUs, initGPU, divideWalkers, printGPUs, readGPUbufs
-from NewtonSteps import newtonMCMC, runMCMC
+from mcmcGPU import (setupGPUs, initGPU, divideWalkers, printGPUs, 
+                     readGPUbufs, releaseGPUbufs, reportPerf)
+from NewtonSteps import (newtonMCMC, runMCMC, runMCMCLoops, tuneKernelSteps,
+                         sampleAccumulate, generateSamples, annealSeqs, 
+                         topDistinct)
 
 ################################################################################
 # Set up enviroment and some helper functions
@@ -94,12 +101,34 @@ def optionRegistry():
         help="Number of MC walkers")
     add('nsteps', type=uint32, default=2048,
         help="number of MC steps per kernel call")
+    add('kerneltime', type=float32, default=0,
+        help=("Target duration (s) of each MCMC kernel launch. If nonzero, "
+              "the MC steps per launch are adapted after warmup, keeping "
+              "the total number of MC steps the same"))
     add('wgsize', type=int, default=256, 
         help="GPU workgroup size")
     add('gpus', 
-        help="GPUs to use (comma-sep list of platforms #s, eg '0,0')")
+        help=("OpenCL devices to use, as a comma-sep list of platform #s "
+              "(the next device of that platform), platform:device #s, or "
+              "device types (gpu, cpu or accelerator), eg '0,0', '0:1' or "
+              "'cpu'. All must be on the same platform. See --clinfo"))
+    add('balance', type=float, default=0,
+        help=("At the start of each round, measure each GPU's MCMC "
+              "throughput, and if the slowest GPU takes more than this "
+              "fraction longer than average, redistribute the walkers in "
+              "proportion to throughput (0 to disable)"))
     add('profile', action='store_true', 
-        help="enable OpenCL profiling")
+        help=("enable OpenCL profiling, and log and save (as perf.json) a "
+              "report of time spent per phase and per kernel"))
+    add('trace', 
+        help=("Record host phases and OpenCL events, and write them to this "
+              "file in Chrome trace (JSON) format, viewable in "
+              "chrome://tracing or ui.perfetto.dev"))
+    add('chunksize', type=uint32, default=65536,
+        help=("Number of sequences per GPU processed at once when streaming "
+              "a sequence file. Memory use is proportional to this, "
+              "independent of the number of sequences. For mutscan, it is "
+              "reduced if needed to keep the results within 256MB per GPU"))
     add('nlargebuf', type=uint32, default=1,
         help='size of large seq buffer, in multiples of nwalkers')
     add('measurefperror', action='store_true', 
@@ -124,6 +153,16 @@ def optionRegistry():
         help="Perform a round of newton steps before first MCMC run") 
     add('resetseqs', action='store_false', 
         help="Reset sequence to S0 at start of every MCMC round") 
+    add('warmstart', default='reset', 
+        choices=['reset', 'continue', 'reseed'],
+        help=("Walker start after the first round: 'reset' all walkers to "
+              "a single seq chosen from the previous round, 'continue' each "
+              "walker from its final state, or 'reseed' each walker from a "
+              "random sample of the previous round"))
+    add('dedup', action='store_true', 
+        help=("Before the Newton steps, compact the sampled sequences into "
+              "distinct sequences with multiplicities, so the Newton steps "
+              "only process distinct sequences"))
     
     # Potts options
     add('alpha', required=True,
@@ -144,7 +183,76 @@ def optionRegistry():
     add('nsamples', type=uint32, required=True, 
         help="Number of sequence samples")
     add('trackequil', type=uint32, default=0,
-        help='Save bimarg every TRACKEQUIL steps during equilibration')
+        help=("Every TRACKEQUIL loops during equilibration, append the "
+              "walkers' SSR and RMSD relative to the target bimarg, bimarg "
+              "drift, energy mean and variance and acceptance rate to "
+              "equilibration.txt"))
+    add('equildump', type=uint32, default=0,
+        help=("With trackequil, also save the full bimarg every EQUILDUMP "
+              "intervals (0 for never)"))
+    add('equilthresh', type=float, default=0,
+        help=("End equilibration early, at a trackequil interval, once the "
+              "drift of the walkers' bimarg between intervals is below "
+              "EQUILTHRESH times that expected from sampling noise and the "
+              "mean energy shows no trend, for 3 intervals in a row. "
+              "equiltime is the maximum. 0 to always run equiltime loops"))
+    add('spill', action='store_true',
+        help=("Store the sampled sequences (and their energies and weights) "
+              "in host memory rather than GPU memory, streaming them through "
+              "the GPU in blocks of nwalkers sequences when needed. Allows "
+              "more samples than fit in GPU memory"))
+    add('accumulate', action='store_true',
+        help=("Instead of storing all samples, add the pair counts and "
+              "energies of each sample to accumulators on the GPU, using "
+              "memory independent of nsamples"))
+    add('ntemps', type=uint32, default=1,
+        help=("Number of temperatures for parallel tempering (1 for none). "
+              "The walkers of each GPU are divided into NTEMPS equal groups "
+              "with different temperatures, which exchange sequences, and "
+              "only the walkers at the original temperature are sampled"))
+    add('betamin', type=float, default=0.5,
+        help=("Lowest inverse temperature (relative to the model's) for "
+              "parallel tempering"))
+    add('tunetemps', type=uint32, default=8,
+        help=("Number of times the parallel tempering temperatures are "
+              "adjusted from the measured swap rates, during the first half "
+              "of equilibration (0 to keep them fixed)"))
+    add('proposal', default='uniform',
+        help=("Residues proposed by the Metropolis sampler: 'uniform', or "
+              "'marginal' to propose from the site marginals of the target "
+              "bimarg, or the name of a bimarg npy file whose site marginals "
+              "are used. Marginal proposals exclude the current residue"))
+    add('autocorr', action='store_true',
+        help=("Record the energy of each walker, and its Hamming distance "
+              "from its seq at the start of sampling, every MCMC loop "
+              "during sampling, and log autocorrelation times and R-hat"))
+    add('adaptsample', type=float, default=0,
+        help=("After each round, set sampletime to this many "
+              "autocorrelation times (0 to keep it fixed). Implies "
+              "--autocorr"))
+    add('stream', action='store_true',
+        help=("Write the sequences and energies of each sample to disk as "
+              "soon as it is generated, while the walkers keep running"))
+    add('saveseqs', type=uint32, default=0,
+        help=("With --accumulate, save the walkers' sequences every SAVESEQS "
+              "samples (0 for never)"))
+    add('ehistbins', type=uint32, default=100,
+        help="With --accumulate, number of bins of the energy histogram")
+    add('erange', 
+        help=("With --accumulate, energy histogram range 'emin:emax'. By "
+              "default, twice the range of the first sample's energies. If "
+              "emin is negative, use the form --erange=emin:emax"))
+
+    # Distributed options
+    add('listen', type=int,
+        help=("Coordinate a distributed inference, waiting on this TCP port "
+              "for --nworkers worker processes to connect"))
+    add('nworkers', type=int, default=1,
+        help="Number of worker processes of a distributed inference")
+    add('connect',
+        help=("Run as a worker of the distributed inference coordinated at "
+              "'host:port'. Workers must be given the same inference options "
+              "as the coordinator, and their own --outdir"))
 
     return dict(options)
 
@@ -174,14 +282,20 @@ def inverseIsing(args, log):
              'on the GPU')
     parser = argparse.ArgumentParser(prog=progname + ' inverseIsing',
                                      description=descr)
-    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
-                                          'gibbs gpus profile')
+    addopt(parser, 'GPU options',         'nwalkers nsteps kerneltime wgsize '
+                                          'gibbs gpus balance profile trace')
     addopt(parser, 'Sequence Options',    'startseq seqs')
     addopt(parser, 'Newton Step Options', 'bimarg mcsteps newtonsteps gamma '
-                                          'damping jclamp preopt resetseqs')
+                                          'damping jclamp preopt resetseqs '
+                                          'warmstart dedup')
     addopt(parser, 'Sampling Options',    'equiltime sampletime nsamples '
-                                          'trackequil')
+                                          'trackequil equildump equilthresh '
+                                          'spill '
+                                          'ntemps betamin '
+                                          'tunetemps proposal autocorr '
+                                          'adaptsample')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
+    addopt(parser, 'Distributed Options', 'listen nworkers connect')
     addopt(parser,  None,                 'seqmodel outdir')
 
     args = parser.parse_args(args)
@@ -195,6 +309,8 @@ def inverseIsing(args, log):
     p = attrdict({'outdir': args.outdir})
     mkdir_p(args.outdir)
 
+    process_distributed_args(args, log)
+
     p.update(process_newton_args(args, log))
     if p.bimarg is not None:
         p['L'], p['nB'] = seqsize_from_param_shape(p.bimarg.shape)
@@ -202,13 +318,29 @@ def inverseIsing(args, log):
     p.update(process_potts_args(args, p.L, p.nB, p.bimarg, log))
     L, nB, alpha = p.L, p.nB, p.alpha
 
-    p.update(process_sample_args(args, log))
-    rngPeriod = (p.equiltime + p.sampletime*p.nsamples)*p.mcmcsteps
+    p.update(process_sample_args(args, log, p.bimarg))
+    if p.spill and p.dedup:
+        raise Exception("dedup cannot be used with spill")
+    #(plus 2 warmup calls if tuning the kernel launch size)
+    rngPeriod = (p.equiltime + p.sampletime*p.nsamples)*p.mcmcsteps + 2
     gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, rngPeriod, log)
     p.update(gpup)
+    p['balance'] = args.balance
+    if p.balance:
+        log(("Balancing walkers over GPUs by throughput when imbalanced by "
+             "more than {}").format(p.balance))
     gpuwalkers = divideWalkers(p.nwalkers, len(gdevs), p.wgsize, log)
-    gpus = [initGPU(n, cldat, dev, nwalk, nwalk*p.nsamples, p, log)
-            for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
+    #number the gpus and walkers of all processes consecutively, so their
+    #RNG streams differ even if the processes have different nwalkers
+    rank = distributed.comm.rank
+    ngpus = distributed.comm.allgather(len(gdevs))
+    nwalks = distributed.comm.allgather(int(sum(gpuwalkers)))
+    gpunum0 = int(sum(ngpus[:rank]))
+    walker0 = cumsum([int(sum(nwalks[:rank]))] + list(gpuwalkers[:-1]))
+    gpus = [initGPU(gpunum0 + n, cldat, dev, nwalk, 
+                    nwalk/p.ntemps*p.nsamples, p, log, walker0=int(w0))
+            for n,(dev, nwalk, w0) in enumerate(zip(gdevs, gpuwalkers, 
+                                                    walker0))]
     log("")
     #log(("Running {} MCMC walkers in parallel over {} GPUs, with {} MC "
     #    "steps per kernel call").format(p.nwalkers, len(gpus), 
@@ -229,7 +361,7 @@ def inverseIsing(args, log):
             raise Exception("Need to provide seqs if not using startseq")
         #get required seqs from end of detected seqs
         if len(p.seqs) == 1:
-            smallseq = [p.seqs[-sum([g.nseq['small'] for f in gpus]):]]
+            smallseq = [p.seqs[-sum([g.nseq['small'] for g in gpus]):]]
         else:
             smallseq = [s[-g.nseq['small']:] for s,g in zip(p.seqs, gpus)]
         transferSeqsToGPU(gpus, 'small', smallseq, log)
@@ -243,7 +375,12 @@ def inverseIsing(args, log):
          "sampling every {} loops to get {} samples ({} total seqs) with {} MC "
          "steps per loop (Each walker equilibrated a total of {} MC steps)."
          ).format(p.nwalkers, p.equiltime, p.sampletime, p.nsamples, 
-                p.nsamples*p.nwalkers, p.nsteps, p.nsteps*p.equiltime))
+                p.nsamples*p.nwalkers/p.ntemps, p.nsteps, 
+                p.nsteps*p.equiltime))
+    if distributed.comm.size > 1:
+        log(("Distributed over {} processes with {} GPUs and {} MC walkers "
+             "in total.").format(distributed.comm.size, int(sum(ngpus)), 
+             int(sum(distributed.comm.allgather(p.nwalkers)))))
     log("")
     log("")
     log("MCMC Run")
@@ -257,7 +394,8 @@ def getEnergies(args, log):
                                      description=descr)
     add = parser.add_argument
     add('out', default='output', help='Output File')
-    addopt(parser, 'GPU Options',         'wgsize gpus profile')
+    addopt(parser, 'GPU Options',         'wgsize chunksize gpus profile '
+                                          'trace')
     addopt(parser, 'Potts Model Options', 'alpha couplings')
     addopt(parser, 'Sequence Options',    'seqs')
     addopt(parser,  None,                 'outdir')
@@ -267,6 +405,8 @@ def getEnergies(args, log):
     
     args = parser.parse_args(args)
     args.measurefperror = False
+    args.kerneltime = 0
+    args.seqmodel = None
 
     requireargs(args, 'couplings alpha seqs')
 
@@ -275,40 +415,257 @@ def getEnergies(args, log):
     log("")
 
     param = attrdict({'outdir': args.outdir})
+    mkdir_p(args.outdir)
     param.update(process_potts_args(args, None, None, None, log))
     L, nB, alpha = param.L, param.nB, param.alpha
     log("Sequence Setup")
     log("--------------")
-    seqs = loadSequenceFile(args.seqs, alpha, log)
-    if seqs is None:
-        raise Exception("seqs must be supplied")
+    nseq = seqload.countSeqs(args.seqs)
+    log("Streaming {} sequences from file {}".format(nseq, args.seqs))
     log("")
 
-    args.nwalkers = len(seqs)
+    gpus, chunk = initStreamingGPUs(args, param, log)
+
+    log("Computing Energies")
+    log("==================")
+    
+    for gpu in gpus:
+        gpu.setBuf('J main', param.couplings)
+    
+    out = args.out if args.out.endswith('.npy') else args.out + '.npy'
+    log("Writing results to file '{}'".format(out))
+    es = np.lib.format.open_memmap(out, mode='w+', dtype='<f4', 
+                                   shape=(nseq,))
+
+    def runChunk(gpu, bufname):
+        gpu.calcEnergies(bufname, 'main')
+        return gpu.getBuf('E ' + bufname)
+
+    def writeChunk(offset, seqs, res):
+        es[offset:offset+len(seqs)] = res
+
+    streamSeqs(gpus, args.seqs, alpha, chunk, nseq, runChunk, writeChunk)
+    es.flush()
+    reportPerf(gpus, None, os.path.join(param.outdir, 'perf.json'), log)
+
+def findModels(paths):
+    # list of coupling files. Directories are expanded to the run_N/J.npy
+    # files of an inverseIsing run, in order of N
+    models = []
+    for path in paths:
+        if not os.path.isdir(path):
+            models.append(path)
+            continue
+        runs = []
+        for fn in glob.glob(os.path.join(path, 'run_*', 'J.npy')):
+            m = re.match(r'run_(\d+)$', os.path.basename(os.path.dirname(fn)))
+            if m:
+                runs.append((int(m.group(1)), fn))
+        if runs == []:
+            raise Exception("No run_N/J.npy files in directory {}".format(path))
+        models += [fn for n,fn in sorted(runs)]
+    return models
+
+def multiEnergies(args, log):
+    descr = ('Compute Potts Energies of a set of sequences for many sets of '
+             'couplings')
+    parser = argparse.ArgumentParser(prog=progname + ' multiEnergies',
+                                     description=descr)
+    add = parser.add_argument
+    add('out', default='output', 
+        help='Output File, for the (nmodels, nseq) energies')
+    add('models', nargs='+',
+        help=("Coupling files, or directories with inverseIsing output whose "
+              "run_N/J.npy couplings are used in order"))
+    addopt(parser, 'GPU Options',         'wgsize gpus profile trace')
+    addopt(parser, 'Potts Model Options', 'alpha')
+    addopt(parser, 'Sequence Options',    'seqs')
+    addopt(parser,  None,                 'outdir')
+
+    args = parser.parse_args(args)
+    args.measurefperror = False
+    args.kerneltime = 0
+    args.nwalkers = None
     args.gibbs = False
     args.nsteps = 1
     args.nlargebuf = 1
-    gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, 1, log)
-    gpuwalkers = divideWalkers(p.nwalkers, len(gdevs), p.wgsize, log)
-    param.update(gpup)
-    gpus = [initGPU(n, cldat, dev, nwalk, 1, param, log)
-            for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
-    transferSeqsToGPU(gpus, 'small', [seqs], log)
+
+    requireargs(args, 'alpha seqs')
+
+    log("Initialization")
+    log("===============")
+    log("")
+
+    mkdir_p(args.outdir)
+    models = findModels(args.models)
+    out = args.out if args.out.endswith('.npy') else args.out + '.npy'
+    modelfile = out[:-len('.npy')] + '_models.txt'
+    with open(modelfile, 'wt') as f:
+        f.write("\n".join(models) + "\n")
+    log("{} coupling sets, listed in file {}".format(len(models), modelfile))
+
+    alpha = args.alpha
+    Jshape = np.load(models[0], mmap_mode='r').shape
+    L, nB = seqsize_from_param_shape(Jshape)
+    if nB != len(alpha):
+        raise Exception("Couplings do not match the alphabet size")
+    log("alphabet: {}".format(alpha))
+    log("nBases {}  seqLen {}".format(nB, L))
     log("")
 
+    log("Sequence Setup")
+    log("--------------")
+    seqs = loadSequenceFile(args.seqs, alpha, log)
+    nseq = len(seqs)
+    log("")
+
+    param = attrdict({'outdir': args.outdir})
+    gpup, cldat, gdevs = process_GPU_args(args, L, nB, param.outdir, 1, log)
+    param.update(gpup)
+    #seqs are divided among the gpus' large buffers, padded to a multiple
+    #of wgsize
+    wgsize = param.wgsize
+    gpuwalkers = divideWalkers(nseq, len(gdevs), wgsize, log)
+    padwalkers = [wgsize*((n-1)//wgsize + 1) for n in gpuwalkers]
+    gpus = [initGPU(n, cldat, dev, wgsize, npad, param, log)
+            for n,(dev, npad) in enumerate(zip(gdevs, padwalkers))]
+    for gpu, s, npad in zip(gpus, split(seqs, cumsum(gpuwalkers)[:-1]), 
+                            padwalkers):
+        padded = zeros((npad, L), dtype='<u1')
+        padded[:len(s)] = s
+        gpu.setBuf('seq large', padded)
+        #second energy buffer, so one model's energies are read back while
+        #the next is computed
+        gpu.addBuf('E large2', '<f4', (npad,))
+    log("")
 
     log("Computing Energies")
     log("==================")
+
+    log("Writing results to file '{}'".format(out))
+    es = np.lib.format.open_memmap(out, mode='w+', dtype='<f4', 
+                                   shape=(len(models), nseq))
+
+    def writeModel(k, readbacks):
+        es[k] = concatenate([buf.read()[:n] 
+                             for buf,n in zip(readbacks, gpuwalkers)])
+        for buf in readbacks:
+            buf.release()
+
+    #couplings alternate between the front and back J buffers, so the next
+    #upload overlaps with the current model's kernels
+    pending = deque()
+    for k, fn in enumerate(models):
+        couplings = np.load(fn)
+        if couplings.shape != Jshape or couplings.dtype != dtype('<f4'):
+            raise Exception("Couplings in {} must be '<f4' with shape "
+                            "{}".format(fn, Jshape))
+        Jbuf = ['front', 'back'][k%2]
+        Ebuf = ['E large', 'E large2'][k%2]
+        for gpu in gpus:
+            gpu.setBuf('J ' + Jbuf, couplings)
+            gpu.calcEnergies('large', Jbuf, Ebuf)
+        pending.append((k, [gpu.getBuf(Ebuf) for gpu in gpus]))
+        if len(pending) > 1:
+            writeModel(*pending.popleft())
+    while pending:
+        writeModel(*pending.popleft())
+    es.flush()
+    reportPerf(gpus, None, os.path.join(param.outdir, 'perf.json'), log)
+
+def mutscan(args, log):
+    descr = ('Compute the energy change of all single point mutants of a set '
+             'of sequences, and optionally the epistasis of double mutants')
+    parser = argparse.ArgumentParser(prog=progname + ' mutscan',
+                                     description=descr)
+    add = parser.add_argument
+    add('out', default='output', 
+        help='Output File, for the (nseq, L, nB) single mutant energy changes')
+    add('--pairs', 
+        help=("comma separated list of position pairs i:j for which to "
+              "compute double mutant epistasis, eg '3:10,4:12'"))
+    addopt(parser, 'GPU Options',         'wgsize chunksize gpus profile '
+                                          'trace')
+    addopt(parser, 'Potts Model Options', 'alpha couplings')
+    addopt(parser, 'Sequence Options',    'seqs')
+    addopt(parser,  None,                 'outdir')
+
+    args = parser.parse_args(args)
+    args.measurefperror = False
+    args.kerneltime = 0
+    args.seqmodel = None
+
+    requireargs(args, 'couplings alpha seqs')
+
+    log("Initialization")
+    log("===============")
+    log("")
+
+    param = attrdict({'outdir': args.outdir})
+    mkdir_p(args.outdir)
+    param.update(process_potts_args(args, None, None, None, log))
+    L, nB, alpha = param.L, param.nB, param.alpha
+    couplings = param.couplings
+
+    pairs, Jpairs = [], []
+    if args.pairs is not None:
+        pairs = [tuple(sorted(int(x) for x in p.split(':'))) 
+                 for p in args.pairs.split(',')]
+        if any([i == j or i < 0 or j >= L for i,j in pairs]):
+            raise Exception("Error: pairs must be distinct positions less "
+                            "than L")
+
+    log("Sequence Setup")
+    log("--------------")
+    nseq = seqload.countSeqs(args.seqs)
+    log("Streaming {} sequences from file {}".format(nseq, args.seqs))
+    log("")
+
+    gpus, chunk = initStreamingGPUs(args, param, log, 
+                                    resultbytes=4*L*nB)
+
+    log("Mutant Scan")
+    log("===========")
     
     for gpu in gpus:
-        gpu.setBuf('J main', param.couplings)
-    
-    for gpu in gpus:
-        gpu.calcEnergies('small', 'main')
-    es = concatenate(readGPUbufs(['E small'], gpus)[0])
+        gpu.setBuf('J main', couplings)
     
-    log("Saving results to file '{}'".format(args.out))
-    save(args.out, es)
+    out = args.out if args.out.endswith('.npy') else args.out + '.npy'
+    log("Writing single mutant energy changes to file '{}'".format(out))
+    dE = np.lib.format.open_memmap(out, mode='w+', dtype='<f4', 
+                                   shape=(nseq, L, nB))
+    if pairs != []:
+        # epistasis of double mutant (a,b) at pair (i,j) is 
+        #   dE(i->a, j->b) - dE(i->a) - dE(j->b)
+        #     = J_ij(a,b) - J_ij(a,s_j) - J_ij(s_i,b) + J_ij(s_i,s_j)
+        # which only depends on the residues at i and j.
+        epiout = out[:-len('.npy')] + '_epistasis.npy'
+        log("Writing double mutant epistasis for {} pairs to file "
+            "'{}'".format(len(pairs), epiout))
+        epi = np.lib.format.open_memmap(epiout, mode='w+', dtype='<f4', 
+                                        shape=(nseq, len(pairs), nB, nB))
+        pairind = lambda i,j: (L*(L-1)/2) - (L-i)*((L-i)-1)/2 + j - i - 1
+        Jpairs = [couplings[pairind(i,j)].reshape((nB, nB)) for i,j in pairs]
+
+    def runChunk(gpu, bufname):
+        gpu.calcMutscan(bufname)
+        return gpu.getBuf('dE ' + bufname)
+
+    def writeChunk(offset, seqs, res):
+        n = len(seqs)
+        dE[offset:offset+n] = res.T.reshape((n, L, nB))
+        for k,((i,j), Jij) in enumerate(zip(pairs, Jpairs)):
+            si, sj = seqs[:,i], seqs[:,j]
+            epi[offset:offset+n,k] = (Jij[newaxis,:,:] 
+                                      - Jij[:,sj].T[:,:,newaxis]
+                                      - Jij[si,:][:,newaxis,:]
+                                      + Jij[si,sj][:,newaxis,newaxis])
+
+    streamSeqs(gpus, args.seqs, alpha, chunk, nseq, runChunk, writeChunk)
+    dE.flush()
+    if pairs != []:
+        epi.flush()
+    reportPerf(gpus, None, os.path.join(param.outdir, 'perf.json'), log)
 
 
 def MCMCbenchmark(args, log):
@@ -318,8 +675,8 @@ def MCMCbenchmark(args, log):
     add = parser.add_argument
     add('--nloop', type=uint32, required=True, 
         help="Number of kernel calls to benchmark")
-    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
-                                          'gibbs gpus profile')
+    addopt(parser, 'GPU options',         'nwalkers nsteps kerneltime wgsize '
+                                          'gibbs gpus profile trace')
     addopt(parser, 'Sequence Options',    'startseq seqs')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'seqmodel outdir')
@@ -337,7 +694,8 @@ def MCMCbenchmark(args, log):
     p.update(process_potts_args(args, p.L, p.nB, None, log))
     L, nB, alpha = p.L, p.nB, p.alpha
     args.nlargebuf = 1
-    gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, 2*nloop, log)
+    gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, 2*nloop+2, 
+                                          log)
     p.update(gpup)
     gpuwalkers = divideWalkers(p.nwalkers, len(gdevs), p.wgsize, log)
     gpus = [initGPU(n, cldat, dev, nwalk, 1, p, log)
@@ -366,9 +724,7 @@ def MCMCbenchmark(args, log):
     import time
 
     def runMCMC():
-        for i in range(nloop):
-            for gpu in gpus:
-                gpu.runMCMC()
+        runMCMCLoops(gpus, nloop)
         for gpu in gpus:
             gpu.wait()
     
@@ -378,35 +734,148 @@ def MCMCbenchmark(args, log):
     
     #warmup
     log("Warmup run...")
+    if p.kerneltime:
+        tuneKernelSteps(gpus, p.kerneltime, log)
     runMCMC()
     
     #timed run
     log("Timed run...")
-    start = time.clock()
-    runMCMC()
-    end = time.clock()
+    with tracing.phase('benchmark'):
+        start = time.time()
+        runMCMC()
+        end = time.time()
 
     log("Elapsed time: ", end - start, )
     totsteps = p.nwalkers*nloop*p.nsteps
     steps_per_second = totsteps/(end-start)
     log("MC steps computed: {}".format(totsteps))
     log("MC steps per second: {:g}".format(steps_per_second))
+    reportPerf(gpus, None, os.path.join(p.outdir, 'perf.json'), log)
+
+def benchmarkSuite(args, log):
+    descr = ('Benchmark the GPU kernels and host-side hot paths on a '
+             'synthetic Potts model')
+    parser = argparse.ArgumentParser(prog=progname + ' benchsuite',
+                                     description=descr)
+    add = parser.add_argument
+    add('--L', type=int, default=64, help="sequence length")
+    add('--nB', type=int, default=21, help="alphabet size")
+    add('--nloop', type=uint32, default=4,
+        help="Number of MCMC kernel calls per repetition")
+    add('--nrep', type=uint32, default=5,
+        help="Number of timed repetitions of each case")
+    add('--cases', help="comma separated list of cases to run (default all)")
+    add('--baseline', help=("Previous benchsuite.json to compare against. "
+                            "Exits with an error if any case is slower"))
+    add('--tolerance', type=float, default=0.1,
+        help="Fractional slowdown relative to baseline counted as regression")
+    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize gpus '
+                                          'profile trace')
+    addopt(parser,  None,                 'outdir')
+
+    args = parser.parse_args(args)
+    requireargs(args, 'nwalkers')
+    args.measurefperror = False
+    args.kerneltime = 0
+    args.gibbs = False
+    L, nB = args.L, args.nB
+    letters = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+               '0123456789')
+    if nB > len(letters):
+        raise Exception("nB must be at most {}".format(len(letters)))
+    alpha = letters[:nB]
+    only = args.cases.split(',') if args.cases is not None else None
+
+    log("Initialization")
+    log("===============")
+    log("")
+
+    p = attrdict({'outdir': args.outdir})
+    mkdir_p(args.outdir)
+    log("Synthetic Potts model with L = {}, nB = {}".format(L, nB))
+    couplings, seqs, bimarg = benchsuite.syntheticModel(L, nB, args.nwalkers)
+    log("")
+
+    nMCMCcalls = (args.nrep+1)*args.nloop
+    gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, nMCMCcalls, 
+                                          log)
+    p.update(gpup)
+    gpuwalkers = divideWalkers(p.nwalkers, len(gdevs), p.wgsize, log)
+    gpus = [initGPU(n, cldat, dev, nwalk, nwalk, p, log)
+            for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
+    #separate gpu objects for the gibbs kernel
+    p.gibbs = True
+    ngpu = len(gdevs)
+    gibbsgpus = [initGPU(ngpu + n, cldat, dev, nwalk, nwalk, p, log)
+                 for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
+    #and for the large buffer spilled to host memory, holding 2 samples
+    p.gibbs = False
+    p['spill'] = True
+    spillgpus = [initGPU(2*ngpu + n, cldat, dev, nwalk, 2*nwalk, p, log)
+                 for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
+
+    gpuseqs = split(seqs, cumsum(gpuwalkers)[:-1])
+    for gpu, s in zip(gpus + gibbsgpus + spillgpus, gpuseqs*3):
+        gpu.setBuf('seq small', s)
+        gpu.setBuf('seq large', s if not gpu.spill else concatenate([s, s]))
+        for buf in ['J main', 'J back']:
+            gpu.setBuf(buf, couplings)
+        for buf in ['bi target', 'bi back']:
+            gpu.setBuf(buf, bimarg)
+        gpu.calcEnergies('large', 'main')
+    log("")
+
+    log("Benchmark Suite")
+    log("===============")
+    log("")
+    log("{} repetitions per case. Best time per repetition, and rate:".format(
+        args.nrep))
+    cases = (benchsuite.gpuCases(gpus, gibbsgpus, args.nloop, spillgpus) + 
+             benchsuite.hostCases(couplings, seqs, bimarg, alpha, p.outdir))
+    results = {'params': {'L': L, 'nB': nB, 'nwalkers': int(p.nwalkers), 
+                          'nsteps': int(p.nsteps), 'wgsize': p.wgsize, 
+                          'nloop': int(args.nloop),
+                          'devices': [d.name.strip() for d in gdevs]},
+               'cases': benchsuite.runCases(cases, args.nrep, only, log)}
+
+    fn = os.path.join(p.outdir, 'benchsuite.json')
+    log("")
+    log("Saving results to {}".format(fn))
+    benchsuite.saveResults(fn, results)
+    reportPerf(gpus + gibbsgpus + spillgpus, None, 
+               os.path.join(p.outdir, 'perf.json'), log)
+
+    if args.baseline is not None:
+        log("")
+        log("Comparison to baseline {}".format(args.baseline))
+        baseline = benchsuite.loadResults(args.baseline)
+        regressions = benchsuite.compareBaseline(results, baseline, 
+                                                 args.tolerance, log)
+        if regressions != []:
+            raise Exception("Performance regression in: {}".format(
+                            ", ".join(regressions)))
 
 def equilibrate(args, log):
     descr = ('Run a round of MCMC generation on the GPU')
     parser = argparse.ArgumentParser(prog=progname + ' mcmc',
                                      description=descr)
     add = parser.add_argument
-    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
-                                          'gibbs gpus profile')
+    addopt(parser, 'GPU options',         'nwalkers nsteps kerneltime wgsize '
+                                          'gibbs gpus profile trace')
     addopt(parser, 'Sequence Options',    'startseq seqs')
     addopt(parser, 'Sampling Options',    'equiltime sampletime nsamples '
-                                          'trackequil')
+                                          'trackequil equildump equilthresh '
+                                          'spill '
+                                          'ntemps betamin '
+                                          'tunetemps proposal autocorr '
+                                          'stream accumulate '
+                                          'saveseqs ehistbins erange')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'seqmodel outdir')
 
     args = parser.parse_args(args)
     args.measurefperror = False
+    args.adaptsample = 0
 
     log("Initialization")
     log("===============")
@@ -418,11 +887,14 @@ def equilibrate(args, log):
     L, nB, alpha = p.L, p.nB, p.alpha
 
     p.update(process_sample_args(args, log))
-    rngPeriod = (p.equiltime + p.sampletime*p.nsamples)
+    p.update(process_accumulate_args(args, log))
+    rngPeriod = (p.equiltime + p.sampletime*p.nsamples) + 2
     gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, rngPeriod, log)
     p.update(gpup)
     gpuwalkers = divideWalkers(p.nwalkers, len(gdevs), p.wgsize, log)
-    gpus = [initGPU(n, cldat, dev, nwalk, nwalk*p.nsamples, p, log)
+    #when streaming or accumulating, the large buffer is unused 
+    nlarge = 1 if (p.accumulate or p.stream) else p.nsamples
+    gpus = [initGPU(n, cldat, dev, nwalk, nwalk/p.ntemps*nlarge, p, log)
             for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
     preopt_seqs = sum([g.nseq['large'] for g in gpus])
     p.update(process_sequence_args(args, L, alpha, None, log, 
@@ -432,20 +904,157 @@ def equilibrate(args, log):
     log("Equilibrating ...")
     for gpu in gpus:
         gpu.fillSeqs(p.startseq)
+    outdir = p.outdir
+
+    if p.accumulate:
+        (bimarg_model, bicount, nseq, 
+         (Emean, Evar), 
+         (Ehist, edges)) = sampleAccumulate(gpus, p.couplings, '.', p, log)
+        log("Accumulated {} sequences. Energy mean {} variance {}".format(
+            nseq, Emean, Evar))
+        with tracing.phase('output'):
+            savetxt(os.path.join(outdir, 'bicounts'), bicount, fmt='%d')
+            save(os.path.join(outdir, 'bimarg'), bimarg_model)
+            savetxt(os.path.join(outdir, 'Emoments'), [[nseq, Emean, Evar]],
+                    header='nseq mean variance')
+            save(os.path.join(outdir, 'Ehist'), Ehist)
+            save(os.path.join(outdir, 'Ehist_edges'), edges)
+        reportPerf(gpus, None, os.path.join(outdir, 'perf.json'), log)
+        return
+
+    if p.stream:
+        streamSamples(gpus, p, log)
+        reportPerf(gpus, None, os.path.join(outdir, 'perf.json'), log)
+        return
 
     (bimarg_model, 
      bicount, 
      energies, 
-     seqs) = runMCMC(gpus, p.startseq, p.couplings, '.', p)
+     seqs) = runMCMC(gpus, p.startseq, p.couplings, '.', p, log)
     
+    with tracing.phase('output'):
+        savetxt(os.path.join(outdir, 'bicounts'), bicount, fmt='%d')
+        save(os.path.join(outdir, 'bimarg'), bimarg_model)
+        save(os.path.join(outdir, 'energies'), energies)
+        for n,seqbuf in enumerate(seqs):
+            seqload.writeSeqs(os.path.join(outdir, 'seqs-{}'.format(n)), 
+                              seqbuf, alpha)
+    reportPerf(gpus, None, os.path.join(outdir, 'perf.json'), log)
+
+
+def streamSamples(gpus, p, log):
+    # writes the samples to the seqs file and energies.npy in the output 
+    # directory as they are generated
     outdir = p.outdir
-    savetxt(os.path.join(outdir, 'bicounts'), bicount, fmt='%d')
-    save(os.path.join(outdir, 'bimarg'), bimarg_model)
-    save(os.path.join(outdir, 'energies'), energies)
-    for n,seqbuf in enumerate(seqs):
-        seqload.writeSeqs(os.path.join(outdir, 'seqs-{}'.format(n)), 
-                          seqbuf, alpha)
+    nwalkers = sum([gpu.nseq['small'] for gpu in gpus])
+    energies = np.lib.format.open_memmap(os.path.join(outdir, 'energies.npy'),
+                                         mode='w+', dtype='<f4', 
+                                         shape=(p.nsamples*nwalkers,))
+    with open(os.path.join(outdir, 'seqs'), 'wt') as f:
+        seqload.writeSeqsF(f, zeros((0, p.L), dtype='<u1'), p.alpha)
+        samples = generateSamples(gpus, p.couplings, '.', p, log)
+        for j, (seqs, es) in enumerate(samples):
+            with tracing.phase('output', sample=j):
+                seqload.writeSeqsF(f, seqs, p.alpha, noheader=True)
+                f.flush()
+                energies[j*nwalkers:(j+1)*nwalkers] = es
+            log("Wrote sample {} of {}".format(j+1, p.nsamples))
+    energies.flush()
+
+def design(args, log):
+    descr = ('Design low energy sequences by simulated annealing')
+    parser = argparse.ArgumentParser(prog=progname + ' design',
+                                     description=descr)
+    add = parser.add_argument
+    add('--schedule', default='0.1:4',
+        help=("Inverse temperatures 'start:end' of each anneal, relative to "
+              "the model's. Beta increases geometrically from start to end"))
+    add('--annealtime', type=uint32, default=64,
+        help="Number of MCMC loops (kernel calls) per anneal")
+    add('--nanneal', type=uint32, default=1,
+        help=("Number of successive anneals, each restarting the walkers "
+              "from random sequences"))
+    add('--topk', type=uint32, default=100,
+        help="Number of distinct lowest energy sequences to save")
+    add('--fixpos', 
+        help=("comma separated list of positions which are kept fixed to "
+              "the residues of startseq"))
+    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize gpus '
+                                          'profile trace')
+    addopt(parser, 'Sequence Options',    'startseq')
+    addopt(parser, 'Potts Model Options', 'alpha couplings L')
+    addopt(parser,  None,                 'seqmodel outdir')
+
+    args = parser.parse_args(args)
+    args.measurefperror = False
+    args.kerneltime = 0
+    args.gibbs = False
+    args.trackequil = 0
+
+    requireargs(args, 'nwalkers')
+    if args.fixpos is not None and args.startseq is None:
+        raise Exception("fixpos requires a startseq")
+
+    log("Initialization")
+    log("===============")
+
+    p = attrdict({'outdir': args.outdir})
+    mkdir_p(args.outdir)
+    p.update(process_potts_args(args, None, None, None, log))
+    L, nB, alpha = p.L, p.nB, p.alpha
+
+    bstart, bend = [float(x) for x in args.schedule.split(':')]
+    if not 0 < bstart <= bend:
+        raise Exception("schedule must be 'start:end' with 0 < start <= end")
+    schedule = bstart*(bend/bstart)**linspace(0, 1, args.annealtime)
+    log(("Running {} anneals of {} loops of {} MC steps, with beta from {} "
+         "to {}").format(args.nanneal, args.annealtime, args.nsteps, bstart, 
+                         bend))
+
+    fixedmarks = zeros(L, dtype='u1')
+    startseq = None
+    if args.fixpos is not None:
+        fixedpos = array([int(x) for x in args.fixpos.split(',')])
+        fixedmarks[fixedpos] = 1
+        startseq = array(map(alpha.index, args.startseq), dtype='<u1')
+        log("Fixed positions {} to residues {}".format(args.fixpos, 
+            "".join(alpha[startseq[i]] for i in fixedpos)))
+
+    rngPeriod = args.annealtime*args.nanneal + 2
+    gpup, cldat, gdevs = process_GPU_args(args, L, nB, p.outdir, rngPeriod, log)
+    p.update(gpup)
+    gpuwalkers = divideWalkers(p.nwalkers, len(gdevs), p.wgsize, log)
+    #the large buffer is unused
+    gpus = [initGPU(n, cldat, dev, nwalk, 1, p, log)
+            for n,(dev, nwalk) in enumerate(zip(gdevs, gpuwalkers))]
+    for gpu in gpus:
+        gpu.setBuf('J main', p.couplings)
+        gpu.setFixedPos(fixedmarks)
+    log("")
+
+    log("Annealing")
+    log("=========")
+    log("")
 
+    bestseqs = zeros((0, L), dtype='<u1')
+    bestE = zeros(0, dtype='<f4')
+    for n in range(args.nanneal):
+        startseqs = [randint(0, nB, size=(nwalk, L)).astype('<u1') 
+                     for nwalk in gpuwalkers]
+        if startseq is not None:
+            for seqs in startseqs:
+                seqs[:,fixedmarks != 0] = startseq[fixedmarks != 0]
+        seqs, energies = annealSeqs(gpus, startseqs, schedule, args.topk)
+        bestseqs, bestE = topDistinct(concatenate([bestseqs, seqs]),
+                                      concatenate([bestE, energies]), 
+                                      args.topk)
+        log("Anneal {}: lowest energy {}, {}th lowest {}".format(n, 
+            energies[0], len(bestE), bestE[-1]))
+
+    log("Saving {} sequences to {}".format(len(bestE), p.outdir))
+    seqload.writeSeqs(os.path.join(p.outdir, 'seqs'), bestseqs, alpha)
+    save(os.path.join(p.outdir, 'energies'), bestE)
+    reportPerf(gpus, None, os.path.join(p.outdir, 'perf.json'), log)
 
 def subseqFreq(args, log):
     descr = ('Compute relative frequency of subsequences at fixed positions')
@@ -454,7 +1063,7 @@ def subseqFreq(args, log):
     add = parser.add_argument
     add('fixpos', help="comma separated list of fixed positions")
     add('out', default='output', help='Output File')
-    addopt(parser, 'GPU options',         'nsteps wgsize gpus profile')
+    addopt(parser, 'GPU options',         'nsteps wgsize gpus profile trace')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'outdir')
     group = parser.add_argument_group('Sequence Options')
@@ -464,6 +1073,10 @@ def subseqFreq(args, log):
     
     args = parser.parse_args(args)
     args.measurefperror = False
+    args.kerneltime = 0
+    args.gibbs = False
+    args.nwalkers = None
+    args.seqmodel = None
 
     log("Initialization")
     log("===============")
@@ -503,24 +1116,22 @@ def subseqFreq(args, log):
     log("=================================")
     log("")
 
-    for gpu in gpus:
-        gpu.calcEnergies('large', 'main')
-    origEs = concatenate(readGPUbufs(['E large'], gpus)[0])
-
     log("Getting substituted energies...")
-    subseqE = []
-    logf = zeros(len(sseqs))
-    for n in range(len(sseqs)):
-        # replaced fixed positions by subsequence, and calc energies
+    # each gpu computes logsumexp(origE - E) over its background seqs for
+    # every subseq. Subseqs are done in batches to keep kernel launches short
+    nsub = len(sseqs)
+    batch = max(1, (1<<22)//max(gpuwalkers))
+    for offset in range(0, nsub, batch):
         for gpu in gpus:
-            gpu.copySubseq(n)
-            gpu.calcEnergies('large', 'main')
-        energies = concatenate(readGPUbufs(['E large'], gpus)[0])
-        logf[n] = logsumexp(origEs - energies)
+            gpu.calcSubseqFreq(offset, min(batch, nsub - offset))
+    res = readGPUbufs(['E small'], gpus)
+    logf = logsumexp(array(res[0]), axis=0)
+    releaseGPUbufs(res, gpus)
 
     #save result
     log("Saving result (log frequency) to file {}".format(args.out))
     save(args.out, logf)
+    reportPerf(gpus, None, os.path.join(p.outdir, 'perf.json'), log)
     
 
 ################################################################################
@@ -534,6 +1145,7 @@ def process_GPU_args(args, L, nB, outdir, rngPeriod, log):
                       'nwalkers': args.nwalkers,
                       'gpuspec': args.gpus,
                       'gibbs': args.gibbs,
+                      'kerneltime': args.kerneltime,
                       'profile': args.profile,
                       'fperror': args.measurefperror})
     
@@ -544,16 +1156,38 @@ def process_GPU_args(args, L, nB, outdir, rngPeriod, log):
 
     log("Work Group Size: {}".format(p.wgsize))
     log("{} MC steps per MCMC kernel call".format(p.nsteps))
+    if p.kerneltime:
+        log("Adapting MC steps per kernel launch to target duration "
+            "{}s".format(p.kerneltime))
     log("Using {} MC sampler".format('Gibbs' if args.gibbs 
                                    else 'Metropolis-hastings'))
     log("GPU Initialization:")
     if p.profile:
         log("Profiling Enabled")
+        tracing.enableReport()
+    if args.trace:
+        log("Tracing Enabled, writing trace to {} at exit".format(args.trace))
+        tracing.enable(args.trace)
     clinfo, gpudevs = setupGPUs(scriptPath, scriptfile, p, log)
 
     log("")
     return p, clinfo, gpudevs
 
+def process_distributed_args(args, log):
+    if args.listen is None and args.connect is None:
+        return
+    log("Distributed Setup")
+    log("-----------------")
+    if args.listen is not None and args.connect is not None:
+        raise Exception("Error: cannot both listen and connect")
+    if args.listen is not None:
+        if args.nworkers < 1:
+            raise Exception("Error: nworkers must be at least 1")
+        distributed.listen(args.listen, args.nworkers, log)
+    else:
+        distributed.connect(args.connect, log)
+    log("")
+
 def process_newton_args(args, log):
     log("Newton Solver Setup")
     log("-------------------")
@@ -566,7 +1200,9 @@ def process_newton_args(args, log):
              'pcdamping': args.damping,
              'jclamp': args.jclamp,
              'resetseqs': args.resetseqs,
-             'preopt': args.preopt }
+             'warmstart': args.warmstart,
+             'preopt': args.preopt,
+             'dedup': args.dedup }
     p = attrdict(param)
 
     cutoffstr = ('dJ clamp {}'.format(p.jclamp) if p.jclamp != 0 
@@ -574,6 +1210,15 @@ def process_newton_args(args, log):
     log(("Updating J locally with gamma = {}, {}, and pc-damping {}. "
          "Running {} Newton update steps per round.").format(
           p.gamma0, cutoffstr, p.pcdamping, p.newtonSteps))
+    if p.dedup:
+        log("Deduplicating sampled sequences before Newton steps")
+    if not p.resetseqs:
+        if p.warmstart == 'reseed':
+            raise Exception("warmstart reseed cannot be used with resetseqs")
+        p['warmstart'] = 'continue'
+    if p.warmstart == 'reseed' and args.spill:
+        raise Exception("warmstart reseed cannot be used with spill")
+    log("Walkers start each round after the first by: {}".format(p.warmstart))
 
     log("Reading target marginals from file {}".format(args.bimarg))
     bimarg = scipy.load(args.bimarg)
@@ -760,6 +1405,83 @@ def loadSequenceDir(sdir, alpha, log):
         seqs.append(seqload.loadSeqs(sfile, names=alpha)[0].astype('<u1'))
     return seqs
 
+streambudget = 1<<28 #max bytes of device memory for streaming results
+
+def initStreamingGPUs(args, param, log, resultbytes=0):
+    # sets up gpus for streaming a sequence file in chunks of 
+    # args.chunksize seqs per gpu (see streamSeqs). If the result of each seq
+    # takes resultbytes on the gpu, the chunks are made smaller if needed so
+    # the results of the two buffers fit in streambudget bytes. Returns gpus
+    # and chunk size.
+    wgsize = args.wgsize
+    chunk = wgsize*((int(args.chunksize)-1)//wgsize + 1)
+    if resultbytes and 2*chunk*resultbytes > streambudget:
+        chunk = max(wgsize, wgsize*(streambudget//(2*resultbytes*wgsize)))
+    args.nwalkers = None
+    args.gibbs = False
+    args.nsteps = 1
+    args.nlargebuf = 1
+    gpup, cldat, gdevs = process_GPU_args(args, param.L, param.nB, 
+                                          param.outdir, 1, log)
+    param.update(gpup)
+    gpus = [initGPU(n, cldat, dev, chunk, chunk, param, log)
+            for n,dev in enumerate(gdevs)]
+    log("Chunks of {} sequences per GPU".format(chunk))
+    if resultbytes:
+        log("Using {:.1f} MB of GPU memory per GPU for results".format(
+            2*chunk*resultbytes/1e6))
+    log("")
+    return gpus, chunk
+
+def streamSeqs(gpus, seqfile, alpha, chunk, nseq, runChunk, writeChunk):
+    # Streams the seqs in seqfile through the gpus in chunks of chunk seqs
+    # per gpu. runChunk(gpu, bufname) should enqueue work on the seqs in seq
+    # buffer bufname, and return a FutureBuf of the result, which has the seqs
+    # along the last axis. writeChunk(offset, seqs, result) is then called
+    # with the seqs starting at offset in the file, and the result for them.
+    # 
+    # Each gpu has two buffers of chunk seqs (the 'small' and 'large'
+    # buffers), which are used alternately so that one chunk is parsed and
+    # uploaded while the previous one is computed and read back.
+    L = gpus[0].L
+    padded = zeros((chunk, L), dtype='<u1')
+
+    def finishChunk(offset, seqs, readbacks):
+        res = []
+        for buf, n in readbacks:
+            res.append(buf.read()[...,:n])
+            buf.release()
+        writeChunk(offset, seqs, concatenate(res, axis=-1))
+
+    pending = deque()
+    offset = 0
+    with open(seqfile) as f:
+        seqgen = seqload.loadSeqsChunked(f, alpha, chunk*len(gpus))
+        seqgen.next() #header
+        for i, seqs in enumerate(seqgen):
+            bufname = ['small', 'large'][i%2]
+            readbacks = []
+            for n, gpu in enumerate(gpus):
+                s = seqs[n*chunk:(n+1)*chunk]
+                if len(s) == 0:
+                    break
+                if len(s) != chunk: #last chunk, pad with dummy seqs
+                    padded[:len(s)] = s
+                    s = padded
+                gpu.setBuf('seq ' + bufname, s)
+                readbacks.append((runChunk(gpu, bufname), 
+                                  min(chunk, len(seqs) - n*chunk)))
+            pending.append((offset, seqs, readbacks))
+            offset += len(seqs)
+            #keep the previous chunk in flight while this one is parsed
+            if len(pending) > 1:
+                finishChunk(*pending.popleft())
+    while pending:
+        finishChunk(*pending.popleft())
+    if offset != nseq:
+        raise Exception("Error: read {} sequences but expected {}".format(
+                        offset, nseq))
+
 def transferSeqsToGPU(gpus, bufname, seqs, log):
     log("Transferring {} seqs to gpu's {} seq buffer...".format(str([len(s) for s in seqs]), bufname))
     if len(seqs) == 1:
@@ -779,11 +1501,20 @@ def transferSeqsToGPU(gpus, bufname, seqs, log):
                             gpu.nseq[bufname], len(seq)))
         gpu.setBuf('seq ' + bufname, seq)
 
-def process_sample_args(args, log):
+def process_sample_args(args, log, bimarg=None):
     p = attrdict({'equiltime': args.equiltime,
                   'sampletime': args.sampletime,
                   'nsamples': args.nsamples,
-                  'trackequil': args.trackequil})
+                  'trackequil': args.trackequil,
+                  'equildump': args.equildump,
+                  'equilthresh': args.equilthresh,
+                  'spill': args.spill,
+                  'ntemps': args.ntemps,
+                  'betamin': args.betamin,
+                  'tunetemps': args.tunetemps,
+                  'proposal': None,
+                  'autocorr': args.autocorr or args.adaptsample != 0,
+                  'adaptsample': args.adaptsample})
 
     if p.nsamples == 0:
         raise Exception("nsamples must be at least 1")
@@ -798,7 +1529,83 @@ def process_sample_args(args, log):
         if p.equiltime%p.trackequil != 0:
             raise Exception("Error: trackequil must be a divisor of equiltime")
         log("Tracking equilibration every {} loops.".format(p.trackequil))
+        if p.equildump:
+            log("Saving bimarg every {} intervals".format(p.equildump))
+    if p.equilthresh:
+        if p.trackequil == 0:
+            raise Exception("equilthresh requires trackequil")
+        log(("Ending equilibration early when the bimarg drift is below {} "
+             "times the sampling noise").format(p.equilthresh))
+    if p.spill:
+        log("Storing sampled sequences in host memory, streamed through the "
+            "GPUs in blocks")
+    if p.ntemps == 0:
+        raise Exception("ntemps must be at least 1")
+    if p.ntemps > 1:
+        if args.gibbs:
+            raise Exception("parallel tempering requires the Metropolis "
+                            "sampler")
+        if not 0 < p.betamin < 1:
+            raise Exception("betamin must be between 0 and 1")
+        log(("Parallel tempering with {} temperatures, beta from 1 to {}, "
+             "tuned {} times during equilibration").format(p.ntemps, 
+             p.betamin, p.tunetemps))
+    if p.adaptsample < 0:
+        raise Exception("adaptsample must be positive")
+    if p.autocorr:
+        log("Tracking walker energies and Hamming distances during sampling")
+    if p.adaptsample:
+        log("Adapting sampletime to {} autocorrelation times".format(
+            p.adaptsample))
+    if args.proposal != 'uniform':
+        if args.gibbs:
+            raise Exception("marginal proposals require the Metropolis "
+                            "sampler")
+        if args.proposal != 'marginal':
+            bimarg = load(args.proposal)
+        elif bimarg is None:
+            raise Exception("proposal 'marginal' requires target bimarg, "
+                            "otherwise give a bimarg file")
+        # mix in a little of the uniform distribution so no residue has
+        # zero proposal probability
+        nB = seqsize_from_param_shape(bimarg.shape)[1]
+        p['proposal'] = 0.99*getUnimarg(bimarg) + 0.01/nB
+        log("Proposing mutations from the site marginals of {}".format(
+            'the target bimarg' if args.proposal == 'marginal' 
+                                else args.proposal))
+
+    log("")
+    return p
 
+def process_accumulate_args(args, log):
+    p = attrdict({'stream': args.stream,
+                  'accumulate': args.accumulate,
+                  'saveseqs': args.saveseqs,
+                  'ehistbins': args.ehistbins,
+                  'erange': None})
+    if p.stream and (p.accumulate or args.spill):
+        raise Exception("stream cannot be used with accumulate or spill")
+    if (p.stream or p.accumulate) and (args.ntemps > 1 or args.autocorr):
+        raise Exception("stream and accumulate cannot be used with ntemps "
+                        "or autocorr")
+    if p.stream:
+        log("Streaming samples to disk as they are generated")
+        log("")
+        return p
+    if not p.accumulate:
+        return p
+    if args.spill:
+        raise Exception("spill cannot be used with accumulate")
+    if p.ehistbins == 0:
+        raise Exception("ehistbins must be at least 1")
+    if args.erange is not None:
+        p['erange'] = tuple(float(e) for e in args.erange.split(':'))
+        if len(p.erange) != 2 or p.erange[0] >= p.erange[1]:
+            raise Exception("erange must be of the form 'emin:emax'")
+
+    log("Accumulating pair counts and energies of each sample on the GPUs")
+    if p.saveseqs != 0:
+        log("Saving sequences every {} samples".format(p.saveseqs))
     log("")
     return p
 
@@ -826,10 +1633,14 @@ def main(args):
     actions = {
       'inverseIsing':   inverseIsing,
       'getEnergies':    getEnergies,
+      'mutscan':        mutscan,
+      'multiEnergies':  multiEnergies,
       'benchmark':      MCMCbenchmark,
+      'benchsuite':     benchmarkSuite,
       #'measureFPerror': measureFPerror,
       'subseqFreq':     subseqFreq,
-      'mcmc':            equilibrate
+      'mcmc':            equilibrate,
+      'design':          design
      }
     
     descr = 'Perform biophysical Potts Model calculations on the GPU'
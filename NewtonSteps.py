@@ -26,11 +26,16 @@ import numpy.random
 import pyopencl as cl
 import pyopencl.array as cl_array
 import sys, os, errno, glob, argparse, time
+from itertools import izip_longest
+from collections import deque
 import ConfigParser
 import seqload
+import tracing
+import distributed
 from scipy.optimize import leastsq
 from changeGauge import zeroGauge, zeroJGauge, fieldlessGaugeEven
-from mcmcGPU import readGPUbufs
+from mcmcGPU import (readGPUbufs, releaseGPUbufs, reportPerf, divideWalkers,
+                     redistributeWalkers, timeMCMCConcurrent)
 
 ################################################################################
 # Set up enviroment and some helper functions
@@ -82,6 +87,13 @@ def sumarr(arrlist):
 def meanarr(arrlist):
     return sumarr(arrlist)/len(arrlist)
 
+def combineMarg(bimargs, weights):
+    # weighted mean of the marginals of the gpus of all processes, and the
+    # total weight. Only the weighted sum and total weight are communicated.
+    tot = sumarr([w*b for w,b in zip(weights, bimargs)])
+    tot, wsum = distributed.comm.reduceSum([tot, float(sum(weights))])
+    return tot/wsum, wsum
+
 ################################################################################
 #local optimization related code
 
@@ -89,26 +101,28 @@ def newtonStep(n, bimarg_target, gamma, pc, jclamp, gpus, log):
     # expects the back buffers to contain current couplings & bimarg,
     # will overwrite front buffers
 
-    # calculate perturbed marginals
-    for gpu in gpus:
-        # note: updateJPerturb should give same result on all GPUs
-        # overwrites J front using bi back and J back
-        gpu.updateJPerturb(gamma, pc, jclamp) 
+    with tracing.phase('newtonStep', n=n):
+        # calculate perturbed marginals
+        for gpu in gpus:
+            # note: updateJPerturb should give same result on all GPUs
+            # overwrites J front using bi back and J back
+            gpu.updateJPerturb(gamma, pc, jclamp) 
 
-    for gpu in gpus:
-        gpu.swapBuf('J') #temporarily put trial J in back buffer
-        gpu.perturbMarg() #overwrites bi front using J back
-        gpu.swapBuf('J')
-    # at this point, front = trial param, back = last accepted param
+        for gpu in gpus:
+            gpu.swapBuf('J') #temporarily put trial J in back buffer
+            gpu.perturbMarg() #overwrites bi front using J back
+            gpu.swapBuf('J')
+        # at this point, front = trial param, back = last accepted param
     
-    #read out result and update bimarg
-    res = readGPUbufs(['bi front', 'neff', 'weights'], gpus)
+        #read out result and update bimarg
+        res = readGPUbufs(['bi front', 'neff', 'weights'], gpus)
     bimargb, Neffs, weightb = res
-    Neff = sum(Neffs)
-    bimarg_model = sumarr([N*buf for N,buf in zip(Neffs, bimargb)])/Neff
+    bimarg_model, Neff = combineMarg(bimargb, Neffs)
     weights = concatenate(weightb)
+    releaseGPUbufs(res, gpus)
     SSR = sum((bimarg_model.flatten() - bimarg_target.flatten())**2)
-    trialJ = gpus[0].getBuf('J front').read()
+    trialJbuf = gpus[0].getBuf('J front')
+    trialJ = trialJbuf.read()
     
     #display result
     log("")
@@ -117,8 +131,9 @@ def newtonStep(n, bimarg_target, gamma, pc, jclamp, gpus, log):
     log("    trialJ:", printsome(trialJ))
     log("    bimarg:", printsome(bimarg_model))
     log("   weights:", printsome(weights))
+    trialJbuf.release()
 
-    if isinf(Neff) or Neff == 0:
+    if not isfinite(Neff) or Neff == 0:
         raise Exception("Error: Divergence. Decrease gamma or increase "
                         "pc-damping")
     
@@ -137,8 +152,13 @@ def iterNewton(param, gpus, log):
 
     # setup front and back buffers. Back buffers should contain last accepted
     # values, front buffers vonctain trial values.
+    if param.dedup:
+        for gpu in gpus:
+            nunique = gpu.dedupSeqs()
+            log("GPU {}: {} distinct of {} sequences".format(gpu.gpunum, 
+                nunique, gpu.nseq['large']))
     for gpu in gpus:
-        gpu.calcEnergies('large', 'main')
+        gpu.calcEnergies(gpu.weightSeqbuf, 'main')
         gpu.copyBuf('J main', 'J back')
         gpu.copyBuf('J main', 'J front')
         gpu.copyBuf('bi main', 'bi back')
@@ -182,9 +202,11 @@ def iterNewton(param, gpus, log):
                 log("gamma decreased too much relative to gamma0. Stopping")
                 break
 
-    # return back buffer, which contains last accepted move
-    return (gpus[0].getBuf('J back').read(), 
-            gpus[0].getBuf('bi back').read())
+    # return back buffer, which contains last accepted move. In a distributed
+    # inference all processes continue from the coordinator's result, in case
+    # their devices' rounding differs.
+    return distributed.comm.bcast((gpus[0].getBuf('J back').read(), 
+                                   gpus[0].getBuf('bi back').read()))
     
 ################################################################################
 
@@ -201,16 +223,19 @@ def preOpt(param, gpus, log):
         gpu.calcEnergies('large', 'main')
         gpu.calcBimarg('large')
     res = readGPUbufs(['bi main', 'bicount', 'seq large'], gpus)
-    bimarg, bicount, seqs = meanarr(res[0]), sumarr(res[1]), res[2]
+    bimarg = combineMarg(res[0], [gpu.nseq['large'] for gpu in gpus])[0]
+    bicount = distributed.comm.reduceSum([sumarr(res[1])])[0]
+    seqs = res[2]
     
     #store initial setup
     mkdir_p(os.path.join(outdir, 'preopt'))
     log("Unweighted Marginals: ", printsome(bimarg))
-    save(os.path.join(outdir, 'preopt', 'initbimarg'), bimarg)
-    save(os.path.join(outdir, 'preopt', 'initBicont'), bicount)
-    for n,s in enumerate(seqs):
-        seqload.writeSeqs(os.path.join(outdir, 'preopt', 'seqs-'+str(n)), 
-                          s, alpha)
+    with tracing.phase('output', run='preopt'):
+        save(os.path.join(outdir, 'preopt', 'initbimarg'), bimarg)
+        save(os.path.join(outdir, 'preopt', 'initBicont'), bicount)
+        for n,s in enumerate(seqs):
+            seqload.writeSeqs(os.path.join(outdir, 'preopt', 'seqs-'+str(n)),
+                              s, alpha)
 
     ferr = mean((abs(bimarg_target - bimarg)/bimarg_target)[bimarg_target > 0.01])
     ssr = sum((bimarg_target - bimarg)**2)
@@ -218,62 +243,554 @@ def preOpt(param, gpus, log):
     log("S Ferr: {: 9.7f}  SSR: {: 9.5f}  wDf: {: 9.5f}".format(ferr,ssr,wdf))
 
     #modify couplings a little
-    couplings, bimarg_p = iterNewton(param, gpus, log)
+    with tracing.phase('newton', run='preopt'):
+        couplings, bimarg_p = iterNewton(param, gpus, log)
     save(os.path.join(outdir, 'preopt', 'perturbedbimarg'), bimarg_p)
     save(os.path.join(outdir, 'preopt', 'perturbedJ'), couplings)
+    reportPerf(gpus, 'preopt', os.path.join(outdir, 'preopt', 'perf.json'), 
+               log)
+
+def runMCMCLoops(gpus, nloop):
+    # runs nloop*nsteps MC steps on each gpu, split into kernel launches of
+    # gpu.kernelsteps steps. Keep the launch iterator on the outside to avoid
+    # filling the queue with only 1 gpu
+    launches = [gpu.splitSteps(nloop) for gpu in gpus]
+    for steps in izip_longest(*launches):
+        for gpu, nsteps in zip(gpus, steps):
+            if nsteps is not None:
+                gpu.runMCMC(nsteps)
+
+def tuneKernelSteps(gpus, kerneltime, log):
+    # time a warmup kernel call of nsteps on each gpu, and choose the number
+    # of MC steps per launch so each launch takes about kerneltime seconds.
+    # Launches are short enough to avoid the driver watchdog, but long enough
+    # that launch overhead is small.
+    for gpu in gpus:
+        gpu.timeMCMC() #first call may include one-time setup costs
+        dt = gpu.timeMCMC()
+        gpu.setKernelSteps(gpu.nsteps*kerneltime/dt)
+        log(("GPU {}: warmup kernel call of {} MC steps took {:.4g}s. Using {} "
+             "MC steps per kernel launch for target {:.4g}s").format(
+             gpu.gpunum, gpu.nsteps, dt, gpu.kernelsteps, kerneltime))
+
+def balanceWalkers(gpus, thresh, param, log):
+    # times one MCMC kernel call on all gpus at once to measure their 
+    # throughput in walker MC steps per second. If the slowest gpu takes more
+    # than a fraction thresh longer than average to run its walkers, the 
+    # walkers are redistributed in proportion to the throughputs. This 
+    # replaces the elements of gpus. Once the gpus are balanced they are not
+    # measured again. Returns the number of loops run, which count towards
+    # equilibration.
+    if all([gpu.walkersBalanced for gpu in gpus]):
+        return 0
+    times = [t/gpu.nsteps for gpu, t in zip(gpus, timeMCMCConcurrent(gpus))]
+    nwalkers = [gpu.nseq['small'] for gpu in gpus]
+    rates = [n/t for n, t in zip(nwalkers, times)]
+    imbalance = max(times)/mean(times) - 1
+    log("Walker MC steps/s per GPU: {}  imbalance: {:.3f}".format(
+        " ".join(["{:.4g}".format(r) for r in rates]), imbalance))
+    if imbalance > thresh:
+        gpuwalkers = divideWalkers(sum(nwalkers), len(gpus), 
+                                   gpus[0].wgsize*gpus[0].ntemps, log, rates)
+        if gpuwalkers != nwalkers:
+            log("Rebalancing walkers per GPU from {} to {}".format(
+                nwalkers, gpuwalkers))
+            gpus[:] = redistributeWalkers(gpus, gpuwalkers, param, log)
+            return 1
+    for gpu in gpus:
+        gpu.walkersBalanced = True
+    return 1
 
-def runMCMC(gpus, startseq, couplings, runName, param):
+def equilibrateMCMC(gpus, couplings, runName, param, log):
     nloop = param.equiltime
-    nsamples = param.nsamples
-    nsampleloops = param.sampletime
     trackequil = param.trackequil
-    outdir = param.outdir
     # assumes small sequence buffer is already filled
 
     #get ready for MCMC
     for gpu in gpus:
         gpu.setBuf('J main', couplings)
+
+    #warmup calls to pick the kernel launch size (first round only)
+    if param.kerneltime and not all([gpu.kernelstepsTuned for gpu in gpus]):
+        with tracing.phase('warmup'):
+            tuneKernelSteps(gpus, param.kerneltime, log)
+
+    #measure the gpus' throughput, and rebalance the walkers if needed
+    if param.balance and len(gpus) > 1:
+        with tracing.phase('balance', run=runName):
+            nloop -= balanceWalkers(gpus, param.balance, param, log)
     
     #equilibration MCMC
-    if trackequil == 0:
-        #keep nloop iterator on outside to avoid filling queue with only 1 gpu
-        for i in range(nloop):
-            for gpu in gpus:
-                gpu.runMCMC()
-    else:
-        #note: sync necessary with trackequil (may slightly affect performance)
-        mkdir_p(os.path.join(outdir, runName, 'equilibration'))
+    with tracing.phase('equilibration', run=runName):
+        if gpus[0].ntemps > 1 and param.tunetemps != 0:
+            nloop -= tuneTemperatures(gpus, nloop/2, param.tunetemps, log)
+        if trackequil == 0:
+            runMCMCLoops(gpus, nloop)
+        else:
+            trackEquilibration(gpus, nloop, runName, param, log)
+    if gpus[0].ntemps > 1:
+        log("Equilibration swap rates:", swapRates(gpus))
+    if not gpus[0].gibbs:
+        log("Equilibration acceptance rate:", acceptRate(gpus))
+
+def trackEquilibration(gpus, nloop, runName, param, log):
+    # runs nloop loops, computing statistics of the walkers on the gpus after
+    # each whole interval of trackequil loops, which are appended to the file
+    # equilibration.txt of the run. Every equildump intervals (if nonzero),
+    # the full bimarg is also saved. With equilthresh, ends early once
+    # equilibrated (see EquilMonitor). Each interval's stats are read back
+    # while the next interval runs. Leftover loops after the last interval
+    # are run untracked.
+    trackequil, dump = param.trackequil, param.equildump
+    rundir = os.path.join(param.outdir, runName)
+    if dump:
+        mkdir_p(os.path.join(rundir, 'equilibration'))
+    monitor = EquilMonitor(param.equilthresh, gpus[0].nPairs*gpus[0].nB**2)
+    target = param.bimarg is not None
+
+    def processInterval(j, stats, bimargs):
+        res = [buf.read().astype(float) for buf, n in stats]
+        for buf, n in stats:
+            buf.release()
+        done = monitor.update(res, [gpu.nstore for gpu in gpus], 
+                              [n for buf, n in stats])
+        f.write("{} {:.6g} {:.6g} {:.6g} {:.8g} {:.6g} {:.6g}\n".format(
+                (j + 1)*trackequil, monitor.ssr, monitor.rmsd, monitor.drift,
+                monitor.Emean, monitor.Evar, monitor.accept))
+        f.flush()
+        if bimargs:
+            bimarg_model = sumarr([gpu.nstore*buf.read() for gpu, buf 
+                                   in zip(gpus, bimargs)])
+            bimarg_model /= sum([gpu.nstore for gpu in gpus])
+            for buf in bimargs:
+                buf.release()
+            save(os.path.join(rundir, 'equilibration', 
+                              'bimarg_{}'.format(j)), bimarg_model)
+        return done
+
+    with open(os.path.join(rundir, 'equilibration.txt'), 'wt') as f:
+        f.write("# loop SSR RMSD drift Emean Evar accept\n")
+        pending, done, j = None, False, -1
         for j in range(nloop/trackequil):
-            for i in range(trackequil):
-                for gpu in gpus:
-                    gpu.runMCMC()
+            runMCMCLoops(gpus, trackequil)
+            if pending is not None:
+                done = processInterval(*pending)
+                if done:
+                    break
             for gpu in gpus:
-                gpu.calcBimarg('small')
-            bimarg_model = meanarr(readGPUbufs(['bi main'], gpus)[0])
-            save(os.path.join(outdir, runName, 
-                 'equilibration', 'bimarg_{}'.format(j)), bimarg_model)
+                gpu.calcBimarg('small', nseq=gpu.nstore)
+            bimargs = []
+            if dump and j%dump == 0:
+                bimargs = [gpu.getBuf('bi main') for gpu in gpus]
+            stats = [gpu.equilStats(target) for gpu in gpus]
+            pending = (j, stats, bimargs)
+        if pending is not None and not done:
+            done = processInterval(*pending)
+
+    # run the loops left over after the last whole interval
+    if not done:
+        runMCMCLoops(gpus, nloop%trackequil)
+
+    if param.equilthresh:
+        log(("{} after {} loops: bimarg drift {:.3g} times sampling "
+             "noise, energy trend z = {:.2f}").format(
+             'Equilibrated' if done else 'Not equilibrated', 
+             (j + 1)*trackequil if done else nloop, 
+             monitor.drift, monitor.z))
+
+def acceptRate(gpus):
+    # fraction of Metropolis proposals which changed a residue since the
+    # last call, over all walkers of all gpus
+    res = [gpu.readAccept() for gpu in gpus]
+    accepted = sum([buf.read().sum(dtype='u8') for buf, n in res])
+    proposals = sum([n*gpu.nseq['small'] for gpu, (buf, n) in zip(gpus, res)])
+    for buf, n in res:
+        buf.release()
+    return accepted/float(max(proposals, 1))
+
+equilpatience = 3 #intervals in a row below threshold to end equilibration
+
+class EquilMonitor:
+    # Combines the stats of each tracking interval (see MCMCGPU.equilStats)
+    # over the gpus, and decides when the walkers are equilibrated. This is
+    # when the drift of the bimarg since the previous interval, relative to 
+    # the drift expected from sampling noise alone, is below thresh, and the
+    # change in mean energy is within 3 standard errors, for equilpatience 
+    # intervals in a row. SSR and RMSD relative to the target bimarg are 
+    # averaged over the gpus, weighted by their numbers of walkers.
+    def __init__(self, thresh, nbimarg):
+        self.thresh = thresh
+        self.nbimarg = nbimarg
+        self.prevE = None
+        self.prevaccept = (0, 0)
+        self.nbelow = 0
+        self.drift, self.z = nan, nan
+
+    def update(self, stats, nseqs, proposals):
+        # stats, number of walkers and MC steps per walker counted in the
+        # acceptance counts of each gpu. Returns True once equilibrated.
+        ntot = float(sum(nseqs))
+        noise = sum([2*s[1]/n for s, n in zip(stats, nseqs)])
+        Emean = sum([n*s[2] + s[3] for s, n in zip(stats, nseqs)])/ntot
+        #total variance: the variance within each gpu plus the spread of the
+        #gpus' means around Emean
+        Evar = sum([s[4] - s[3]**2/n + n*(s[2] + s[3]/n - Emean)**2 
+                    for s, n in zip(stats, nseqs)])/ntot
+        if self.prevE is not None:
+            self.drift = sum([s[0] for s in stats])/noise
+            self.z = (Emean - self.prevE)/sqrt(2*Evar/ntot)
+            below = self.drift < self.thresh and abs(self.z) < 3
+            self.nbelow = self.nbelow + 1 if below else 0
+        self.prevE = self.Emean = Emean
+        self.Evar = Evar
+        self.ssr = sum([n*s[5] for s, n in zip(stats, nseqs)])/ntot
+        self.rmsd = sqrt(self.ssr/self.nbimarg)
+
+        #acceptance rate since the previous interval. (The counts are reset
+        #by acceptRate, after which both totals start again from 0)
+        accepted = sum([s[6] for s in stats])
+        nprop = sum([n*p for n, p in zip(nseqs, proposals)])
+        if nprop < self.prevaccept[1]:
+            self.prevaccept = (0, 0)
+        dprop = nprop - self.prevaccept[1]
+        self.accept = (accepted - self.prevaccept[0])/dprop if dprop else nan
+        self.prevaccept = (accepted, nprop)
+        return self.nbelow >= equilpatience
+
+def swapRates(gpus):
+    # acceptance rates of replica exchanges between each pair of neighboring
+    # temperatures since the last call, over all gpus
+    res = [gpu.readSwaps() for gpu in gpus]
+    accepted = sumarr([buf.read().astype(float) for buf, n in res])
+    attempts = sumarr([n for buf, n in res])
+    for buf, n in res:
+        buf.release()
+    return accepted/maximum(attempts, 1)
+
+def tuneLadder(betas, rates):
+    # moves the inverse temperatures between the (fixed) first and last ones
+    # to even out the swap rates: gaps in log(beta) with low swap rates are 
+    # narrowed, and gaps with high rates widened
+    gaps = -diff(log(betas))
+    rates = rates + 0.01
+    gaps = gaps*sqrt(rates/mean(rates))
+    gaps = gaps*log(betas[0]/betas[-1])/sum(gaps)
+    return betas[0]*exp(-concatenate([[0], cumsum(gaps)]))
+
+def tuneTemperatures(gpus, nloop, ntune, log):
+    # runs about nloop loops, adjusting the temperature ladder from the
+    # measured swap rates ntune times. Returns the number of loops run.
+    # each interval is at least 2 loops so both parities of swaps are tried
+    interval = max(nloop//ntune, 2)
+    ntune = min(ntune, nloop//interval)
+    if ntune == 0:
+        return 0
+    swapRates(gpus) #reset counts
+    for n in range(ntune):
+        runMCMCLoops(gpus, interval)
+        rates = swapRates(gpus)
+        betas = tuneLadder(gpus[0].betas.astype(float), rates)
+        for gpu in gpus:
+            gpu.setTemperatures(betas)
+    log("Tuned temperature ladder, beta:", betas)
+    log("    swap rates before last adjustment:", rates)
+    return interval*ntune
 
-    #post-equilibration samples
-    for gpu in gpus:
-        gpu.storeSeqs(offset=0) #save seqs from smallbuf to largebuf
-    for j in range(1,nsamples):
-        for i in range(nsampleloops):
-            for gpu in gpus:
-                gpu.runMCMC()
+def runMCMC(gpus, startseq, couplings, runName, param, log):
+    nsamples = param.nsamples
+    nsampleloops = param.sampletime
+    equilibrateMCMC(gpus, couplings, runName, param, log)
+
+    #optionally record the walkers' energies and Hamming distances during
+    #sampling, every stride loops, to measure how well they mix
+    nloops = (nsamples - 1)*nsampleloops
+    trace = param.autocorr and nloops > 0
+    if trace:
+        stride = max(1, -(-nloops//maxtrace))
         for gpu in gpus:
-            gpu.storeSeqs(offset=j*gpu.nseq['small'])
+            gpu.initTrace(nloops//stride + 1)
+            gpu.recordTrace()
+    done = 0
+
+    #post-equilibration samples. Each block of samples is read back from the
+    #large buffer while the next block is generated.
+    seqblocks = [[] for gpu in gpus]
+    with tracing.phase('sampling', run=runName):
+        for j in range(nsamples):
+            if j != 0 and trace:
+                done = runTracedLoops(gpus, nsampleloops, stride, done)
+            elif j != 0:
+                runMCMCLoops(gpus, nsampleloops)
+            for gpu,blocks in zip(gpus, seqblocks):
+                nseq = gpu.nstore
+                gpu.storeSeqs(offset=j*nseq) #save seqs from small to large buf
+                blocks.append(gpu.getSeqBlock('large', j*nseq, nseq))
+    if gpus[0].ntemps > 1:
+        log("Sampling swap rates:", swapRates(gpus))
+    if not gpus[0].gibbs:
+        log("Sampling acceptance rate:", acceptRate(gpus))
+    if trace:
+        mixingStats(gpus, stride, param, log)
     
     #process results
-    for gpu in gpus:
-        gpu.calcBimarg('large')
-        gpu.calcEnergies('large', 'main')
-    res = readGPUbufs(['bi main', 'bicount', 'E large', 'seq large'], gpus)
-    bimarg_model, bicount = meanarr(res[0]), sumarr(res[1])
-    sampledenergies, sampledseqs = concatenate(res[2]), res[3]
+    with tracing.phase('processResults', run=runName):
+        for gpu in gpus:
+            gpu.calcBimarg('large')
+            gpu.calcEnergies('large', 'main')
+        res = readGPUbufs(['bi main', 'bicount', 'E large'], gpus)
+        bimarg_model = combineMarg(res[0], 
+                                   [gpu.nseq['large'] for gpu in gpus])[0]
+        bicount = distributed.comm.reduceSum([sumarr(res[1])])[0]
+        sampledenergies = concatenate(res[2])
+        releaseGPUbufs(res, gpus)
+        sampledseqs = [concatenate([b.read() for b in blocks]) 
+                       for blocks in seqblocks]
 
     return bimarg_model, bicount, sampledenergies, sampledseqs
 
-def MCMCstep(runName, startseq, couplings, param, gpus, log):
+maxtrace = 1024 #maximum number of trace records per sampling run
+
+def runTracedLoops(gpus, nloop, stride, done):
+    # like runMCMCLoops, but records the walkers' traces every stride loops,
+    # counting from loop number done. Returns the new loop number.
+    while nloop > 0:
+        n = min(nloop, stride - done%stride)
+        runMCMCLoops(gpus, n)
+        done, nloop = done + n, nloop - n
+        if done%stride == 0:
+            for gpu in gpus:
+                gpu.recordTrace()
+    return done
+
+def autocorrTime(x):
+    # integrated autocorrelation time, in records, of traces x (ntrace, 
+    # nchains), from the autocorrelation function averaged over the chains.
+    # The sum is cut off at the first lag >= 5 times the running estimate.
+    n = x.shape[0]
+    x = x - mean(x, axis=0)
+    f = np.fft.rfft(x, n=2*n, axis=0)
+    acf = np.fft.irfft(f*conj(f), n=2*n, axis=0)[:n].mean(axis=1)
+    if acf[0] == 0:
+        return 0.0
+    taus = 2*cumsum(acf/acf[0]) - 1
+    window = nonzero(arange(n) >= 5*taus)[0]
+    return taus[window[0]] if len(window) != 0 else taus[-1]
+
+def rhat(x):
+    # Gelman-Rubin potential scale reduction of traces x (ntrace, nchains). 
+    # Close to 1 when the chains have mixed.
+    n = x.shape[0]
+    W = mean(var(x, axis=0, ddof=1))
+    B = n*var(mean(x, axis=0), ddof=1)
+    return sqrt(((n - 1.0)/n*W + B/n)/W)
+
+def decorrelationTime(h):
+    # records until the mean Hamming distance from the reference seqs first
+    # reaches 1-1/e of its final value (the mean over the last half)
+    hmean = mean(h, axis=1)
+    plateau = mean(hmean[len(hmean)//2:])
+    return argmax(hmean >= (1 - exp(-1))*plateau)
+
+def mixingStats(gpus, stride, param, log):
+    # logs autocorrelation times (in MCMC loops) and R-hat from the recorded
+    # traces, and adapts the sampletime for the next round if requested
+    res = readGPUbufs(['E trace', 'H trace'], gpus)
+    ntrace = gpus[0].ntrace
+    E = concatenate([e[:ntrace] for e in res[0]], axis=1).astype(float)
+    H = concatenate([h[:ntrace] for h in res[1]], axis=1).astype(float)
+    releaseGPUbufs(res, gpus)
+
+    tauE = stride*autocorrTime(E)
+    tauH = stride*decorrelationTime(H)
+    log(("Energy autocorrelation time {:.1f} loops, R-hat {:.3f}. Hamming "
+         "decorrelation time {} loops, mean distance {:.1f}").format(tauE, 
+         rhat(E), tauH, mean(H[ntrace//2:])))
+    if (ntrace - 1)*stride < 50*tauE:
+        log("Warning: sampling ran for less than 50 autocorrelation times, "
+            "so the estimates are unreliable")
+    if param.adaptsample:
+        sampletime = max(1, int(ceil(param.adaptsample*max(tauE, tauH))))
+        log("Adapting sampletime from {} to {} loops".format(
+            param.sampletime, sampletime))
+        param['sampletime'] = sampletime
+
+def generateSamples(gpus, couplings, runName, param, log, depth=2):
+    # generator which equilibrates the walkers, and then yields a batch 
+    # (seqs, energies) of the walkers of all gpus at each of the 
+    # param.nsamples sample points. The walkers keep running while the
+    # consumer processes earlier batches, up to depth sample points ahead,
+    # after which the generator waits for the consumer to ask for more.
+    nsamples = param.nsamples
+    nsampleloops = param.sampletime
+    equilibrateMCMC(gpus, couplings, runName, param, log)
+
+    def readBatch(bufs):
+        seqs = concatenate([s.read() for s, e in bufs])
+        energies = concatenate([e.read() for s, e in bufs])
+        for s, e in bufs:
+            e.release()
+        return seqs, energies
+
+    pending = deque()
+    for j in range(nsamples):
+        with tracing.phase('sampling', run=runName, sample=j):
+            if j != 0:
+                runMCMCLoops(gpus, nsampleloops)
+            for gpu in gpus:
+                gpu.calcEnergies('small', 'main')
+            #(the next MCMC kernels wait for these readbacks, not the consumer)
+            pending.append([(gpu.getBuf('seq small'), gpu.getBuf('E small'))
+                            for gpu in gpus])
+        if len(pending) > depth:
+            yield readBatch(pending.popleft())
+    while pending:
+        yield readBatch(pending.popleft())
+
+class SampleAccumulator:
+    # host side totals of the gpus' sample accumulators (see accumSample). The
+    # gpus' uint32 counts are folded into these and reset before overflowing.
+    def __init__(self, nB, nPairs, nbins):
+        self.nseq = 0
+        self.bicount = zeros((nPairs, nB*nB), dtype='i8')
+        self.Ehist = zeros(nbins+2, dtype='i8')
+        self.Emoments = zeros(2) # sums of (E - eref) and (E - eref)**2
+
+    def fold(self, gpus):
+        res = readGPUbufs(['bicount', 'E hist', 'E moments'], gpus)
+        for gpu, bicount, Ehist, Emom in zip(gpus, *res):
+            self.nseq += gpu.naccum
+            self.bicount += bicount
+            self.Ehist += Ehist
+            self.Emoments += [float64(Emom[0]) - Emom[1], 
+                              float64(Emom[2]) - Emom[3]]
+        releaseGPUbufs(res, gpus)
+        for gpu in gpus:
+            gpu.resetAccum()
+
+def sampleAccumulate(gpus, couplings, runName, param, log):
+    # like runMCMC, but instead of storing the samples in the large buffer,
+    # adds their pair counts and energies to accumulators on the gpus at each
+    # sample point, so memory use does not depend on nsamples. Every 
+    # param.saveseqs samples (if nonzero) the walkers' seqs are appended to
+    # a file seqs-n for each gpu. 
+    nsamples = param.nsamples
+    nsampleloops = param.sampletime
+    nbins = param.ehistbins
+    outdir = param.outdir
+    alpha = param.alpha
+    equilibrateMCMC(gpus, couplings, runName, param, log)
+
+    #the first sample sets the energy reference and histogram range
+    for gpu in gpus:
+        gpu.calcEnergies('small', 'main')
+    res = readGPUbufs(['E small'], gpus)
+    energies = concatenate(res[0])
+    releaseGPUbufs(res, gpus)
+    eref = mean(energies)
+    if param.erange is not None:
+        emin, emax = param.erange
+    else:
+        emin, emax = min(energies), max(energies)
+        emin, emax = emin - (emax - emin)/2, emax + (emax - emin)/2
+    log("Energy histogram: {} bins from {} to {}".format(nbins, emin, emax))
+    for gpu in gpus:
+        gpu.initAccum(eref, emin, emax, nbins)
+    acc = SampleAccumulator(param.nB, gpus[0].nPairs, nbins)
+
+    seqfiles = []
+    if param.saveseqs:
+        seqfiles = [open(os.path.join(outdir, runName, 'seqs-{}'.format(n)),
+                         'wt') for n in range(len(gpus))]
+        for f in seqfiles:
+            seqload.writeSeqsF(f, zeros((0, param.L), dtype='<u1'), alpha)
+
+    with tracing.phase('sampling', run=runName):
+        for j in range(nsamples):
+            if j != 0:
+                runMCMCLoops(gpus, nsampleloops)
+            if any([g.naccum + g.nseq['small'] >= 2**32 for g in gpus]):
+                acc.fold(gpus)
+            for gpu in gpus:
+                gpu.accumSample()
+            if seqfiles and j % param.saveseqs == 0:
+                res = readGPUbufs(['seq small'], gpus)[0]
+                for f, seqs in zip(seqfiles, res):
+                    seqload.writeSeqsF(f, seqs, alpha, noheader=True)
+    for f in seqfiles:
+        f.close()
+
+    with tracing.phase('processResults', run=runName):
+        acc.fold(gpus)
+    N = float(acc.nseq)
+    bimarg_model = (acc.bicount/N).astype('<f4')
+    Emean = eref + acc.Emoments[0]/N
+    Evar = acc.Emoments[1]/N - (acc.Emoments[0]/N)**2
+    edges = linspace(emin, emax, nbins+1)
+    return (bimarg_model, acc.bicount, acc.nseq, (Emean, Evar), 
+            (acc.Ehist, edges))
+
+def topDistinct(seqs, energies, k):
+    # the (up to) k lowest energy distinct seqs, sorted by energy
+    order = argsort(energies, kind='mergesort')
+    seqs, energies = ascontiguousarray(seqs[order]), energies[order]
+    rows = seqs.view(dtype((np.void, seqs.shape[1]))).ravel()
+    first = sort(np.unique(rows, return_index=True)[1])[:k]
+    return seqs[first], energies[first]
+
+def annealSeqs(gpus, startseqs, schedule, topk):
+    # simulated annealing: every walker is an independent anneal, starting
+    # from its seq in startseqs[n] for gpu n, and running one MCMC loop at 
+    # each inverse temperature of schedule. Returns the topk lowest energy 
+    # distinct seqs visited by any walker, at the end of each loop.
+    for gpu, seqs in zip(gpus, startseqs):
+        gpu.setBuf('seq small', seqs)
+        gpu.resetBest()
+    with tracing.phase('anneal'):
+        for beta in schedule:
+            for gpu in gpus:
+                gpu.setBeta(beta)
+                gpu.runMCMC()
+                gpu.trackBest()
+    res = readGPUbufs(['seq best', 'E best'], gpus)
+    seqs, energies = concatenate(res[0]), concatenate(res[1])
+    releaseGPUbufs(res, gpus)
+    return topDistinct(seqs, energies, topk)
+
+def warmStart(mode, startseq, gpus, rundir, log):
+    # sets the walkers' start seqs for a round, and records how in the file
+    # 'warmstart' of the run directory. Modes are 'reset' (all walkers start
+    # at startseq), 'continue' (each walker continues from its final state,
+    # which is the last sample of the previous round) and 'reseed' (each
+    # walker starts from a random sample of the previous round, chosen with
+    # a recorded random seed). In the first round, 'preloaded' means the
+    # walkers were already set from supplied seqs.
+    with open(os.path.join(rundir, 'warmstart'), 'wt') as f:
+        f.write("mode {}\n".format(mode))
+        if mode == 'reset':
+            for gpu in gpus:
+                gpu.fillSeqs(startseq)
+            f.write("startseq file startseq\n")
+        elif mode == 'preloaded':
+            f.write("walkers start from the supplied seqs\n")
+        elif mode == 'continue':
+            f.write("walkers continue from the last sample of the previous "
+                    "round\n")
+        elif mode == 'reseed':
+            seed = numpy.random.randint(2**31)
+            rng = numpy.random.RandomState(seed)
+            for gpu in gpus:
+                gpu.reseedSeqs(rng.randint(0, gpu.nseq['large'], 
+                                           size=gpu.nseq['small']))
+            f.write("seed {}\n".format(seed))
+            f.write(("walker n of gpu g starts from sample index[n] of gpu "
+                     "g in the previous round, where index is drawn in gpu "
+                     "order as RandomState(seed).randint(0, nlarge, "
+                     "size=nwalkers)\n"))
+        else:
+            raise Exception("unknown warm start mode {}".format(mode))
+    log("Walker start: {}".format(mode))
+
+def MCMCstep(runName, startseq, couplings, param, gpus, log, warm=False):
     outdir = param.outdir
     alpha, L, nB = param.alpha, param.L, param.nB
     bimarg_target = param.bimarg
@@ -292,31 +809,37 @@ def MCMCstep(runName, startseq, couplings, param, gpus, log):
     with open(os.path.join(outdir, runName, 'startseq'), 'wt') as f:
         f.write("".join(alpha[c] for c in startseq))
     
-    if param.resetseqs:
-        for gpu in gpus:
-            gpu.fillSeqs(startseq)
+    #the first round starts at startseq, unless the walkers were preloaded
+    if warm:
+        warmStart(param.warmstart, startseq, gpus, 
+                  os.path.join(outdir, runName), log)
+    else:
+        warmStart('reset' if param.resetseqs else 'preloaded', startseq, gpus,
+                  os.path.join(outdir, runName), log)
 
     (bimarg_model, 
      bicount, 
      sampledenergies, 
-     sampledseqs) = runMCMC(gpus, startseq, couplings, runName, param)
+     sampledseqs) = runMCMC(gpus, startseq, couplings, runName, param, log)
 
     #get summary statistics and output them
     ferr = mean((abs(bimarg_target - bimarg_model)/bimarg_target)[bimarg_target > 0.01])
     ssr = sum((bimarg_target - bimarg_model)**2)
     wdf = sum(bimarg_target*abs(bimarg_target - bimarg_model))
-    writeStatus(runName, ferr, ssr, wdf, bicount, bimarg_model, 
-                couplings, sampledseqs, startseq, sampledenergies, 
-                alpha, outdir, log)
+    with tracing.phase('output', run=runName):
+        writeStatus(runName, ferr, ssr, wdf, bicount, bimarg_model, 
+                    couplings, sampledseqs, startseq, sampledenergies, 
+                    alpha, outdir, log)
     
     #compute new J using local newton updates (in-place on GPU)
-    couplings, bimarg_p = iterNewton(param, gpus, log)
+    with tracing.phase('newton', run=runName):
+        couplings, bimarg_p = iterNewton(param, gpus, log)
     save(os.path.join(outdir, runName, 'predictedBimarg'), bimarg_p)
+    reportPerf(gpus, runName, os.path.join(outdir, runName, 'perf.json'), log)
 
     #choose seed sequence for next round
     rseq_ind = numpy.random.randint(0, len(sampledenergies))
-    nseq = gpus[0].nseq['large'] #assumes all gpus the same
-    rseq = sampledseqs[rseq_ind/nseq][rseq_ind%nseq]
+    rseq = concatenate(sampledseqs)[rseq_ind]
 
     return rseq, couplings
 
@@ -324,6 +847,16 @@ def newtonMCMC(param, gpus, log):
     startseq = param.startseq
     couplings = param.couplings
 
+    # all processes of a distributed inference must run the same inference,
+    # from the coordinator's couplings
+    if distributed.comm.size > 1:
+        settings = (param.L, param.nB, param.mcmcsteps, param.newtonSteps,
+                    param.gamma0, param.pcdamping, param.jclamp, param.preopt)
+        if any([s != settings for s in distributed.comm.allgather(settings)]):
+            raise Exception("Error: the processes of a distributed inference "
+                            "must use the same inference parameters")
+        couplings = distributed.comm.bcast(couplings)
+
     if startseq is None:
         raise Exception("Error: Potts inference requires a starting sequence")
     
@@ -345,4 +878,6 @@ def newtonMCMC(param, gpus, log):
     for i in range(param.mcmcsteps):
         runname = 'run_{}'.format(i)
         startseq, couplings = MCMCstep(runname, startseq, couplings, 
-                                       param, gpus, log)
+                                       param, gpus, log, warm=(i != 0))
+
+    reportPerf(gpus, None, os.path.join(param.outdir, 'perf.json'), log)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python2
+#
+#Copyright 2016 Allan Haldane.
+
+#This file is part of IvoGPU.
+
+#IvoGPU is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, version 3 of the License.
+
+#IvoGPU is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with IvoGPU.  If not, see <http://www.gnu.org/licenses/>.
+
+#Contact: allan.haldane _AT_ gmail.com
+from __future__ import print_function
+from scipy import *
+import numpy as np
+import os, time, json
+import seqload
+from changeGauge import zeroGauge, zeroJGauge, fieldlessGaugeEven
+from pseudocount import pseudocount
+
+################################################################################
+
+#Benchmark suite for the hot paths of the program, run on a synthetic Potts
+#model. Each case is timed over several repetitions after one warmup call,
+#waiting for the gpus after each repetition, so that times are wall times of
+#complete operations. Results are saved as JSON, and may be compared against
+#a previously saved result (the baseline) to detect performance regressions.
+
+#Cases are compared by their fastest repetition, which is less sensitive to
+#noise from other processes than the mean.
+
+def syntheticModel(L, nB, nseq, seed=0):
+    # random couplings, sequences and (normalized) bivariate marginals
+    rng = np.random.RandomState(seed)
+    nPairs = L*(L-1)/2
+    couplings = rng.normal(0, 0.5, size=(nPairs, nB*nB)).astype('<f4')
+    seqs = rng.randint(0, nB, size=(nseq, L)).astype('<u1')
+    bimarg = rng.uniform(0.1, 1, size=(nPairs, nB*nB))
+    bimarg = (bimarg/sum(bimarg, axis=1)[:,newaxis]).astype('<f4')
+    return couplings, seqs, bimarg
+
+def timeCase(func, nrep, gpus=()):
+    # returns wall time of each of nrep calls of func, after a warmup call
+    def run():
+        start = time.time()
+        func()
+        for gpu in gpus:
+            gpu.wait()
+        return time.time() - start
+    run()
+    return [run() for n in range(nrep)]
+
+def summarizeCase(times, nitems, unit):
+    times = array(times)
+    return {'nrep': len(times),
+            'mean': float(mean(times)),
+            'min': float(np.min(times)),
+            'median': float(median(times)),
+            'rate': nitems/float(np.min(times)),
+            'unit': unit}
+
+def gpuCases(mcmcgpus, gibbsgpus, nloop, spillgpus=None):
+    # list of (name, func, gpus, nitems, unit) for the gpu kernels. Assumes
+    # the gpu buffers are filled in (see IvoGPU.benchmarkSuite).
+    # spillgpus, if given, keep their large buffer in host memory (see 
+    # MCMCGPU spill), and are used to time storing samples to it and 
+    # streaming them back through the processing kernels.
+    def mcmc(gpus):
+        def func():
+            for n in range(nloop):
+                for gpu in gpus:
+                    gpu.runMCMC()
+        return func
+
+    def spill():
+        for gpu in spillgpus:
+            for offset in range(0, gpu.nseq['large'], gpu.nstore):
+                gpu.storeSeqs(offset=offset)
+            gpu.calcBimarg('large')
+            gpu.calcEnergies('large', 'main')
+            gpu.perturbMarg()
+
+    def packJ():
+        for gpu in mcmcgpus:
+            gpu.packedJ = None #force a repack
+            gpu.packJ('main')
+
+    nwalkers = sum([gpu.nseq['small'] for gpu in mcmcgpus])
+    nlarge = sum([gpu.nseq['large'] for gpu in mcmcgpus])
+    L = mcmcgpus[0].L
+    nPairs = mcmcgpus[0].nPairs
+    nsteps = mcmcgpus[0].nsteps
+    each = lambda f: (lambda: [f(gpu) for gpu in mcmcgpus])
+
+    cases = [('metropolis', mcmc(mcmcgpus), mcmcgpus,
+              nwalkers*nsteps*nloop, 'MC steps/s')]
+    if gibbsgpus is not None:
+        cases.append(('gibbs', mcmc(gibbsgpus), gibbsgpus,
+                      nwalkers*nsteps*nloop, 'MC steps/s'))
+    cases += [
+        ('getEnergies', each(lambda g: g.calcEnergies('large', 'main')),
+         mcmcgpus, nlarge, 'seqs/s'),
+        ('countBimarg', each(lambda g: g.calcBimarg('large')),
+         mcmcgpus, nlarge, 'seqs/s'),
+        ('perturbedWeights+weightedMarg', each(lambda g: g.perturbMarg()),
+         mcmcgpus, nlarge, 'seqs/s'),
+        ('packfV', packJ, mcmcgpus, len(mcmcgpus)*nPairs, 'pairs/s')]
+    if spillgpus is not None:
+        cases.append(('spill', spill, spillgpus, 
+                      sum([gpu.nseq['large'] for gpu in spillgpus]), 'seqs/s'))
+    return cases
+
+def hostCases(couplings, seqs, bimarg, alpha, outdir):
+    # list of (name, func, gpus, nitems, unit) for the cpu-side code
+    L, nB = seqs.shape[1], len(alpha)
+    seqfile = os.path.join(outdir, 'benchseqs')
+    seqload.writeSeqs(seqfile, seqs, alpha)
+    h = zeros((L, nB))
+
+    return [
+        ('writeSeqs', lambda: seqload.writeSeqs(seqfile, seqs, alpha),
+         (), len(seqs), 'seqs/s'),
+        ('loadSeqs', lambda: seqload.loadSeqs(seqfile, alpha),
+         (), len(seqs), 'seqs/s'),
+        ('zeroGauge', lambda: zeroGauge(h, couplings),
+         (), 1, 'models/s'),
+        ('zeroJGauge', lambda: zeroJGauge(h, couplings),
+         (), 1, 'models/s'),
+        ('fieldlessGaugeEven', lambda: fieldlessGaugeEven(h, couplings),
+         (), 1, 'models/s'),
+        ('pseudocount prior', lambda: pseudocount(bimarg, 0.01, 'prior'),
+         (), 1, 'models/s'),
+        ('pseudocount constant', lambda: pseudocount(bimarg, 0.01, 'constant'),
+         (), 1, 'models/s')]
+
+def runCases(cases, nrep, only, log):
+    results = {}
+    for name, func, gpus, nitems, unit in cases:
+        if only is not None and name not in only:
+            continue
+        results[name] = summarizeCase(timeCase(func, nrep, gpus),
+                                      nitems, unit)
+        log("{:<32} {:>11.5f}s {:>12.4g} {}".format(name,
+            results[name]['min'], results[name]['rate'], unit))
+    return results
+
+def compareBaseline(results, baseline, tolerance, log):
+    # returns list of cases which are slower than the baseline by more than
+    # the fractional tolerance
+    if baseline['params'] != results['params']:
+        log("Warning: baseline was run with different parameters:")
+        log("    baseline: {}".format(baseline['params']))
+        log("    current:  {}".format(results['params']))
+
+    log("{:<32} {:>12} {:>12} {:>8}".format('case', 'baseline(s)',
+                                            'current(s)', 'ratio'))
+    regressions = []
+    for name, res in sorted(results['cases'].items()):
+        if name not in baseline['cases']:
+            log("{:<32} {:>12} {:>12.5f}".format(name, '-', res['min']))
+            continue
+        base = baseline['cases'][name]['min']
+        ratio = res['min']/base
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        log("{:<32} {:>12.5f} {:>12.5f} {:>8.3f}{}".format(name, base,
+            res['min'], ratio, flag))
+    return regressions
+
+def saveResults(fn, results):
+    with open(fn, 'wt') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+def loadResults(fn):
+    with open(fn) as f:
+        return json.load(f)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+#
+#Copyright 2016 Allan Haldane.
+
+#This file is part of IvoGPU.
+
+#IvoGPU is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, version 3 of the License.
+
+#IvoGPU is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with IvoGPU.  If not, see <http://www.gnu.org/licenses/>.
+
+#Contact: allan.haldane _AT_ gmail.com
+from __future__ import print_function
+import socket, struct, time
+import cPickle as pickle
+
+################################################################################
+
+#Communication between the processes of a distributed inference, in which
+#several processes (eg on different nodes), each with their own GPUs and
+#walkers, run one Newton-MCMC inference together. One process is the
+#coordinator (rank 0), and the others are workers which connect to it over
+#TCP. All processes run the same inference, and only exchange small arrays
+#at a few points: the weighted sums of their bimargs and their Neff, and the
+#couplings at the end of each round, so traffic is O(nPairs*nB^2) per step.
+
+#Each collective operation must be called by all processes in the same
+#order. The coordinator combines the contributions in rank order, so all
+#processes get bitwise identical results and take the same decisions.
+
+#By default the module-level 'comm' is a NullComm for a single process, whose
+#operations just return their input. Code should always access it as
+#'distributed.comm' since listen() and connect() replace it.
+
+def sendmsg(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('<Q', len(data)) + data)
+
+def recvall(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1<<20))
+        if not chunk:
+            raise Exception("distributed: connection closed by peer")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+def recvmsg(sock):
+    n = struct.unpack('<Q', recvall(sock, 8))[0]
+    return pickle.loads(recvall(sock, n))
+
+class NullComm:
+    rank = 0
+    size = 1
+
+    def reduceSum(self, vals):
+        return list(vals)
+    def bcast(self, obj):
+        return obj
+    def allgather(self, obj):
+        return [obj]
+
+class Coordinator:
+    def __init__(self, port, nworkers, log):
+        self.rank = 0
+        self.size = nworkers + 1
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('', port))
+        server.listen(nworkers)
+        log("Waiting for {} workers on port {}".format(nworkers, port))
+        self.workers = []
+        for n in range(nworkers):
+            conn, addr = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.workers.append(conn)
+            log("Worker {} connected from {}:{}".format(n + 1, *addr))
+        server.close()
+        for rank, conn in enumerate(self.workers):
+            sendmsg(conn, (rank + 1, self.size))
+
+    def reduceSum(self, vals):
+        # elementwise sums of the lists vals (of arrays or numbers) of all
+        # processes
+        tot = list(vals)
+        for conn in self.workers:
+            for i, v in enumerate(recvmsg(conn)):
+                tot[i] = tot[i] + v
+        for conn in self.workers:
+            sendmsg(conn, tot)
+        return tot
+
+    def bcast(self, obj):
+        # the coordinator's obj, on all processes
+        for conn in self.workers:
+            sendmsg(conn, obj)
+        return obj
+
+    def allgather(self, obj):
+        # list of the objs of all processes, in rank order
+        objs = [obj] + [recvmsg(conn) for conn in self.workers]
+        for conn in self.workers:
+            sendmsg(conn, objs)
+        return objs
+
+class Worker:
+    def __init__(self, host, port, log, timeout=60):
+        # the coordinator may not be listening yet, so retry for a while
+        log("Connecting to coordinator at {}:{}".format(host, port))
+        start = time.time()
+        while True:
+            try:
+                self.sock = socket.create_connection((host, port))
+                break
+            except socket.error:
+                if time.time() - start > timeout:
+                    raise Exception("distributed: could not connect to "
+                                    "coordinator at {}:{}".format(host, port))
+                time.sleep(0.5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rank, self.size = recvmsg(self.sock)
+        log("Connected as worker {} of {}".format(self.rank, self.size - 1))
+
+    def reduceSum(self, vals):
+        sendmsg(self.sock, list(vals))
+        return recvmsg(self.sock)
+
+    def bcast(self, obj):
+        return recvmsg(self.sock)
+
+    def allgather(self, obj):
+        sendmsg(self.sock, obj)
+        return recvmsg(self.sock)
+
+################################################################################
+
+comm = NullComm()
+
+def listen(port, nworkers, log):
+    # become the coordinator, waiting for nworkers workers to connect
+    global comm
+    comm = Coordinator(port, nworkers, log)
+    return comm
+
+def connect(address, log):
+    # become a worker of the coordinator at address 'host:port'
+    global comm
+    host, port = address.rsplit(':', 1)
+    comm = Worker(host, int(port), log)
+    return comm
@@ -124,6 +124,87 @@ void copySubseq(__global uint *smallbuf,
 }
  
 
+// For each subsequence in the small buffer, computes the log of the sum over
+// the background sequences in the large buffer of exp(-dE), where dE is the
+// energy change caused by placing the subsequence at the fixed positions of
+// the background sequence. Only couplings involving fixed positions are
+// evaluated. Call with one work group per subsequence, for nsubseq groups
+// starting at subsequence seqoffset. J must be packed.
+__kernel
+void subseqFreq(__global float *J,
+                __global uint *smallbuf,
+                         uint  nsmallbuf,
+                __global uint *largebuf,
+                         uint  nlargebuf,
+               __constant uchar *fixedpos,
+                         uint  seqoffset,
+                __global float *logf,
+                __local  float *lmax,
+                __local  float *lsum){
+    uint li = get_local_id(0);
+    uint lsize = get_local_size(0);
+    uint seqnum = seqoffset + get_group_id(0);
+    uint n, i, m;
+
+    // running logsumexp over this work item's background seqs, as
+    // max*exp(sum)
+    float maxval = -INFINITY, sum = 0;
+    for(n = li; n < nlargebuf; n += lsize){
+        float dE = 0;
+        for(i = 0; i < L; i++){
+            if(!fixedpos[i]){
+                continue;
+            }
+            uint sbs = smallbuf[(i/4)*nsmallbuf + seqnum];
+            uint sbl = largebuf[(i/4)*nlargebuf + n];
+            uchar si = getbyte(&sbs, i%4);
+            uchar bi = getbyte(&sbl, i%4);
+            for(m = 0; m < L; m++){
+                // pairs of fixed positions are counted once, from the first
+                if(m == i || (fixedpos[m] && m < i)){
+                    continue;
+                }
+                sbl = largebuf[(m/4)*nlargebuf + n];
+                uchar bm = getbyte(&sbl, m%4);
+                uchar sm = bm;
+                if(fixedpos[m]){
+                    sbs = smallbuf[(m/4)*nsmallbuf + seqnum];
+                    sm = getbyte(&sbs, m%4);
+                }
+                dE += J[(i*L + m)*nB*nB + nB*si + sm] - 
+                      J[(i*L + m)*nB*nB + nB*bi + bm];
+            }
+        }
+        float x = -dE;
+        if(x > maxval){
+            sum = sum*exp(maxval - x) + 1;
+            maxval = x;
+        }
+        else{
+            sum += exp(x - maxval);
+        }
+    }
+    lmax[li] = maxval;
+    lsum[li] = sum;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    //reduce
+    for(n = lsize/2; n > 0; n >>= 1){
+        if(li < n){
+            float m1 = lmax[li], m2 = lmax[li + n];
+            float mx = max(m1, m2);
+            if(mx != -INFINITY){
+                lsum[li] = lsum[li]*exp(m1 - mx) + lsum[li + n]*exp(m2 - mx);
+                lmax[li] = mx;
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if(li == 0){
+        logf[seqnum] = lmax[0] + log(lsum[0]);
+    }
+}
+
 //only call from kernels with nseqs work units!!!!!!
 inline float getEnergiesf(__global float *J,
                           __global uint *seqmem,
@@ -138,6 +219,22 @@ inline float getEnergiesf(__global float *J,
     //    }
     //}
 
+#ifdef CPU_KERNELS
+    // CPU variant: reads the couplings directly (they are cached), since 
+    // local memory staging and barriers are pure overhead on CPUs, and 
+    // prevent the compiler from vectorizing over the work items
+    uint n, m;
+    float energy = 0;
+    for(n = 0; n < L-1; n++){
+        uint sbn = seqmem[(n/4)*get_global_size(0) + get_global_id(0)]; 
+        __global float *Jn = &J[n*L*nB*nB + nB*getbyte(&sbn, n%4)];
+        for(m = n+1; m < L; m++){
+            uint sbm = seqmem[(m/4)*get_global_size(0) + get_global_id(0)]; 
+            energy = energy + Jn[m*nB*nB + getbyte(&sbm, m%4)];
+        }
+    }
+    return energy;
+#else
     uint li = get_local_id(0);
 
     uchar seqm, seqn, seqp;
@@ -171,6 +268,7 @@ inline float getEnergiesf(__global float *J,
         }
     }
     return energy;
+#endif
 }
 
 __kernel //__attribute__((work_group_size_hint(WGSIZE, 1, 1)))
@@ -181,6 +279,42 @@ void getEnergies(__global float *J,
     energies[get_global_id(0)] = getEnergiesf(J, seqmem, lcouplings);
 }
 
+// energy change of every single point mutant of each sequence. The change
+// for residue a at position i of seq n is stored in dE[(i*nB + a)*nseqs + n].
+// Call with nseqs work units. J must be packed.
+__kernel
+void mutscan(__global float *J,
+             __global uint *seqmem,
+             __global float *dE){
+    uint nseqs = get_global_size(0);
+    uint n = get_global_id(0);
+    uint i, m, a;
+    float d[nB];
+
+    for(i = 0; i < L; i++){
+        uint sbi = seqmem[(i/4)*nseqs + n];
+        uchar si = getbyte(&sbi, i%4);
+        for(a = 0; a < nB; a++){
+            d[a] = 0;
+        }
+        for(m = 0; m < L; m++){
+            if(m == i){
+                continue;
+            }
+            uint sbm = seqmem[(m/4)*nseqs + n];
+            uchar sm = getbyte(&sbm, m%4);
+            __global float *Jim = &J[(i*L + m)*nB*nB];
+            float cur = Jim[nB*si + sm];
+            for(a = 0; a < nB; a++){
+                d[a] += Jim[nB*a + sm] - cur;
+            }
+        }
+        for(a = 0; a < nB; a++){
+            dE[(i*nB + a)*nseqs + n] = d[a];
+        }
+    }
+}
+
 //****************************** Metropilis sampler **************************
 
 __kernel
@@ -195,6 +329,20 @@ void initRNG2(__global mwc64xvec2_state_t *rngstates,
 inline float UpdateEnergy(__local float *lcouplings, __global float *J, 
                           global uint *seqmem, uint nseqs, 
                           uint pos, uchar seqp, uchar mutres, float energy){
+#ifdef CPU_KERNELS
+    // CPU variant, without local memory staging (see getEnergiesf)
+    __global float *Jpos = &J[pos*L*nB*nB];
+    uint m;
+    for(m = 0; m < L; m++){
+        if(m == pos){
+            continue;
+        }
+        uint sbm = seqmem[(m/4)*nseqs + get_global_id(0)]; 
+        uchar seqm = getbyte(&sbm, m%4);
+        energy += Jpos[m*nB*nB + nB*mutres + seqm];
+        energy -= Jpos[m*nB*nB + nB*seqp   + seqm];
+    }
+#else
     uint m = 0;
     while(m < L){
         //loop through seq, changing energy by changed coupling with pos
@@ -222,6 +370,7 @@ inline float UpdateEnergy(__local float *lcouplings, __global float *J,
         }
         barrier(CLK_LOCAL_MEM_FENCE);
     }
+#endif
 
     return energy;
 }
@@ -232,10 +381,15 @@ void metropolis(__global float *J,
                 __global uint *position_list,
                          uint nsteps, // must be multiple of L
                 __global float *energies, //ony used to measure fp error
-                __global uint *seqmem){
+                __global uint *seqmem,
+                __global float *betas, //inverse temperatures, or NULL for 1
+                __global float *proposal, //site marginals, or NULL
+                __global uint *naccept){ //accepted mutations, or NULL
     
     uint nseqs = get_global_size(0);
 	mwc64xvec2_state_t rstate = rngstates[get_global_id(0)];
+    float beta = betas ? betas[get_global_id(0)] : 1.0f;
+    uint accepted = 0;
 
     //set up local mem 
     __local float lcouplings[nB*nB*4];
@@ -268,29 +422,204 @@ void metropolis(__global float *J,
     for(i = 0; i < nsteps; i++){
         uint pos = position_list[i];
         uint2 rng = MWC64XVEC2_NextUint2(&rstate);
-        uchar mutres = rng.x%nB;  // small error here if MAX_INT%nB != 0
-                                  // of order nB/MAX_INT in marginals
         uint sbn = seqmem[(pos/4)*nseqs + get_global_id(0)]; 
         uchar seqp = getbyte(&sbn, pos%4); 
+        uchar mutres = rng.x%nB;  // small error here if MAX_INT%nB != 0
+                                  // of order nB/MAX_INT in marginals
+        float hastings = 1.0f;
+        if(proposal){
+            // propose residue a != seqp with probability q[a]/(1 - q[seqp]),
+            // so the Hastings ratio is q[s](1-q[s]) / (q[a](1-q[a]))
+            __global float *q = &proposal[pos*nB];
+            float qs = q[seqp];
+            float r = uniformMap(rng.x)*(1 - qs);
+            uchar a;
+            for(a = 0; a < nB; a++){
+                if(a == seqp){
+                    continue;
+                }
+                mutres = a; // (last candidate, in case of fp rounding)
+                r -= q[a];
+                if(r < 0){
+                    break;
+                }
+            }
+            hastings = qs*(1 - qs)/(q[mutres]*(1 - q[mutres]));
+        }
 
         float newenergy = UpdateEnergy(lcouplings, J, seqmem, nseqs, 
                                        pos, seqp, mutres, energy);
 
         //apply MC criterion and possibly update
-        if(exp(-(newenergy - energy)) > uniformMap(rng.y)){ 
+        if(exp(-beta*(newenergy - energy))*hastings > uniformMap(rng.y)){ 
             setbyte(&sbn, pos%4, mutres);
             seqmem[(pos/4)*nseqs + get_global_id(0)] = sbn;
             energy = newenergy;
+            accepted += (mutres != seqp);
         }
     }
 
     rngstates[get_global_id(0)] = rstate;
+    if(naccept){
+        naccept[get_global_id(0)] += accepted;
+    }
 
 #ifdef MEASURE_FP_ERROR
     energies[get_global_id(0)] = energy;
 #endif
 }
 
+// Replica exchange step of parallel tempering. Walker t*nrep + r is replica r
+// of temperature t, for ntemps temperatures. For each replica r, attempts to
+// swap the seqs (and energies) of temperatures t and t+1 for every t with 
+// t%2 == parity, accepting with probability 
+// min(1, exp((beta_t - beta_t+1)*(E_t - E_t+1))). Accepted swaps are counted
+// in nswaps[t]. Energies must be up to date. Call with nrep work units.
+__kernel
+void swapTemps(__global mwc64xvec2_state_t *rngstates, 
+               __global float *energies,
+               __global uint *seqmem,
+               __global float *betas,
+                        uint ntemps,
+                        uint parity,
+               __global uint *nswaps){
+    uint r = get_global_id(0);
+    uint nrep = get_global_size(0);
+    uint nseqs = nrep*ntemps;
+    uint t, w;
+
+	mwc64xvec2_state_t rstate = rngstates[r];
+    #define SWORDS ((L-1)/4+1) 
+    for(t = parity; t+1 < ntemps; t += 2){
+        uint a = t*nrep + r, b = a + nrep;
+        float Ea = energies[a], Eb = energies[b];
+        float d = (betas[a] - betas[b])*(Ea - Eb);
+        uint2 rng = MWC64XVEC2_NextUint2(&rstate);
+        if(d >= 0 || exp(d) > uniformMap(rng.x)){
+            for(w = 0; w < SWORDS; w++){
+                uint tmp = seqmem[w*nseqs + a];
+                seqmem[w*nseqs + a] = seqmem[w*nseqs + b];
+                seqmem[w*nseqs + b] = tmp;
+            }
+            energies[a] = Eb;
+            energies[b] = Ea;
+            atomic_inc(&nswaps[t]);
+        }
+    }
+    rngstates[r] = rstate;
+    #undef SWORDS
+}
+
+// Records the energy of each of the first nrec walkers, and its Hamming 
+// distance from the reference seqs refseqs, as record t of the traces. 
+// seqmem and refseqs have nseqs seqs. Call with nrec work units.
+__kernel
+void recordTrace(__global float *energies,
+                 __global uint *seqmem,
+                 __global uint *refseqs,
+                          uint nseqs,
+                          uint t,
+                 __global float *Etrace,
+                 __global uint *Htrace){
+    uint n = get_global_id(0);
+    uint nrec = get_global_size(0);
+    uint w, k, d = 0;
+
+    for(w = 0; w < (L-1)/4+1; w++){
+        uint x = seqmem[w*nseqs + n] ^ refseqs[w*nseqs + n];
+        for(k = 0; k < 4; k++){
+            d += ((x >> (8*k)) & 0xff) != 0;
+        }
+    }
+    Etrace[t*nrec + n] = energies[n];
+    Htrace[t*nrec + n] = d;
+}
+
+// Statistics of a set of walkers for equilibration tracking, given their
+// bimarg and the bimarg of the previous tracking interval:
+//   stats[0] = sum((bimarg - prevmarg)^2)
+//   stats[1] = sum(bimarg*(1 - bimarg))
+//   stats[2] = E0 = energies[0]
+//   stats[3], stats[4] = sum of (E - E0) and (E - E0)^2 over nseq energies
+//   stats[5] = sum((bimarg - target)^2), if target is not NULL
+//   stats[6] = sum of naccept over nseq walkers, if naccept is not NULL
+// Call with a single group of vsize work units, with 6*vsize local floats.
+__kernel
+void equilStats(__global float *bimarg,
+                __global float *prevmarg,
+                __global float *target,
+                __global float *energies,
+                __global uint *naccept,
+                         uint nseq,
+                __local  float *sums,
+                __global float *stats){
+    uint li = get_local_id(0);
+    uint vsize = get_local_size(0);
+    uint n, k;
+    float E0 = energies[0];
+
+    for(k = 0; k < 6; k++){
+        sums[k*vsize + li] = 0;
+    }
+    for(n = li; n < (L*(L-1)/2)*nB*nB; n += vsize){
+        float b = bimarg[n], d = b - prevmarg[n];
+        sums[li] += d*d;
+        sums[vsize + li] += b*(1 - b);
+        if(target){
+            d = b - target[n];
+            sums[4*vsize + li] += d*d;
+        }
+    }
+    for(n = li; n < nseq; n += vsize){
+        float dE = energies[n] - E0;
+        sums[2*vsize + li] += dE;
+        sums[3*vsize + li] += dE*dE;
+        if(naccept){
+            sums[5*vsize + li] += naccept[n];
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    //reduce
+    for(n = vsize/2; n > 0; n >>= 1){
+        if(li < n){
+            for(k = 0; k < 6; k++){
+                sums[k*vsize + li] += sums[k*vsize + li + n];
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if(li == 0){
+        stats[0] = sums[0];
+        stats[1] = sums[vsize];
+        stats[2] = E0;
+        stats[3] = sums[2*vsize];
+        stats[4] = sums[3*vsize];
+        stats[5] = target ? sums[4*vsize] : NAN;
+        stats[6] = naccept ? sums[5*vsize] : NAN;
+    }
+}
+
+// Keeps the lowest energy visited by each walker, and the corresponding seq,
+// eg for simulated annealing. Energies must be up to date. Call with nseqs 
+// work units.
+__kernel
+void trackBest(__global float *energies,
+               __global uint *seqmem,
+               __global float *bestE,
+               __global uint *bestseqs){
+    uint n = get_global_id(0);
+    uint nseqs = get_global_size(0);
+    uint w;
+
+    float E = energies[n];
+    if(E < bestE[n]){
+        bestE[n] = E;
+        for(w = 0; w < (L-1)/4+1; w++){
+            bestseqs[w*nseqs + n] = seqmem[w*nseqs + n];
+        }
+    }
+}
+
 //****************************** Gibbs sampler **************************
 
 __kernel
@@ -391,7 +720,9 @@ void countBimarg(__global uint *bicount,
                  __global float *bimarg, 
                           uint nseq,
                  __global uint *seqmem,
-                 __local  uint *hist) {
+                 __local  uint *hist,
+                          uint nprev,
+                          uint stride) { //number of seqs in the seq buffer
     uint li = get_local_id(0);
     uint gi = get_group_id(0);
     uint nhist = get_local_size(0);
@@ -418,9 +749,9 @@ void countBimarg(__global uint *bicount,
     uint tmp;
     //loop through all sequences
     for(n = li; n < nseq; n += nhist){
-        tmp = seqmem[(i/4)*nseq+n];
+        tmp = seqmem[(i/4)*stride+n];
         uchar seqi = ((uchar*)&tmp)[i%4];
-        tmp = seqmem[(j/4)*nseq+n];
+        tmp = seqmem[(j/4)*stride+n];
         uchar seqj = ((uchar*)&tmp)[j%4];
         hist[nhist*(nB*seqi + seqj) + li]++;
     }
@@ -435,10 +766,15 @@ void countBimarg(__global uint *bicount,
         }
     }
     
+    //if nprev seqs were already counted (in earlier blocks of a spilled
+    //buffer), add to their counts
     for(n = li; n < nB*nB; n += nhist){ //only loops once if nhist > nB*nB
         uint count = hist[nhist*n];
+        if(nprev != 0){
+            count += bicount[gi*nB*nB + n];
+        }
         bicount[gi*nB*nB + n] = count;
-        bimarg[gi*nB*nB + n] = ((float)count)/nseq;
+        bimarg[gi*nB*nB + n] = ((float)count)/(nprev + nseq);
     }
 }
 
@@ -452,18 +788,26 @@ void perturbedWeights(__global float *J,
     weights[get_global_id(0)] = exp(-(energy - energies[get_global_id(0)]));
 }
 
+//weight of sequence n times its multiplicity, if seqs were deduplicated 
+//(counts is not NULL). Padding entries with count 0 give 0 even if their
+//weight is inf, so that divergence gives inf and not NaN.
+#define multweight(weights, counts, n) ((counts) ? \
+        ((counts)[n] ? (weights)[n]*(float)(counts)[n] : 0.0f) : (weights)[n])
+
 __kernel //simply sums a vector. Call with single group of size VSIZE
 void sumWeights(__global float *weights,
                 __global float *sumweights,
                           uint  nseq,
-                __local   float *sums){
+                __local   float *sums,
+                __global  uint *counts,
+                          uint  accumulate){
     uint li = get_local_id(0);
     uint vsize = get_local_size(0);
     uint n;
 
     sums[li] = 0;
     for(n = li; n < nseq; n += vsize){
-        sums[li] += weights[n];
+        sums[li] += multweight(weights, counts, n);
     }
     barrier(CLK_LOCAL_MEM_FENCE);
     //reduce
@@ -474,7 +818,7 @@ void sumWeights(__global float *weights,
         barrier(CLK_LOCAL_MEM_FENCE);
     }
     if(li == 0){
-        *sumweights = sums[0];
+        *sumweights = accumulate ? *sumweights + sums[0] : sums[0];
     }
 }
 
@@ -484,7 +828,9 @@ void weightedMarg(__global float *bimarg_new,
                   __global float *sumweights,
                            uint nseq, 
                   __global uint *seqmem,
-                  __local  float *hist) {
+                  __local  float *hist,
+                  __global uint *counts,
+                  __global float *prevsum) {
     uint li = get_local_id(0);
     uint gi = get_group_id(0);
     uint nhist = get_local_size(0);
@@ -511,7 +857,7 @@ void weightedMarg(__global float *bimarg_new,
         uchar seqi = ((uchar*)&tmp)[i%4];
         tmp = seqmem[(j/4)*nseq+n];
         uchar seqj = ((uchar*)&tmp)[j%4];
-        hist[nhist*(nB*seqi + seqj) + li] += weights[n];
+        hist[nhist*(nB*seqi + seqj) + li] += multweight(weights, counts, n);
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
@@ -525,11 +871,224 @@ void weightedMarg(__global float *bimarg_new,
         }
     }
 
+    //if prevsum is given, bimarg_new holds the marginals of earlier blocks
+    //of a spilled buffer with total weight prevsum, and sumweights includes
+    //this block
     for(n = li; n < nB*nB; n += nhist){ //only loops once if nhist >= nB*nB
-        bimarg_new[gi*nB*nB + n] = hist[nhist*n]/(*sumweights);
+        float b = hist[nhist*n];
+        if(prevsum){
+            b += bimarg_new[gi*nB*nB + n]*(*prevsum);
+        }
+        bimarg_new[gi*nB*nB + n] = b/(*sumweights);
+    }
+}
+
+// adds the energies of nseq seqs to running moments and a histogram. moments
+// holds the sums of (E - eref) and (E - eref)^2, each followed by its Kahan
+// compensation term. hist has nbins bins of width binwidth starting at emin,
+// plus an underflow bin at the start and an overflow bin at the end.
+__kernel //call with single group of size VSIZE
+void accumEnergies(__global float *energies,
+                            uint  nseq,
+                            float eref,
+                   __global float *moments,
+                   __global uint  *hist,
+                            float emin,
+                            float binwidth,
+                            uint  nbins,
+                   __local  float *sum1,
+                   __local  float *sum2){
+    uint li = get_local_id(0);
+    uint vsize = get_local_size(0);
+    uint n;
+
+    float s1 = 0, s2 = 0;
+    for(n = li; n < nseq; n += vsize){
+        float e = energies[n];
+        float d = e - eref;
+        s1 += d;
+        s2 += d*d;
+        float x = clamp((e - emin)/binwidth, -1.0f, (float)nbins);
+        atomic_inc(&hist[(int)floor(x) + 1]);
+    }
+    sum1[li] = s1;
+    sum2[li] = s2;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    //reduce
+    for(n = vsize/2; n > 0; n >>= 1){
+        if(li < n){
+            sum1[li] = sum1[li] + sum1[li + n];
+            sum2[li] = sum2[li] + sum2[li + n];
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if(li == 0){
+        float y, t;
+        y = sum1[0] - moments[1];
+        t = moments[0] + y;
+        moments[1] = (t - moments[0]) - y;
+        moments[0] = t;
+        y = sum2[0] - moments[3];
+        t = moments[2] + y;
+        moments[3] = (t - moments[2]) - y;
+        moments[2] = t;
+    }
+}
+
+// finds duplicate sequences, using a hash table with open addressing, in two
+// passes. The table has tablesize entries (a power of two) initialized to
+// 0xffffffff. insertUnique stores the lowest index of each distinct seq in
+// its slot, then countUnique (with counts zeroed) sets counts[n] to the
+// number of copies of seq n for the first occurrence n of each distinct seq,
+// and 0 for the others. Call both with at least nseq work units.
+inline uint findSlot(__global uint *seqmem, uint nseq, __global uint *table,
+                     uint tablesize, uint n, int insert){
+    // returns the slot of seq n, claiming an empty slot if insert is set
+    uint w, h = 2166136261u;
+    #define SWORDS ((L-1)/4+1) 
+    for(w = 0; w < SWORDS; w++){ //FNV-1a on words
+        h = (h ^ seqmem[w*nseq + n])*16777619u;
+    }
+    uint slot = h & (tablesize-1);
+    while(1){
+        uint prev = insert ? atomic_cmpxchg(&table[slot], 0xffffffff, n) 
+                           : table[slot];
+        if(prev == 0xffffffff){
+            return slot;
+        }
+        // (entries only ever change to copies of the same seq)
+        for(w = 0; w < SWORDS; w++){
+            if(seqmem[w*nseq + prev] != seqmem[w*nseq + n]){
+                break;
+            }
+        }
+        if(w == SWORDS){
+            return slot;
+        }
+        slot = (slot+1) & (tablesize-1);
+    }
+    #undef SWORDS
+}
+
+__kernel
+void insertUnique(__global uint *seqmem,
+                           uint  nseq,
+                  __global uint *table,
+                           uint  tablesize){
+    uint n = get_global_id(0);
+    if(n >= nseq){
+        return;
+    }
+    atomic_min(&table[findSlot(seqmem, nseq, table, tablesize, n, 1)], n);
+}
+
+__kernel
+void countUnique(__global uint *seqmem,
+                          uint  nseq,
+                 __global uint *table,
+                          uint  tablesize,
+                 __global uint *counts){
+    uint n = get_global_id(0);
+    if(n >= nseq){
+        return;
+    }
+    uint slot = findSlot(seqmem, nseq, table, tablesize, n, 0);
+    atomic_inc(&counts[table[slot]]);
+}
+
+// The first occurrences found by countUnique are compacted in order on the
+// device: groupUnique counts the distinct seqs in each group of work units,
+// scanGroups turns these into the number in all previous groups, and
+// scatterUnique writes index[k] = n and mult[k] = counts[n] for the k-th
+// distinct seq n. Call groupUnique and scatterUnique with the same group
+// size and at least nseq work units, and scanGroups with a single group.
+inline void localScan(__local uint *s){
+    // inclusive prefix sum of s over the work group
+    uint li = get_local_id(0);
+    uint d;
+    for(d = 1; d < get_local_size(0); d <<= 1){
+        uint v = li >= d ? s[li-d] : 0;
+        barrier(CLK_LOCAL_MEM_FENCE);
+        s[li] += v;
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+}
+
+__kernel
+void groupUnique(__global uint *counts,
+                          uint  nseq,
+                 __global uint *groupsums,
+                 __local  uint *s){
+    uint n = get_global_id(0);
+    uint li = get_local_id(0);
+    s[li] = n < nseq && counts[n] != 0;
+    localScan(s);
+    if(li == get_local_size(0)-1){
+        groupsums[get_group_id(0)] = s[li];
     }
 }
 
+__kernel
+void scanGroups(__global uint *groupsums,
+                         uint  ngroups,
+                __global uint *total,
+                __local  uint *s){
+    uint li = get_local_id(0);
+    uint vsize = get_local_size(0);
+    uint n, v, carry = 0;
+
+    for(n = 0; n < ngroups; n += vsize){
+        v = n + li < ngroups ? groupsums[n + li] : 0;
+        s[li] = v;
+        localScan(s);
+        if(n + li < ngroups){
+            groupsums[n + li] = carry + s[li] - v;
+        }
+        carry += s[vsize-1];
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if(li == 0){
+        *total = carry;
+    }
+}
+
+__kernel
+void scatterUnique(__global uint *counts,
+                            uint  nseq,
+                   __global uint *groupsums,
+                   __global uint *index,
+                   __global uint *mult,
+                   __local  uint *s){
+    uint n = get_global_id(0);
+    uint li = get_local_id(0);
+    uint c = n < nseq ? counts[n] : 0;
+    s[li] = c != 0;
+    localScan(s);
+    if(c != 0){
+        uint k = groupsums[get_group_id(0)] + s[li] - 1;
+        index[k] = n;
+        mult[k] = c;
+    }
+}
+
+// copies seqs index[n] of src to seq n of dst. Call with one work unit per
+// dst seq.
+__kernel
+void gatherSeqs(__global uint *src,
+                         uint  nsrc,
+                __global uint *dst,
+                __global uint *index){
+    uint n = get_global_id(0);
+    uint ndst = get_global_size(0);
+    uint w;
+
+    #define SWORDS ((L-1)/4+1) 
+    for(w = 0; w < SWORDS; w++){
+        dst[w*ndst + n] = src[w*nsrc + index[n]];
+    }
+    #undef SWORDS
+}
+
 __kernel 
 void updatedJ(__global float *bimarg_target,
               __global float *bimarg,
@@ -25,9 +25,11 @@ from numpy.random import randint
 import numpy.random
 import pyopencl as cl
 import pyopencl.array as cl_array
-import os, time
+import os, time, weakref, threading
+from collections import deque
 import seqload
 import textwrap
+import tracing
 
 ################################################################################
 
@@ -43,14 +45,47 @@ import textwrap
 #You can copy one buffer to the other with 'storebuf', and swap them with
 #'swapbuf'.
 
+#Each GPU has two in-order command queues: a compute queue for kernels and
+#device-to-device copies, and a transfer queue for copies between host and
+#device (getBuf, setBuf). Transfers wait for the last compute work enqueued
+#before them which uses the same device buffer, and kernels wait for pending
+#transfers of the buffers they use, so that readbacks of finished results and
+#uploads of new inputs overlap with kernels working on other buffers. This
+#relies on every kernel declaring the buffers it reads and writes.
+
+#Host-side copies go through page-locked staging arrays, which are leased from
+#a per-GPU pool (PinnedPool) and reused. The array returned by FutureBuf.read()
+#is a leased staging array: Call FutureBuf.release() (or gpu.releaseBuf) once
+#done with it to return it to the pool. Unreleased arrays are simply garbage
+#collected.
+
+#With spill, the large buffer's seqs, energies and weights are kept in
+#page-locked host memory instead of on the device, so the number of samples is
+#limited by host memory. Computations on the large buffer then stream it
+#through two sets of device block buffers ('seq block0', 'seq block1', etc)
+#one block at a time, so that the upload of the next block overlaps with the
+#kernels working on the current one, and accumulate the results of the blocks.
+#storeSeqs copies the small buffer straight to host memory.
+
+#Per-operation logging is done through the tracing module (see the --trace
+#option), which records the OpenCL events with their buffer names and sizes.
+#The gpu-N.log file only gets rare messages. When profiling, retired events
+#are also added to the tracing performance report. For kernels the byte count
+#is the total size of the buffers they read and write, so the reported kernel
+#bandwidth is a lower bound on the achieved memory bandwidth.
+
 #Note that in openCL implementations there is generally a limit on the
 #number of queued items allowed in a context. If you reach the limit, all queues
 #will block until a kernel finishes. So all code must be careful that one GPU
-#does not hog the queues.
+#does not hog the queues. To help with this, each MCMCGPU keeps a bounded window
+#of in-flight events (maxinflight): Enqueueing past the limit blocks until the
+#oldest event completes, and completed events are released as they retire.
 
 #Note that on some systems there is a watchdog timer that kills any kernel 
 #that takes too long to finish. You will get a CL_OUT_OF_RESOURCES error 
-#if this happens, which occurs when the *following* kernel is run.
+#if this happens, which occurs when the *following* kernel is run. To avoid
+#this, the number of MC steps per kernel launch can be adapted to a target
+#duration (see setKernelSteps), splitting or merging loops of nsteps.
 
 #Note that MCMC generation is split between nloop and nsteps.  Restarting the
 #metropolis kernel as the effect of recalculating the current energy from
@@ -58,26 +93,132 @@ import textwrap
 #kernel run.
 
 class FutureBuf:
-    def __init__(self, buffer, event, postprocess=None):
+    def __init__(self, buffer, event, postprocess=None, pool=None):
         self.buffer = buffer
         self.event = event
         self.postfunc = postprocess
+        self.pool = pool
 
     def read(self):
         self.event.wait()
         if self.postfunc != None:
-            return self.postfunc(self.buffer)
+            #postprocessing makes a new array, so the lease can end now
+            res = self.postfunc(self.buffer)
+            self.release()
+            return res
         return self.buffer
 
+    def release(self):
+        # returns the staging array to the pool. The array returned by read()
+        # must not be used after this.
+        if self.pool is not None:
+            self.pool.release(self.buffer, self.event)
+            self.pool = None
+
+class PinnedPool:
+    # Pool of page-locked host arrays used to stage transfers to and from one
+    # GPU, keyed by (dtype, shape). Arrays are mapped ALLOC_HOST_PTR buffers,
+    # which the driver can transfer at full bandwidth without an extra copy.
+    def __init__(self, ctx, queue):
+        self.ctx = ctx
+        self.queue = queue
+        self.free = {}
+        self.pending = [] # released arrays still in use by a transfer
+        self.owned = weakref.WeakValueDictionary()
+        self.nbytes = 0
+
+    def lease(self, buftype, bufshape):
+        self.reclaim()
+        key = (dtype(buftype).str, tuple(bufshape))
+        if self.free.get(key):
+            return self.free[key].pop()
+
+        arr = self.alloc(buftype, bufshape)
+        self.owned[id(arr)] = arr
+        return arr
+
+    def alloc(self, buftype, bufshape):
+        # new page-locked array, which is not returned to the pool on release
+        size = dtype(buftype).itemsize*product(bufshape)
+        flags = cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR
+        buf = cl.Buffer(self.ctx, flags, size=max(size, 1))
+        mapflags = cl.map_flags.READ | cl.map_flags.WRITE
+        #(the mapped array keeps buf alive)
+        arr = cl.enqueue_map_buffer(self.queue, buf, mapflags, 0, bufshape,
+                                    buftype, is_blocking=True)[0]
+        self.nbytes += size
+        return arr
+
+    def release(self, arr, event=None):
+        # return arr to the pool, once event (if given) has completed
+        if self.owned.get(id(arr)) is not arr:
+            return #not from this pool
+        if event is not None:
+            self.pending.append((arr, event))
+        else:
+            self.free.setdefault((arr.dtype.str, arr.shape), []).append(arr)
+
+    def reclaim(self):
+        complete = cl.command_execution_status.COMPLETE
+        pending = []
+        for arr, evt in self.pending:
+            if evt.command_execution_status == complete:
+                self.release(arr)
+            else:
+                pending.append((arr, evt))
+        self.pending = pending
+
+def reportPerf(gpus, label, fn, log):
+    # wait for the gpus, and log and save a performance report of the round
+    # which ended. If label is None, reports the totals for the whole run.
+    if not tracing.report.enabled:
+        return
+    for gpu in gpus:
+        gpu.wait()
+        gpu.logProfile()
+    if label is None:
+        tracing.report.endRun(fn, log)
+    else:
+        tracing.report.endRound(label, fn, log)
+
 def readGPUbufs(bufnames, gpus):
     futures = [[gpu.getBuf(bn) for gpu in gpus] for bn in bufnames]
     return [[buf.read() for buf in gpuf] for gpuf in futures]
 
+def releaseGPUbufs(bufs, gpus):
+    # returns staging arrays obtained from readGPUbufs to the gpus' pools
+    for gpubufs in bufs:
+        for gpu, buf in zip(gpus, gpubufs):
+            gpu.releaseBuf(buf)
+
+def timeMCMCConcurrent(gpus):
+    # runs a kernel launch on all gpus at once, and returns the wall time (s)
+    # each gpu took from its launch until it finished
+    for gpu in gpus:
+        gpu.wait()
+    starts, times = [], [None]*len(gpus)
+    for gpu in gpus:
+        starts.append(time.time())
+        gpu.runMCMC()
+        gpu.queue.flush()
+    def finish(n):
+        gpus[n].queue.finish()
+        times[n] = time.time() - starts[n]
+    threads = [threading.Thread(target=finish, args=(n,)) 
+               for n in range(len(gpus))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for gpu in gpus:
+        gpu.wait()
+    return times
 
 class MCMCGPU:
     def __init__(self, (gpu, gpunum, ctx, prg), (L, nB), outdir, nseq_small, 
                  nseq_large, wgsize, vsize, nhist, nMCMCcalls, nsteps=1, 
-                 gibbs=False, profile=False):
+                 gibbs=False, profile=False, maxnsteps=None, maxinflight=64,
+                 spill=False, appendlog=False, walker0=None):
 
         self.L = L
         self.nB = nB
@@ -85,11 +226,13 @@ class MCMCGPU:
         self.wgsize = wgsize
         self.nhist = nhist
         self.vsize = vsize
-        self.events = []
+        self.events = deque() #in-flight events (evt, name, nbytes, info)
+        self.maxinflight = maxinflight
+        self.profiledat = []  #(name, start, end, nbytes) of retired events
         self.gpunum = gpunum
 
         self.logfn = os.path.join(outdir, 'gpu-{}.log'.format(gpunum))
-        with open(self.logfn, "wt") as f:
+        with open(self.logfn, "at" if appendlog else "wt") as f:
             printDevice(f.write, gpu)
 
         self.gibbs = gibbs
@@ -104,14 +247,28 @@ class MCMCGPU:
             self.log("Using Metropolis-Hastings sampler")
 
         #setup opencl for this device
+        self.device = gpu
+        self.ctx = ctx
         self.prg = prg
         self.log("Getting CL Queue")
         self.profile = profile
-        if profile:
+        self.tracing = tracing.tracer.enabled
+        if profile or self.tracing:
             qprop = cl.command_queue_properties.PROFILING_ENABLE
             self.queue = cl.CommandQueue(ctx, device=gpu, properties=qprop)
+            self.xferqueue = cl.CommandQueue(ctx, device=gpu, properties=qprop)
         else:
             self.queue = cl.CommandQueue(ctx, device=gpu)
+            self.xferqueue = cl.CommandQueue(ctx, device=gpu)
+        #last event on the compute queue using each device buffer, and 
+        #pending transfer queue events for each device buffer (see
+        #computeWaitlist and transferWaitlist)
+        self.lastuse = {}
+        self.uploads = {}
+        self.readbacks = {}
+        self.pool = PinnedPool(ctx, self.xferqueue)
+        if self.tracing:
+            self.setupTrace(gpu)
         self.log("\nOpenCL Device Compilation Log:")
         self.log(self.prg.get_build_info(gpu, cl.program_build_info.LOG))
         maxwgs = self.mcmcprg.get_work_group_info(
@@ -130,7 +287,13 @@ class MCMCGPU:
         self.log("\nBuffers: {} small seqs, {} large seqs".format(nseq_small, nseq_large))
 
         self.nsteps = int(nsteps)
-        
+        #MC steps per kernel launch. May differ from nsteps if adapted to a
+        #target kernel duration, see setKernelSteps. 
+        self.kernelsteps = self.nsteps
+        self.maxnsteps = int(maxnsteps) if maxnsteps else self.nsteps
+        self.kernelstepsTuned = False
+        self.walkersBalanced = False #see NewtonSteps.balanceWalkers
+
 
         self.buf_spec = {   'Jpacked': ('<f4',  (L*L, nB*nB)),
                              'J main': ('<f4',  (nPairs, nB*nB)),
@@ -148,13 +311,30 @@ class MCMCGPU:
                             'E large': ('<f4',  (self.nseq['large'],)),
                             'weights': ('<f4',  (self.nseq['large'],)),
                                'neff': ('<f4',  (1,)),
-                            'randpos': ('<u4',  (self.nsteps,))}
+                            'randpos': ('<u4',  (self.maxnsteps,))}
+
+        #with spill, the large buffers are host arrays, and are streamed 
+        #through device block buffers of nseq['small'] seqs
+        self.spill = spill
+        self.hostbufs = {}
+        if spill:
+            for bname in ['seq large', 'E large', 'weights']:
+                buftype, bufshape = self.buf_spec[bname]
+                self.hostbufs[bname] = self.pool.alloc(buftype, bufshape)
+            self.log("Spilling large buffer to {} bytes of host memory".format(
+                     sum([b.nbytes for b in self.hostbufs.values()])))
+            nblock = self.nseq['block'] = self.nseq['small']
+            for blk in ['block0', 'block1']:
+                self.nseq[blk] = nblock
+                self.buf_spec['seq ' + blk] = ('<u4', (SWORDS, nblock))
+                self.buf_spec['E ' + blk] = ('<f4', (nblock,))
+                self.buf_spec['weights ' + blk] = ('<f4', (nblock,))
+            self.buf_spec['neff prev'] = ('<f4', (1,))
 
         self.bufs = {}
-        flags = cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR
-        for bname,(buftype,bufshape) in self.buf_spec.iteritems():
-            size = dtype(buftype).itemsize*product(bufshape)
-            self.bufs[bname] = cl.Buffer(ctx, flags, size=size)
+        for bname,(buftype,bufshape) in self.buf_spec.items():
+            if bname not in self.hostbufs:
+                self.addBuf(bname, buftype, bufshape)
         
         #convenience dicts:
         def getBufs(bufname):
@@ -172,41 +352,144 @@ class MCMCGPU:
 
         self.packedJ = None #use to keep track of which Jbuf is packed
         #(This class keeps track of Jpacked internally)
+
+        #seq buffer used for reweighting (perturbMarg), 'unique' after 
+        #dedupSeqs, and otherwise 'large'
+        self.weightSeqbuf = 'large'
+
+        #parallel tempering (see setTemperatures). storeSeqs stores the first
+        #nstore walkers of the small buffer, which are those at beta = 1.
+        self.ntemps = 1
+        self.betas = None
+        self.nstore = self.nseq['small']
+
+        #positions the sampler may mutate, or None for all (see setFixedPos)
+        self.freepos = None
+
+        #accepted mutations of each walker, and MC steps per walker, since
+        #the last readAccept (Metropolis only)
+        if not gibbs:
+            self.addBuf('naccept', '<u4', (self.nseq['small'],))
+            self.fillBuf('naccept', 0)
+        self.proposals = 0
         
-        self.initRNG(nMCMCcalls, gibbs, log)
+        self.initRNG(nMCMCcalls, gibbs, log, walker0)
 
         self.log("Initialization Finished\n")
 
+    def addBuf(self, bufname, buftype, bufshape):
+        # allocates a device buffer. Buffers only needed by some computations
+        # are added by those computations when first used.
+        self.buf_spec[bufname] = (buftype, bufshape)
+        size = dtype(buftype).itemsize*product(bufshape)
+        flags = cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR
+        self.bufs[bufname] = cl.Buffer(self.ctx, flags, size=size)
+
+    def computeWaitlist(self, reads=(), writes=()):
+        # returns events on the transfer queue which a kernel must wait for:
+        # uploads to buffers it reads or writes, and readbacks of buffers it
+        # writes. Since the compute queue is in-order, once a kernel waits for
+        # a transfer no later kernel needs to.
+        wait = [self.uploads.pop(b) for b in list(reads) + list(writes) 
+                                    if b in self.uploads]
+        wait += [self.readbacks.pop(b) for b in writes if b in self.readbacks]
+        if wait != []:
+            self.xferqueue.flush()
+            return wait
+        return None
+
+    def transferWaitlist(self, buf):
+        # transfers wait for previously enqueued compute work using buf
+        if buf not in self.lastuse:
+            return None
+        self.queue.flush()
+        return [self.lastuse[buf]]
+
+    def runKernel(self, name, kernel, gsize, lsize, args, reads=(), writes=(),
+                  info=''):
+        evt = kernel(self.queue, gsize, lsize, *args,
+                     wait_for=self.computeWaitlist(reads, writes))
+        used = set(reads) | set(writes)
+        for b in used:
+            self.lastuse[b] = evt
+        nbytes = sum([b.size for b in used])
+        self.addEvent(evt, name, nbytes, info)
+        return evt
+
+    def setupTrace(self, gpu):
+        trc = tracing.tracer
+        self.tracepid = self.gpunum + 1
+        trc.setName(self.tracepid, 'GPU {} ({})'.format(self.gpunum, gpu.name))
+        trc.setName(self.tracepid, 'compute', 0)
+        trc.setName(self.tracepid, 'transfer', 1)
+        # find offset from device timer to host clock, using a marker
+        evt = cl.enqueue_marker(self.queue)
+        evt.wait()
+        self.clockoffset = time.time() - evt.profile.end*1e-9
+
+    def addEvent(self, evt, name, nbytes=0, info=''):
+        self.events.append((evt, name, nbytes, info))
+        self.retireEvents()
+        #backpressure: don't let this gpu fill up the queues
+        while len(self.events) > self.maxinflight:
+            self.events[0][0].wait()
+            self.retireEvents()
+
+    def retireEvents(self):
+        # release completed events from the front of the in-flight window,
+        # keeping their timestamps if profiling
+        complete = cl.command_execution_status.COMPLETE
+        events = self.events
+        while events and events[0][0].command_execution_status == complete:
+            evt, name, nbytes, info = events.popleft()
+            tid = 0 if evt.command_queue == self.queue else 1
+            if self.profile:
+                self.profiledat.append((name, evt.profile.start, 
+                                        evt.profile.end, nbytes))
+                tracing.report.addEvent(name, 
+                                  (evt.profile.end - evt.profile.start)*1e-9, 
+                                  nbytes, ('compute', 'transfer')[tid])
+            if self.tracing:
+                off = self.clockoffset
+                tracing.tracer.span(name, evt.profile.start*1e-9 + off, 
+                                    evt.profile.end*1e-9 + off, 
+                                    self.tracepid, tid, 
+                                    {'info': info, 'bytes': nbytes})
+
     def log(self, str):
         #logs are rare, so just open the file every time
         with open(self.logfn, "at") as f:
             print(time.clock(), str, file=f)
 
     def logProfile(self):
-        #XXX don't call this if there are uncompleted events
+        #only logs completed events, others are logged in a later call
         if not self.profile:
             return
+        self.retireEvents()
         with open(self.logfn, "at") as f:
-            while self.events != []:
-                dat = self.events.pop(0)
-                evt, name, size = dat[0],dat[1],(dat[2] if len(dat)==3 else '')
-                print("EVT", name, evt.profile.start, evt.profile.end, 
-                      size, file=f)
+            for name, start, end, size in self.profiledat:
+                print("EVT", name, start, end, size, file=f)
+        self.profiledat = []
 
     #converts seqs to uchars, padded to 32bits, assume GPU is little endian
-    def packSeqs(self, seqs):
-        bseqs = zeros((seqs.shape[0], self.SBYTES), dtype='<u1', order='C')
-        bseqs[:,:self.L] = seqs  
-        mem = zeros((self.SWORDS, seqs.shape[0]), dtype='<u4', order='C')
-        for i in range(self.SWORDS):
-            mem[i,:] = bseqs.view(uint32)[:,i]
+    #if mem is given, packs into it instead of a new array
+    def packSeqs(self, seqs, mem=None):
+        nseq = seqs.shape[0]
+        if mem is None:
+            mem = empty((self.SWORDS, nseq), dtype='<u4', order='C')
+        #byte view of mem: byte b of word w of seq n is bmem[w,n,b]
+        bmem = mem.view('<u1').reshape((self.SWORDS, nseq, 4))
+        for i in range(self.SBYTES):
+            bmem[i/4,:,i%4] = seqs[:,i] if i < self.L else 0
         return mem
 
     def unpackSeqs(self, mem):
-        bseqs = zeros((mem.shape[1], self.SBYTES), dtype='<u1', order='C')
-        for i in range(self.SWORDS): #undo memory rearrangement
-            bseqs.view(uint32)[:,i] = mem[i,:] 
-        return bseqs[:,:self.L]
+        nseq = mem.shape[1]
+        bmem = mem.view('<u1').reshape((self.SWORDS, nseq, 4))
+        seqs = empty((nseq, self.L), dtype='<u1')
+        for i in range(self.L): #undo memory rearrangement
+            seqs[:,i] = bmem[i/4,:,i%4]
+        return seqs
 
     #convert from format where every row is a unique ij pair (L choose 2 rows)
     #to format with every pair, all orders (L^2 rows)
@@ -224,16 +507,18 @@ class MCMCGPU:
     def packJ(self, Jbufname):
         if self.packedJ == Jbufname:
             return
-        self.log("packJ " + Jbufname)
 
         nB, nPairs = self.nB, self.nPairs
-        J_dev = self.Jbufs[Jbufname]
-        evt = self.prg.packfV(self.queue, (nPairs*nB*nB,), (nB*nB,), 
-                        J_dev, self.bufs['Jpacked'])
-        self.events.append((evt, 'packJ'))
+        J_dev, Jp_dev = self.Jbufs[Jbufname], self.bufs['Jpacked']
+        self.runKernel('packJ', self.prg.packfV, (nPairs*nB*nB,), (nB*nB,), 
+                       (J_dev, Jp_dev), reads=[J_dev], writes=[Jp_dev],
+                       info=Jbufname)
         self.packedJ = Jbufname
 
-    def initRNG(self, nMCMCcalls, gibbs, log):
+    def initRNG(self, nMCMCcalls, gibbs, log, walker0=None):
+        # walker0 is the number of walkers on all previous gpus (of all 
+        # processes), so each walker gets its own RNG stream. If not given,
+        # all gpus are assumed to have the same number of walkers.
         self.log("initRNG")
 
         if gibbs:
@@ -245,7 +530,9 @@ class MCMCGPU:
 
         nsamples = uint64(2**40) #upper bound for # of rngs generated
         nseq = self.nseq['small']
-        offset = uint64(nsamples*nseq*self.gpunum*vsize) 
+        if walker0 is None:
+            walker0 = nseq*self.gpunum
+        offset = uint64(nsamples*walker0*vsize) 
         # each gpu uses perStreamOffset*get_global_id(0)*vectorSize samples
         #               (nsamples *   nseq         *    vecsize)
         
@@ -261,21 +548,230 @@ class MCMCGPU:
         wgsize = self.wgsize
         while wgsize > nseq:
             wgsize = wgsize/2
-        evt = initkernel(self.queue, (nseq,), (wgsize,), 
-                         self.bufs['rngstates'], offset, nsamples)
-        self.events.append((evt, 'initRNG'))
-
-    def runMCMC(self):
-        self.log("runMCMC")
+        self.runKernel('initRNG', initkernel, (nseq,), (wgsize,), 
+                       (self.bufs['rngstates'], offset, nsamples),
+                       writes=[self.bufs['rngstates']])
+
+    def runMCMC(self, nsteps=None):
+        nsteps = self.nsteps if nsteps is None else nsteps
+        if nsteps > self.maxnsteps:
+            raise Exception("cannot run more than {} MC steps per kernel "
+                            "call".format(self.maxnsteps))
         nseq = self.nseq['small']
-        nsteps = self.nsteps
         self.packJ('main')
-        self.setBuf('randpos', randint(0, self.L, size=nsteps).astype('u4'))
-        evt = self.mcmcprg(self.queue, (nseq,), (self.wgsize,), 
-                          self.bufs['Jpacked'], self.bufs['rngstates'], 
-                          self.bufs['randpos'], uint32(nsteps), 
-                          self.Ebufs['small'], self.seqbufs['small'])
-        self.events.append((evt, 'mcmc'))
+        #only the first nsteps positions are used by the kernel. (Upload on
+        #the compute queue, since it is small and ordered with the kernels)
+        if self.freepos is None:
+            randpos = randint(0, self.L, size=nsteps).astype('<u4')
+        else:
+            randpos = self.freepos[randint(0, len(self.freepos), size=nsteps)]
+        evt = cl.enqueue_copy(self.queue, self.bufs['randpos'], randpos,
+                              is_blocking=False, 
+                              wait_for=self.computeWaitlist(
+                                              writes=[self.bufs['randpos']]))
+        self.addEvent(evt, 'setBuf', randpos.nbytes, 'randpos')
+        bufs = self.bufs
+        args = (bufs['Jpacked'], bufs['rngstates'], bufs['randpos'], 
+                uint32(nsteps), bufs['E small'], bufs['seq small'])
+        betas, proposal = bufs.get('betas'), bufs.get('proposal')
+        if not self.gibbs:
+            args += (betas, proposal, bufs['naccept'])
+            self.proposals += nsteps
+        self.runKernel('mcmc', self.mcmcprg, (nseq,), (self.wgsize,), args,
+                       reads=[b for b in [bufs['Jpacked'], bufs['randpos'], 
+                                          betas, proposal] if b],
+                       writes=[b for b in [bufs['rngstates'], bufs['E small'],
+                                           bufs['seq small'], 
+                                           bufs.get('naccept')] if b], 
+                       info=str(nsteps))
+        if self.ntemps > 1:
+            self.swapTemps()
+
+    def setTemperatures(self, betas):
+        # Sets up parallel tempering: the walkers are divided into len(betas)
+        # groups of nstore walkers ("replicas"), where group t runs at 
+        # inverse temperature betas[t], with betas[0] = 1. Each MCMC kernel 
+        # launch is followed by a replica exchange step (swapTemps), and 
+        # storeSeqs only stores the walkers at beta = 1. 
+        if self.gibbs:
+            raise Exception("parallel tempering requires the Metropolis "
+                            "sampler")
+        ntemps, nseq = len(betas), self.nseq['small']
+        if nseq % (ntemps*self.wgsize) != 0 or betas[0] != 1:
+            raise Exception("walkers per GPU must be a multiple of "
+                            "wgsize*ntemps, and the first beta must be 1")
+        if ntemps != self.ntemps:
+            self.addBuf('betas', '<f4', (nseq,))
+            self.addBuf('nswaps', '<u4', (max(ntemps-1, 1),))
+            self.fillBuf('nswaps', 0)
+            self.swapattempts = zeros(max(ntemps-1, 1), dtype=int)
+            self.swapparity = 0
+        self.ntemps = ntemps
+        self.nstore = nseq//ntemps
+        self.betas = array(betas, dtype='<f4')
+        self.setBuf('betas', repeat(self.betas, self.nstore))
+
+    def swapTemps(self):
+        # replica exchange between neighboring temperatures, alternating
+        # between even and odd pairs. Uses exact energies of the walkers.
+        self.calcEnergies('small', 'main')
+        bufs = self.bufs
+        small = self.seqbufs['small']
+        parity = self.swapparity
+        self.runKernel('swapTemps', self.prg.swapTemps, 
+                       (self.nstore,), (self.wgsize,), 
+                       (bufs['rngstates'], bufs['E small'], small, 
+                        bufs['betas'], uint32(self.ntemps), uint32(parity),
+                        bufs['nswaps']),
+                       reads=[bufs['rngstates'], bufs['E small'], small, 
+                              bufs['betas'], bufs['nswaps']],
+                       writes=[bufs['rngstates'], bufs['E small'], small,
+                               bufs['nswaps']], info=str(parity))
+        self.swapattempts[parity::2] += self.nstore
+        self.swapparity = 1 - parity
+
+    def readSwaps(self):
+        # returns (FutureBuf of accepted swaps, attempted swaps) for each 
+        # pair of neighboring temperatures since the last call
+        nswaps = self.getBuf('nswaps')
+        attempts = self.swapattempts.copy()
+        self.swapattempts[:] = 0
+        self.fillBuf('nswaps', 0)
+        return nswaps, attempts
+
+    def setBeta(self, beta):
+        # sets the inverse temperature of all walkers, eg for annealing
+        if self.gibbs or self.ntemps > 1:
+            raise Exception("setting beta requires the Metropolis sampler "
+                            "without parallel tempering")
+        if 'betas' not in self.bufs:
+            self.addBuf('betas', '<f4', (self.nseq['small'],))
+        self.fillBuf('betas', float32(beta))
+
+    def setFixedPos(self, fixedmarks):
+        # stops the sampler from mutating the positions marked nonzero
+        freepos = nonzero(asarray(fixedmarks) == 0)[0].astype('<u4')
+        if len(freepos) == 0:
+            raise Exception("cannot fix all positions")
+        self.setBuf('fixpos', asarray(fixedmarks, dtype='<u1'))
+        self.freepos = freepos if len(freepos) != self.L else None
+
+    def resetBest(self):
+        # starts tracking the lowest energy seq visited by each walker
+        nseq = self.nseq['small']
+        if 'E best' not in self.bufs:
+            self.addBuf('E best', '<f4', (nseq,))
+            self.addBuf('seq best', '<u4', (self.SWORDS, nseq))
+            self.seqbufs['best'] = self.bufs['seq best']
+            self.nseq['best'] = nseq
+        self.fillBuf('E best', float32(inf))
+
+    def trackBest(self):
+        # updates the lowest energy seqs with the current walker seqs. Only
+        # the states at the end of each MCMC kernel call are considered.
+        self.calcEnergies('small', 'main')
+        bufs = self.bufs
+        small = self.seqbufs['small']
+        self.runKernel('trackBest', self.prg.trackBest, 
+                       (self.nseq['small'],), (self.wgsize,),
+                       (bufs['E small'], small, bufs['E best'], 
+                        bufs['seq best']),
+                       reads=[bufs['E small'], small, bufs['E best']],
+                       writes=[bufs['E best'], bufs['seq best']])
+
+    def setProposal(self, unimarg):
+        # propose mutations from the site marginals unimarg (L, nB), instead
+        # of uniformly. All marginals must be nonzero.
+        if self.gibbs:
+            raise Exception("marginal proposals require the Metropolis "
+                            "sampler")
+        if 'proposal' not in self.bufs:
+            self.addBuf('proposal', '<f4', (self.L, self.nB))
+        self.setBuf('proposal', unimarg.astype('<f4'))
+
+    def readAccept(self):
+        # returns (FutureBuf of accepted mutations of each walker, MC steps
+        # per walker) since the last call
+        naccept = self.getBuf('naccept')
+        nsteps = self.proposals
+        self.proposals = 0
+        self.fillBuf('naccept', 0)
+        return naccept, nsteps
+
+    def initTrace(self, ntrace):
+        # starts recording up to ntrace energies and Hamming distances from
+        # the current seqs of the sampled walkers (see recordTrace)
+        nrec, nseq = self.nstore, self.nseq['small']
+        if self.buf_spec.get('E trace', (None, None))[1] != (ntrace, nrec):
+            self.addBuf('E trace', '<f4', (ntrace, nrec))
+            self.addBuf('H trace', '<u4', (ntrace, nrec))
+        if 'seq ref' not in self.bufs:
+            self.addBuf('seq ref', '<u4', (self.SWORDS, nseq))
+        self.copyBuf('seq small', 'seq ref')
+        self.ntrace = 0
+
+    def recordTrace(self):
+        ntrace = self.buf_spec['E trace'][1][0]
+        if self.ntrace == ntrace:
+            raise Exception("trace buffers are full")
+        self.calcEnergies('small', 'main')
+        bufs = self.bufs
+        small = self.seqbufs['small']
+        self.runKernel('recordTrace', self.prg.recordTrace, 
+                       (self.nstore,), (self.wgsize,),
+                       (bufs['E small'], small, bufs['seq ref'], 
+                        uint32(self.nseq['small']), uint32(self.ntrace),
+                        bufs['E trace'], bufs['H trace']),
+                       reads=[bufs['E small'], small, bufs['seq ref']],
+                       writes=[bufs['E trace'], bufs['H trace']])
+        self.ntrace += 1
+
+    def equilStats(self, target=False):
+        # statistics of the sampled walkers for equilibration tracking (see
+        # the equilStats kernel), including the SSR relative to 'bi target'
+        # if target is True. 'bi main' must hold their bimarg, which is
+        # kept for the next call. Returns (FutureBuf of the stats, MC steps
+        # per walker counted by the acceptance counts).
+        bufs = self.bufs
+        if 'equil stats' not in bufs:
+            self.addBuf('equil stats', '<f4', (7,))
+            self.addBuf('bi prev', '<f4', (self.nPairs, self.nB*self.nB))
+            self.fillBuf('bi prev', 0)
+        self.calcEnergies('small', 'main')
+        target = bufs['bi target'] if target else None
+        naccept = bufs.get('naccept')
+        localarr = cl.LocalMemory(6*self.vsize*dtype(float32).itemsize)
+        self.runKernel('equilStats', self.prg.equilStats, 
+                       (self.vsize,), (self.vsize,),
+                       (bufs['bi main'], bufs['bi prev'], target, 
+                        bufs['E small'], naccept, uint32(self.nstore), 
+                        localarr, bufs['equil stats']),
+                       reads=[b for b in [bufs['bi main'], bufs['bi prev'], 
+                                          target, bufs['E small'], 
+                                          naccept] if b],
+                       writes=[bufs['equil stats']])
+        self.copyBuf('bi main', 'bi prev')
+        return self.getBuf('equil stats'), self.proposals
+
+    def splitSteps(self, nloop):
+        # divides nloop*nsteps MC steps into kernel launches of at most
+        # kernelsteps each. The total number of MC steps is unchanged.
+        totsteps = nloop*self.nsteps
+        nlaunch, rem = divmod(totsteps, self.kernelsteps)
+        return [self.kernelsteps]*nlaunch + ([rem] if rem != 0 else [])
+
+    def timeMCMC(self, nsteps=None):
+        # runs a single synchronous kernel launch, returns wall time (s)
+        self.wait()
+        start = time.time()
+        self.runMCMC(nsteps)
+        self.wait()
+        return time.time() - start
+
+    def setKernelSteps(self, kernelsteps):
+        self.kernelsteps = int(clip(kernelsteps, 1, self.maxnsteps))
+        self.kernelstepsTuned = True
+        self.log("Using {} MC steps per kernel launch".format(self.kernelsteps))
 
     def measureFPerror(self, log, nloops=3):
         log("Measuring FP Error")
@@ -294,112 +790,375 @@ class MCMCGPU:
             log("    Exact E", e3[:5])
             log("    Error:", mean([float((a-b)**2) for a,b in zip(e1, e3)]))
 
-    def calcBimarg(self, seqbufname):
-        self.log("calcBimarg " + seqbufname)
+    def calcBimarg(self, seqbufname, nprev=0, nseq=None):
+        # counts pairs into bicount, and stores normalized marginals in 
+        # 'bi main'. If nprev is nonzero, adds to the counts already in
+        # bicount, which came from nprev seqs. If nseq is given, only counts
+        # the first nseq seqs of the buffer.
         L, nB, nPairs, nhist = self.L, self.nB, self.nPairs, self.nhist
 
-        nseq = self.nseq[seqbufname]
-        seq_dev = self.seqbufs[seqbufname]
-
+        bicount, bimarg = self.bufs['bicount'], self.bibufs['main']
         localhist = cl.LocalMemory(nhist*nB*nB*dtype(uint32).itemsize)
-        evt = self.prg.countBimarg(self.queue, (nPairs*nhist,), (nhist,), 
-                     self.bufs['bicount'], self.bibufs['main'], 
-                     uint32(nseq), seq_dev, localhist)
-        self.events.append((evt, 'calcBimarg'))
-
-    def calcEnergies(self, seqbufname, Jbufname):
-        self.log("calcEnergies " + seqbufname + " " + Jbufname)
-
-        energies_dev = self.Ebufs[seqbufname]
-        seq_dev = self.seqbufs[seqbufname]
-        nseq = self.nseq[seqbufname]
+        ncount = nseq
+        for offset, nseq, blk in self.seqBlocks(seqbufname):
+            seq_dev = self.seqbufs[blk]
+            #counts of later blocks are added to those of earlier ones
+            self.runKernel('calcBimarg', self.prg.countBimarg, 
+                           (nPairs*nhist,), (nhist,), 
+                           (bicount, bimarg, uint32(ncount or nseq), seq_dev,
+                            localhist, uint32(nprev + offset), uint32(nseq)),
+                           reads=[seq_dev] + ([bicount] if nprev + offset 
+                                                        else []), 
+                           writes=[bicount, bimarg], info=blk)
+
+    def seqBlocks(self, seqbufname, extra=()):
+        # yields (offset, nseq, blockname) for the seqs of a seq buffer. This
+        # is the whole buffer, except for a spilled large buffer, where each
+        # block is uploaded (along with the large buffers named in extra) to
+        # alternating device block buffers before being yielded. The caller
+        # enqueues the block's kernels before the next upload is enqueued.
+        if not (self.spill and seqbufname == 'large'):
+            yield 0, self.nseq[seqbufname], seqbufname
+            return
+        nlarge, nblock = self.nseq['large'], self.nseq['block']
+        for j, offset in enumerate(range(0, nlarge, nblock)):
+            nseq = min(nblock, nlarge - offset)
+            blk = 'block{}'.format(j%2)
+            self.nseq[blk] = nseq
+            for bufname in ['seq large'] + list(extra):
+                dev_buf = self.bufs[bufname.split()[0] + ' ' + blk]
+                self.copyBlock(dev_buf, bufname, offset, nseq, upload=True)
+            yield offset, nseq, blk
+
+    def copyBlock(self, dev_buf, bufname, offset, nseq, upload, pitch=None):
+        # copies seqs offset to offset+nseq of a spilled large buffer to 
+        # (or from) the start of a device buffer, with pitch (default nseq)
+        # seqs between rows in the device buffer
+        pitch = nseq if pitch is None else pitch
+        host = self.hostbufs[bufname]
+        isize, nlarge = host.itemsize, self.nseq['large']
+        nrows = self.SWORDS if bufname == 'seq large' else 1
+        dst, src = (dev_buf, host) if upload else (host, dev_buf)
+        evt = cl.enqueue_copy(self.xferqueue, dst, src, 
+                              buffer_origin=(0, 0), 
+                              host_origin=(offset*isize, 0),
+                              region=(nseq*isize, nrows),
+                              buffer_pitches=(pitch*isize,), 
+                              host_pitches=(nlarge*isize,),
+                              is_blocking=False, 
+                              wait_for=self.transferWaitlist(dev_buf))
+        self.xferqueue.flush()
+        if upload:
+            self.uploads[dev_buf] = evt
+            self.readbacks.pop(dev_buf, None)
+        else:
+            self.readbacks[dev_buf] = evt
+        self.addEvent(evt, 'setBuf' if upload else 'getBuf', 
+                      nseq*nrows*isize, 
+                      "{} {}:{}".format(bufname, offset, offset+nseq))
+
+    def calcEnergies(self, seqbufname, Jbufname, Ebufname=None):
+        #energies are stored in the E buffer matching the seq buffer, unless
+        #another buffer of the same size is given
+        if Ebufname is None:
+            Ebufname = 'E ' + seqbufname
+        assert(self.buf_spec[Ebufname][1] == (self.nseq[seqbufname],))
         self.packJ(Jbufname)
-        evt = self.prg.getEnergies(self.queue, (nseq,), (self.wgsize,), 
-                             self.bufs['Jpacked'], seq_dev, energies_dev)
-        self.events.append((evt, 'getEnergies'))
+        for offset, nseq, blk in self.seqBlocks(seqbufname):
+            seq_dev = self.seqbufs[blk]
+            spilled = blk != seqbufname
+            energies_dev = self.bufs['E ' + blk if spilled else Ebufname]
+            self.runKernel('getEnergies', self.prg.getEnergies, 
+                           (nseq,), (self.wgsize,), 
+                           (self.bufs['Jpacked'], seq_dev, energies_dev),
+                           reads=[self.bufs['Jpacked'], seq_dev], 
+                           writes=[energies_dev], 
+                           info=" ".join([blk, Jbufname, Ebufname]))
+            if spilled:
+                self.copyBlock(energies_dev, Ebufname, offset, nseq, 
+                               upload=False)
 
     # update front bimarg buffer using back J buffer and large seq buffer
     def perturbMarg(self): 
-        self.log("perturbMarg")
+        if self.spill:
+            #single pass through the blocks, accumulating neff and bi front
+            for offset, nseq, blk in self.seqBlocks('large', ['E large']):
+                self.calcWeights(blk, offset)
+                self.weightedMarg(blk, offset)
+            return
         self.calcWeights()
         self.wait()
         self.weightedMarg()
 
-    def calcWeights(self): 
-        self.log("getWeights")
+    def calcWeights(self, seqbufname=None, offset=0): 
 
         #overwrites weights, neff
-        #assumes seqmem_dev, energies_dev are filled in
-        nseq = self.nseq['large']
+        #assumes seqmem_dev, energies_dev are filled in. For a block of a 
+        #spilled large buffer at a nonzero offset, adds to neff instead.
+        seqbufname = seqbufname or self.weightSeqbuf
+        nseq = self.nseq[seqbufname]
+        seq_dev = self.seqbufs[seqbufname]
+        E_dev = self.bufs['E ' + seqbufname]
+        counts = self.bufs['multiplicity'] if seqbufname == 'unique' else None
         self.packJ('back')
 
-        evt = self.prg.perturbedWeights(self.queue, (nseq,), (self.wgsize,), 
-                       self.bufs['Jpacked'], self.seqbufs['large'],
-                       self.bufs['weights'], self.Ebufs['large'])
-        self.events.append((evt, 'perturbedWeights'))
+        bufs = self.bufs
+        block = seqbufname.startswith('block')
+        weights = bufs['weights ' + seqbufname] if block else bufs['weights']
+        self.runKernel('perturbedWeights', self.prg.perturbedWeights, 
+                       (nseq,), (self.wgsize,), 
+                       (bufs['Jpacked'], seq_dev, weights, E_dev),
+                       reads=[bufs['Jpacked'], seq_dev, E_dev], 
+                       writes=[weights], info=seqbufname)
+        if block:
+            self.copyBlock(weights, 'weights', offset, nseq, upload=False)
+            if offset != 0: #keep the neff of earlier blocks for weightedMarg
+                self.copyBuf('neff', 'neff prev')
         localarr = cl.LocalMemory(self.vsize*dtype(float32).itemsize)
-        evt = self.prg.sumWeights(self.queue, (self.vsize,), (self.vsize,), 
-                            self.bufs['weights'], self.bufs['neff'], 
-                            uint32(nseq), localarr)
-        self.events.append((evt, 'sumWeights'))
+        self.runKernel('sumWeights', self.prg.sumWeights, 
+                       (self.vsize,), (self.vsize,), 
+                       (weights, bufs['neff'], uint32(nseq), localarr,
+                        counts, uint32(offset != 0)),
+                       reads=[b for b in [weights, counts] if b] + 
+                             ([bufs['neff']] if offset != 0 else []), 
+                       writes=[bufs['neff']])
     
-    def weightedMarg(self):
-        self.log("weightedMarg")
+    def weightedMarg(self, seqbufname=None, offset=0):
         nB, L, nPairs, nhist = self.nB, self.L, self.nPairs, self.nhist
 
         #like calcBimarg, but only works on large seq buf, and also calculate
         #neff. overwites front bimarg buf. Uses weights_dev,
         #neff. Usually not used by user, but is called from
-        #perturbMarg
+        #perturbMarg. For a block of a spilled large buffer at a nonzero 
+        #offset, combines with the marginals of the earlier blocks.
+        seqbufname = seqbufname or self.weightSeqbuf
+        seq_dev = self.seqbufs[seqbufname]
+        counts = self.bufs['multiplicity'] if seqbufname == 'unique' else None
         localhist = cl.LocalMemory(nhist*nB*nB*dtype(float32).itemsize)
-        evt = self.prg.weightedMarg(self.queue, (nPairs*nhist,), (nhist,),
-                        self.bibufs['front'], self.bufs['weights'], 
-                        self.bufs['neff'], uint32(self.nseq['large']), 
-                        self.seqbufs['large'], localhist)
-        self.events.append((evt, 'weightedMarg'))
+        bufs = self.bufs
+        if seqbufname.startswith('block'):
+            weights = bufs['weights ' + seqbufname]
+        else:
+            weights = bufs['weights']
+        prevsum = bufs['neff prev'] if offset != 0 else None
+        bimarg = bufs['bi front']
+        self.runKernel('weightedMarg', self.prg.weightedMarg, 
+                       (nPairs*nhist,), (nhist,),
+                       (bimarg, weights, bufs['neff'], 
+                        uint32(self.nseq[seqbufname]), seq_dev, 
+                        localhist, counts, prevsum),
+                       reads=[b for b in [weights, bufs['neff'], seq_dev, 
+                                          counts, prevsum] if b] +
+                             ([bimarg] if prevsum else []),
+                       writes=[bimarg], info=seqbufname)
+
+    def fillBuf(self, bufname, value):
+        buftype, bufshape = self.buf_spec[bufname]
+        buf = self.bufs[bufname]
+        evt = cl.enqueue_fill_buffer(self.queue, buf, 
+                                     array(value, dtype=buftype), 0, buf.size,
+                                     wait_for=self.computeWaitlist(
+                                                                writes=[buf]))
+        self.lastuse[buf] = evt
+        self.addEvent(evt, 'fillBuf', buf.size, bufname)
+
+    def dedupSeqs(self):
+        # Compacts the large seq buffer into its distinct seqs, stored in the
+        # 'unique' seq buffer with their counts in 'multiplicity'. Until the
+        # large buffer is next modified, reweighting (perturbMarg) works on 
+        # the distinct seqs, giving the same result as for the large buffer
+        # up to rounding. The distinct seqs are in order of first occurrence,
+        # so the result is the same from run to run, and are padded to a
+        # multiple of wgsize with copies of the first one with count 0.
+        # Returns the number of distinct seqs.
+        nlarge, SWORDS, wgsize = self.nseq['large'], self.SWORDS, self.wgsize
+        if self.spill:
+            raise Exception("dedupSeqs requires the large buffer on device")
+        if 'seq unique' not in self.bufs:
+            tablesize = 1 << int(ceil(log2(2*nlarge)))
+            self.addBuf('dedup table', '<u4', (tablesize,))
+            self.addBuf('dedup index', '<u4', (nlarge,))
+            self.addBuf('dedup counts', '<u4', (nlarge,))
+            self.addBuf('dedup groups', '<u4', ((nlarge-1)//wgsize + 1,))
+            self.addBuf('nunique', '<u4', (1,))
+            self.addBuf('multiplicity', '<u4', (nlarge,))
+            self.addBuf('seq unique', '<u4', (SWORDS, nlarge))
+            self.addBuf('E unique', '<f4', (nlarge,))
+            self.seqbufs['unique'] = self.bufs['seq unique']
+        self.clearDedup()
+        bufs = self.bufs
+        large, table = self.seqbufs['large'], bufs['dedup table']
+        counts, index = bufs['dedup counts'], bufs['dedup index']
+        mult, groups = bufs['multiplicity'], bufs['dedup groups']
+        nunique = bufs['nunique']
+
+        self.fillBuf('dedup table', 0xffffffff)
+        self.fillBuf('dedup counts', 0)
+        nwork = wgsize*((nlarge-1)//wgsize + 1)
+        tablesize = uint32(self.buf_spec['dedup table'][1][0])
+        self.runKernel('insertUnique', self.prg.insertUnique, 
+                       (nwork,), (wgsize,), 
+                       (large, uint32(nlarge), table, tablesize),
+                       reads=[large], writes=[table])
+        self.runKernel('countUnique', self.prg.countUnique, 
+                       (nwork,), (wgsize,), 
+                       (large, uint32(nlarge), table, tablesize, counts),
+                       reads=[large, table], writes=[counts])
+        
+        # compact the first occurrences in order, so that results are
+        # deterministic. Padding entries keep index 0 (always a first
+        # occurrence) and count 0.
+        self.fillBuf('dedup index', 0)
+        self.fillBuf('multiplicity', 0)
+        localarr = cl.LocalMemory(wgsize*dtype(uint32).itemsize)
+        ngroups = uint32(nwork//wgsize)
+        self.runKernel('groupUnique', self.prg.groupUnique,
+                       (nwork,), (wgsize,),
+                       (counts, uint32(nlarge), groups, localarr),
+                       reads=[counts], writes=[groups])
+        self.runKernel('scanGroups', self.prg.scanGroups, (wgsize,), (wgsize,),
+                       (groups, ngroups, nunique, localarr),
+                       writes=[groups, nunique])
+        self.runKernel('scatterUnique', self.prg.scatterUnique,
+                       (nwork,), (wgsize,),
+                       (counts, uint32(nlarge), groups, index, mult, localarr),
+                       reads=[counts, groups], writes=[index, mult])
+        nbuf = self.getBuf('nunique')
+        nunique = int(nbuf.read()[0])
+        nbuf.release()
+        npad = wgsize*((nunique-1)//wgsize + 1) - nunique
+
+        nseq = nunique + npad
+        for name in ['dedup index', 'multiplicity', 'E unique', 'weights']:
+            self.buf_spec[name] = (self.buf_spec[name][0], (nseq,))
+        self.buf_spec['seq unique'] = ('<u4', (SWORDS, nseq))
+        self.nseq['unique'] = nseq
+        self.runKernel('gatherSeqs', self.prg.gatherSeqs, (nseq,), (wgsize,),
+                       (large, uint32(nlarge), bufs['seq unique'], index),
+                       reads=[large, index], writes=[bufs['seq unique']])
+        self.weightSeqbuf = 'unique'
+        return nunique
+
+    def clearDedup(self):
+        # go back to reweighting the whole large buffer
+        nlarge = self.nseq['large']
+        self.weightSeqbuf = 'large'
+        for name in ['dedup index', 'multiplicity', 'E unique', 'weights']:
+            if name in self.buf_spec:
+                self.buf_spec[name] = (self.buf_spec[name][0], (nlarge,))
+        if 'seq unique' in self.buf_spec:
+            self.buf_spec['seq unique'] = ('<u4', (self.SWORDS, nlarge))
 
     # updates front J buffer using back J and bimarg buffers, possibly clamped
     # to orig coupling
     def updateJPerturb(self, gamma, pc, jclamp):
-        self.log("updateJPerturb")
         nB, nPairs = self.nB, self.nPairs
         #find next highest multiple of wgsize, for num work units
         nworkunits = self.wgsize*((nPairs*nB*nB-1)//self.wgsize+1)
-        evt = self.prg.updatedJ(self.queue, (nworkunits,), (self.wgsize,), 
-                                self.bibufs['target'], self.bibufs['back'], 
-                                float32(gamma), float32(pc), 
-                                self.Jbufs['main'], float32(jclamp),
-                                self.Jbufs['back'], self.Jbufs['front'])
-        self.events.append((evt, 'updateJPerturb'))
+        bufs = self.bufs
+        self.runKernel('updateJPerturb', self.prg.updatedJ, 
+                       (nworkunits,), (self.wgsize,), 
+                       (bufs['bi target'], bufs['bi back'], float32(gamma), 
+                        float32(pc), bufs['J main'], float32(jclamp),
+                        bufs['J back'], bufs['J front']),
+                       reads=[bufs['bi target'], bufs['bi back'], 
+                              bufs['J main'], bufs['J back']],
+                       writes=[bufs['J front']])
         if self.packedJ == 'front':
             self.packedJ = None
 
     def getBuf(self, bufname):
-        self.log("getBuf " + bufname)
+        if bufname in self.hostbufs:
+            return self.getHostBuf(bufname)
         buftype, bufshape = self.buf_spec[bufname]
-        mem = zeros(bufshape, dtype=buftype)
-        evt = cl.enqueue_copy(self.queue, mem, self.bufs[bufname], 
-                              is_blocking=False)
-        self.events.append((evt, 'getBuf', mem.nbytes))
+        mem = self.pool.lease(buftype, bufshape)
+        buf = self.bufs[bufname]
+        evt = cl.enqueue_copy(self.xferqueue, mem, buf, is_blocking=False,
+                              wait_for=self.transferWaitlist(buf))
+        self.xferqueue.flush()
+        self.readbacks[buf] = evt
+        self.addEvent(evt, 'getBuf', mem.nbytes, bufname)
         if bufname.split()[0] == 'seq':
-            return FutureBuf(mem, evt, self.unpackSeqs)
-        return FutureBuf(mem, evt)
+            return FutureBuf(mem, evt, self.unpackSeqs, self.pool)
+        return FutureBuf(mem, evt, pool=self.pool)
+
+    def getHostBuf(self, bufname, offset=0, nseq=None):
+        # reads (a block of) a spilled large buffer, once the transfers
+        # enqueued before have finished. The result is a copy.
+        host = self.hostbufs[bufname]
+        nseq = self.nseq['large'] - offset if nseq is None else nseq
+        evt = cl.enqueue_marker(self.xferqueue)
+        self.xferqueue.flush()
+        if bufname == 'seq large':
+            block = host[:,offset:offset+nseq]
+            return FutureBuf(block, evt, 
+                             lambda m: self.unpackSeqs(ascontiguousarray(m)))
+        return FutureBuf(host[offset:offset+nseq], evt, lambda m: m.copy())
+
+    def releaseBuf(self, mem):
+        # return a staging array obtained from getBuf to the pool
+        self.pool.release(mem)
+
+    def getSeqBlock(self, seqbufname, offset, nseq):
+        # like getBuf, but reads back only seqs offset to offset+nseq 
+        nbuf = self.nseq[seqbufname]
+        if offset + nseq > nbuf:
+            raise Exception("cannot get seqs past end of seq buffer")
+        if 'seq ' + seqbufname in self.hostbufs:
+            return self.getHostBuf('seq ' + seqbufname, offset, nseq)
+        mem = self.pool.lease('<u4', (self.SWORDS, nseq))
+        buf = self.seqbufs[seqbufname]
+        isize = mem.itemsize
+        evt = cl.enqueue_copy(self.xferqueue, mem, buf, 
+                              buffer_origin=(offset*isize, 0), 
+                              host_origin=(0, 0),
+                              region=(nseq*isize, self.SWORDS),
+                              buffer_pitches=(nbuf*isize,), 
+                              host_pitches=(nseq*isize,),
+                              is_blocking=False, 
+                              wait_for=self.transferWaitlist(buf))
+        self.xferqueue.flush()
+        self.readbacks[buf] = evt
+        self.addEvent(evt, 'getBuf', mem.nbytes, 
+                      "seq {} {}:{}".format(seqbufname, offset, offset+nseq))
+        return FutureBuf(mem, evt, self.unpackSeqs, self.pool)
 
     def setBuf(self, bufname, buf):
-        self.log("setBuf " + bufname)
 
+        #copy into a staging array, so the caller may modify buf immediately
+        buftype, bufshape = self.buf_spec[bufname]
+        spilled = bufname in self.hostbufs
+        if spilled:
+            #write directly, once pending transfers using it are done
+            self.xferqueue.finish()
+            mem = self.hostbufs[bufname]
+        else:
+            mem = self.pool.lease(buftype, bufshape)
         if bufname.split()[0] == 'seq':
-            buf = self.packSeqs(buf)
+            assert(buf.shape == (bufshape[1], self.L))
+            self.packSeqs(buf, mem)
+        else:
+            if not isinstance(buf, ndarray):
+                buf = array(buf, dtype=buftype)
+            #(with subarray dtypes, eg the rngstates, buf has extra axes)
+            bufdtype = dtype(buftype)
+            shape = bufshape + bufdtype.shape
+            assert(bufdtype.base == buf.dtype)
+            assert(shape == buf.shape) or (bufshape == (1,) and buf.size==1)
+            mem[...] = buf.reshape(shape)
+        if bufname == 'seq large':
+            self.clearDedup()
+        if spilled:
+            return
 
-        buftype, bufshape = self.buf_spec[bufname]
-        if not isinstance(buf, ndarray):
-            buf = array(buf, dtype=buftype)
-        assert(dtype(buftype) == buf.dtype)
-        assert(bufshape == buf.shape) or (bufshape == (1,) and buf.size == 1)
-
-        evt = cl.enqueue_copy(self.queue, self.bufs[bufname], buf, 
-                              is_blocking=False)
-        self.events.append((evt, 'setBuf', buf.nbytes))
+        dev_buf = self.bufs[bufname]
+        evt = cl.enqueue_copy(self.xferqueue, dev_buf, mem, is_blocking=False,
+                              wait_for=self.transferWaitlist(dev_buf))
+        self.xferqueue.flush()
+        self.uploads[dev_buf] = evt
+        self.readbacks.pop(dev_buf, None) #upload is ordered after readbacks
+        self.pool.release(mem, evt)
+        self.addEvent(evt, 'setBuf', mem.nbytes, bufname)
         
         #unset packedJ flag if we modified that J buf
         if bufname.split()[0] == 'J':
@@ -407,7 +1166,6 @@ class MCMCGPU:
                 self.packedJ = None
 
     def swapBuf(self, buftype):
-        self.log("swapBuf " + buftype)
         #update convenience dicts
         bufs = {'J': self.Jbufs, 'bi': self.bibufs}[buftype] 
         bufs['front'], bufs['back'] = bufs['back'], bufs['front']
@@ -420,60 +1178,188 @@ class MCMCGPU:
                              'back': 'front'}.get(self.packedJ, self.packedJ)
 
     def storeBuf(self, buftype):
-        self.log("storeBuf " + buftype)
         self.copyBuf(buftype+' front', buftype+' back')
 
     def copyBuf(self, srcname, dstname):
-        self.log("copyBuf " + srcname + " " + dstname)
         assert(srcname.split()[0] == dstname.split()[0])
         assert(self.buf_spec[srcname][1] == self.buf_spec[dstname][1])
         srcbuf = self.bufs[srcname]
         dstbuf = self.bufs[dstname]
-        evt = cl.enqueue_copy(self.queue, dstbuf, srcbuf)
-        self.events.append((evt, 'copyBuf'))
+        evt = cl.enqueue_copy(self.queue, dstbuf, srcbuf, 
+                 wait_for=self.computeWaitlist(reads=[srcbuf], writes=[dstbuf]))
+        self.lastuse[srcbuf] = self.lastuse[dstbuf] = evt
+        self.addEvent(evt, 'copyBuf', 2*srcbuf.size, srcname + " " + dstname)
         if dstname.split()[0] == 'J' and self.packedJ == dstname.split()[1]:
             self.packedJ = None
 
     def fillSeqs(self, startseq, seqbufname='small'):
         #write a kernel function for this?
-        self.log("fillSeqs " + seqbufname)
         nseq = self.nseq[seqbufname]
         self.setBuf('seq '+seqbufname, tile(startseq, (nseq,1)))
 
     def storeSeqs(self, offset=0):
-        self.log("storeSeqs " + str(offset))
-        nseq = self.nseq['small']
+        # stores the first nstore walkers (all, unless tempering)
+        nseq = self.nstore
         if offset + nseq > self.nseq['large']:
             raise Exception("cannot store seqs past end of large buffer")
-        evt = self.prg.storeSeqs(self.queue, (nseq,), (self.wgsize,), 
-                           self.seqbufs['small'], self.seqbufs['large'], 
-                           uint32(self.nseq['large']), uint32(offset))
-        self.events.append((evt, 'storeSeqs'))
+        self.clearDedup()
+        small = self.seqbufs['small']
+        if self.spill:
+            self.copyBlock(small, 'seq large', offset, nseq, upload=False,
+                           pitch=self.nseq['small'])
+            return
+        large = self.seqbufs['large']
+        if nseq != self.nseq['small']:
+            isize, nsmall = dtype('<u4').itemsize, self.nseq['small']
+            evt = cl.enqueue_copy(self.queue, large, small, 
+                                  src_origin=(0, 0), 
+                                  dst_origin=(offset*isize, 0),
+                                  region=(nseq*isize, self.SWORDS),
+                                  src_pitches=(nsmall*isize,),
+                                  dst_pitches=(self.nseq['large']*isize,),
+                                  wait_for=self.computeWaitlist(reads=[small],
+                                                               writes=[large]))
+            self.lastuse[small] = self.lastuse[large] = evt
+            self.addEvent(evt, 'storeSeqs', 2*nseq*self.SBYTES, str(offset))
+            return
+        self.runKernel('storeSeqs', self.prg.storeSeqs, (nseq,), (self.wgsize,),
+                       (small, large, uint32(self.nseq['large']), 
+                        uint32(offset)),
+                       reads=[small], writes=[large], info=str(offset))
 
     def restoreSeqs(self, offset=0):
-        self.log("restoreSeqs " + str(offset))
         nseq = self.nseq['small']
         if offset + nseq > self.nseq['large']:
             raise Exception("cannot get seqs past end of large buffer")
-        evt = self.prg.restoreSeqs(self.queue, (nseq,), (self.wgsize,), 
-                           self.seqbufs['small'], self.seqbufs['large'], 
-                           uint32(self.nseq['large']), uint32(offset))
-        self.events.append((evt, 'restoreSeqs'))
+        if self.spill:
+            self.copyBlock(self.seqbufs['small'], 'seq large', offset, nseq, 
+                           upload=True)
+            return
+        small, large = self.seqbufs['small'], self.seqbufs['large']
+        self.runKernel('restoreSeqs', self.prg.restoreSeqs, 
+                       (nseq,), (self.wgsize,), 
+                       (small, large, uint32(self.nseq['large']), 
+                        uint32(offset)),
+                       reads=[large], writes=[small], info=str(offset))
+
+    def reseedSeqs(self, index):
+        # sets walker n to seq index[n] of the large buffer
+        if self.spill:
+            raise Exception("reseedSeqs cannot be used with spill")
+        nseq = self.nseq['small']
+        if 'reseed index' not in self.bufs:
+            self.addBuf('reseed index', '<u4', (nseq,))
+        self.setBuf('reseed index', asarray(index, dtype='<u4'))
+        small, large = self.seqbufs['small'], self.seqbufs['large']
+        index = self.bufs['reseed index']
+        self.runKernel('gatherSeqs', self.prg.gatherSeqs, 
+                       (nseq,), (self.wgsize,),
+                       (large, uint32(self.nseq['large']), small, index),
+                       reads=[large, index], writes=[small], info='reseed')
 
     def copySubseq(self, seqind):
-        self.log("copySubseq " + str(seqind))
         nseq = self.nseq['large']
         if seqind >= self.nseq['small']:
             raise Exception("given index is past end of small seq buffer")
-        evt = self.prg.copySubseq(self.queue, (nseq,), (self.wgsize,), 
-                           self.seqbufs['small'], self.seqbufs['large'], 
-                           uint32(self.nseq['small']), uint32(seqind),
-                           self.bufs['fixpos'])
-        self.events.append((evt, 'copySubseq'))
+        if self.spill:
+            raise Exception("copySubseq requires the large buffer on device")
+        small, large = self.seqbufs['small'], self.seqbufs['large']
+        self.clearDedup()
+        self.runKernel('copySubseq', self.prg.copySubseq, 
+                       (nseq,), (self.wgsize,), 
+                       (small, large, uint32(self.nseq['small']), 
+                        uint32(seqind), self.bufs['fixpos']),
+                       reads=[small, self.bufs['fixpos']], writes=[large],
+                       info=str(seqind))
+
+    def calcSubseqFreq(self, offset, nsubseq):
+        # for subseqs offset to offset+nsubseq in the small buffer, stores
+        # logsumexp(-dE) over the large buffer seqs in 'E small', where dE is
+        # the energy change from substituting the subseq at the fixpos
+        # positions. 
+        if offset + nsubseq > self.nseq['small']:
+            raise Exception("cannot get subseqs past end of small buffer")
+        if self.spill:
+            raise Exception("calcSubseqFreq requires the large buffer on "
+                            "device")
+        self.packJ('main')
+        bufs = self.bufs
+        small, large = self.seqbufs['small'], self.seqbufs['large']
+        wgsize = self.wgsize
+        localarr = lambda: cl.LocalMemory(wgsize*dtype(float32).itemsize)
+        self.runKernel('subseqFreq', self.prg.subseqFreq, 
+                       (nsubseq*wgsize,), (wgsize,), 
+                       (bufs['Jpacked'], small, uint32(self.nseq['small']), 
+                        large, uint32(self.nseq['large']), bufs['fixpos'], 
+                        uint32(offset), bufs['E small'], 
+                        localarr(), localarr()),
+                       reads=[bufs['Jpacked'], small, large, bufs['fixpos']],
+                       writes=[bufs['E small']], 
+                       info="{}:{}".format(offset, offset+nsubseq))
+
+    def calcMutscan(self, seqbufname):
+        # computes the energy change of all single mutants of the seqs in a
+        # seq buffer, stored in 'dE small' or 'dE large' with shape 
+        # (L*nB, nseq): the change for residue a at position i of seq n is 
+        # element [i*nB + a, n]
+        L, nB = self.L, self.nB
+        if seqbufname not in self.seqbufs:
+            raise Exception("calcMutscan requires the {} buffer on "
+                            "device".format(seqbufname))
+        nseq = self.nseq[seqbufname]
+        dEname = 'dE ' + seqbufname
+        if dEname not in self.bufs:
+            self.addBuf(dEname, '<f4', (L*nB, nseq))
+        seq_dev = self.seqbufs[seqbufname]
+        dE_dev = self.bufs[dEname]
+        self.packJ('main')
+        self.runKernel('mutscan', self.prg.mutscan, (nseq,), (self.wgsize,),
+                       (self.bufs['Jpacked'], seq_dev, dE_dev),
+                       reads=[self.bufs['Jpacked'], seq_dev], writes=[dE_dev],
+                       info=seqbufname)
+
+    def initAccum(self, eref, emin, emax, nbins):
+        # sets up the accumulators used by accumSample. Energy moments are
+        # accumulated relative to eref, and the energy histogram has nbins
+        # bins from emin to emax, plus underflow and overflow bins.
+        if 'E hist' not in self.bufs or self.ehist[2] != nbins:
+            self.addBuf('E hist', '<u4', (nbins+2,))
+            self.addBuf('E moments', '<f4', (4,))
+        self.ehist = (eref, emin, (emax - emin)/float(nbins), nbins)
+        self.resetAccum()
+
+    def resetAccum(self):
+        self.naccum = 0
+        self.fillBuf('E hist', 0)
+        self.fillBuf('E moments', 0)
+
+    def accumSample(self):
+        # adds the pair counts of the small buffer seqs to bicount (with the
+        # marginals of all seqs accumulated so far in 'bi main'), and adds
+        # their energies (computed into 'E small') to the energy moments and
+        # histogram. Counts are uint32, so should be read out and reset 
+        # (resetAccum) before naccum reaches 2**32.
+        nseq = self.nseq['small']
+        self.calcBimarg('small', self.naccum)
+        self.calcEnergies('small', 'main')
+        eref, emin, binwidth, nbins = self.ehist
+        bufs = self.bufs
+        localarr = lambda: cl.LocalMemory(self.vsize*dtype(float32).itemsize)
+        self.runKernel('accumEnergies', self.prg.accumEnergies, 
+                       (self.vsize,), (self.vsize,), 
+                       (bufs['E small'], uint32(nseq), float32(eref), 
+                        bufs['E moments'], bufs['E hist'], float32(emin),
+                        float32(binwidth), uint32(nbins), 
+                        localarr(), localarr()),
+                       reads=[bufs['E small'], bufs['E moments'], 
+                              bufs['E hist']],
+                       writes=[bufs['E moments'], bufs['E hist']])
+        self.naccum += nseq
 
     def wait(self):
-        self.log("wait")
         self.queue.finish()
+        self.xferqueue.finish()
+        self.retireEvents()
 
 ################################################################################
 # Set up enviroment and some helper functions
@@ -513,6 +1399,54 @@ def printGPUs(log):
 
 ################################################################################
 
+devicetypes = {'gpu': cl.device_type.GPU, 
+               'cpu': cl.device_type.CPU,
+               'accelerator': cl.device_type.ACCELERATOR}
+
+def selectDevices(gpuspec, platforms):
+    # returns (platform #, device #) of each device selected by gpuspec, a
+    # comma separated list of: 'P' for the next unused device of platform P,
+    # 'P:D' for device D of platform P, or a device type ('gpu', 'cpu' or 
+    # 'accelerator') for all devices of that type on the first platform 
+    # which has any. platforms is a list of (platform, devices).
+    selected = []
+    for spec in gpuspec.lower().split(','):
+        spec = spec.strip()
+        if spec in devicetypes:
+            devs = [[(pn, dn) for dn, d in enumerate(devices)
+                              if d.type & devicetypes[spec]]
+                    for pn, (plat, devices) in enumerate(platforms)]
+            devs = [d for d in devs if d != []]
+            if devs == []:
+                raise Exception("No OpenCL devices of type {}".format(spec))
+            selected += [d for d in devs[0] if d not in selected]
+            continue
+
+        try:
+            ind = [int(x) for x in spec.split(':')]
+            if len(ind) > 2:
+                raise ValueError
+        except ValueError:
+            raise Exception("Error: GPU specification must be comma separated "
+                            "list of platforms, platform:device pairs or "
+                            "device types, eg '0,0', '0:1,1:0' or 'cpu'")
+        pn = ind[0]
+        if not 0 <= pn < len(platforms):
+            raise Exception("No OpenCL platform {}".format(pn))
+        ndev = len(platforms[pn][1])
+        if len(ind) == 2:
+            dn = ind[1]
+        else:
+            unused = [d for d in range(ndev) if (pn, d) not in selected]
+            dn = unused[0] if unused != [] else ndev
+        if not 0 <= dn < ndev or (pn, dn) in selected:
+            raise Exception("No GPU with specification {}".format(spec))
+        selected.append((pn, dn))
+
+    if len(set([pn for pn, dn in selected])) > 1:
+        raise Exception("Error: all GPUs must be on the same OpenCL platform")
+    return selected
+
 def setupGPUs(scriptpath, scriptfile, param, log):
     outdir = param.outdir
     L, nB = param.L, param.nB
@@ -526,44 +1460,50 @@ def setupGPUs(scriptpath, scriptfile, param, log):
     gpudevices = []
     platforms = [(p, p.get_devices()) for p in cl.get_platforms()]
     if gpuspec is not None:
-        try:
-            dev = [tuple(int(x) for x in a.split(':')) 
-                                for a in gpuspec.split(',')]
-        except:
-            raise Exception("Error: GPU specification must be comma separated "
-                            " list of platforms, eg '0,0'")
-
-        for d in dev:
-            try:
-                plat, devices = platforms[p]
-                gpu = devices.popitem()[1]
-            except:
-                raise Exception("No GPU with specification {}".format(d))
-            log("Using GPU {} on platform {} ({})".format(gpu.name,
-                                                          plat.name, d))
+        for pn, dn in selectDevices(gpuspec, platforms):
+            plat, gpu = platforms[pn][0], platforms[pn][1][dn]
+            log("Using GPU {} on platform {} ({}:{})".format(gpu.name,
+                                                         plat.name, pn, dn))
             gpudevices.append(gpu)
     else:
-        #use gpus in first platform
-        plat = platforms[0]
-        for gpu in plat[1]:
-            log("Using GPU {} on platform {} (0)".format(gpu.name,
-                                                         plat[0].name))
-            gpudevices.append(gpu)
+        #use gpus in first platform which has any. If there are none, fall
+        #back to the first platform with other devices, eg a CPU (pocl)
+        isgpu = lambda d: d.type & cl.device_type.GPU
+        withgpus = [(n, p, [d for d in devs if isgpu(d)]) 
+                    for n,(p, devs) in enumerate(platforms)]
+        withgpus = [x for x in withgpus if x[2] != []]
+        if withgpus == []:
+            log("No GPUs found, using other OpenCL devices")
+            withgpus = [(n, p, devs) for n,(p, devs) in enumerate(platforms)
+                                     if devs != []]
+        if withgpus != []:
+            n, plat, devs = withgpus[0]
+            for gpu in devs:
+                log("Using GPU {} on platform {} ({})".format(gpu.name,
+                                                              plat.name, n))
+                gpudevices.append(gpu)
 
     if len(gpudevices) == 0:
         raise Exception("Error: No GPUs found")
 
-    #set up OpenCL. Assumes all gpus are identical
+    #set up OpenCL. All devices are on the same platform
     log("Getting CL Context...")
     cl_ctx = cl.Context(gpudevices)
+    platname = gpudevices[0].platform.name
 
-    #compile CL program
+    #compile CL program. If all devices are CPUs, use the kernel variants
+    #which read the couplings directly instead of staging them in local
+    #memory, since local memory and barriers are pure overhead on CPUs.
     options = [('nB', nB), ('L', L)]
     if measureFPerror:
         options.append(('MEASURE_FP_ERROR', 1))
+    if all([(d.type & cl.device_type.CPU) != 0 for d in gpudevices]):
+        options.append(('CPU_KERNELS', 1))
     optstr = " ".join(["-D {}={}".format(opt,val) for opt,val in options]) 
     log("Compilation Options: ", optstr)
-    extraopt = " -cl-nv-verbose -Werror -I {}".format(scriptpath)
+    extraopt = " -I {}".format(scriptpath)
+    if 'NVIDIA' in platname:
+        extraopt = " -cl-nv-verbose -Werror" + extraopt
     log("Compiling CL...")
     cl_prg = cl.Program(cl_ctx, src).build(optstr + extraopt) 
     #dump compiled program
@@ -576,15 +1516,69 @@ def setupGPUs(scriptpath, scriptfile, param, log):
 
     return (cl_ctx, cl_prg), gpudevices
 
-def divideWalkers(nwalkers, ngpus, wgsize, log):
-    n_max = (nwalkers-1)/ngpus + 1
-    nwalkers_gpu = [n_max]*(ngpus-1) + [nwalkers - (ngpus-1)*n_max]
-    if nwalkers % (ngpus*wgsize) != 0:
-        log("Warning: number of MCMC walkers is not a multiple of "
-            "wgsize*ngpus, so there are idle work units.")
+def divideWalkers(nwalkers, ngpus, wgsize, log, weights=None):
+    # divides the walkers evenly, or if weights (eg the gpus' throughputs)
+    # are given, in proportion to the weights in multiples of wgsize, with at
+    # least wgsize walkers per gpu
+    if weights is None:
+        n_max = (nwalkers-1)/ngpus + 1
+        nwalkers_gpu = [n_max]*(ngpus-1) + [nwalkers - (ngpus-1)*n_max]
+        if nwalkers % (ngpus*wgsize) != 0:
+            log("Warning: number of MCMC walkers is not a multiple of "
+                "wgsize*ngpus, so there are idle work units.")
+        return nwalkers_gpu
+
+    nunits = nwalkers//wgsize
+    if nunits < ngpus:
+        raise Exception("need at least wgsize walkers per GPU")
+    share = (nunits - ngpus)*array(weights, dtype=float)/sum(weights)
+    units = 1 + floor(share).astype(int)
+    #give the remaining units to the largest remainders
+    units[argsort(floor(share) - share)[:nunits - sum(units)]] += 1
+    nwalkers_gpu = [int(u)*wgsize for u in units]
+    nwalkers_gpu[-1] += nwalkers - nunits*wgsize
     return nwalkers_gpu
 
-def initGPU(devnum, (cl_ctx, cl_prg), device, nwalkers, nlargebuf, param, log):
+def redistributeWalkers(gpus, gpuwalkers, param, log):
+    # returns new gpus replacing gpus, with gpuwalkers walkers each. The
+    # walkers (sequences and RNG states) are moved between the gpus in order
+    # and keeping their temperatures, so each continues its own RNG stream.
+    # The large buffers are resized in proportion. The couplings, target 
+    # marginals, temperatures and kernel launch sizes are kept, but the 
+    # contents of other buffers are not.
+    ntemps = gpus[0].ntemps
+    res = readGPUbufs(['seq small', 'rngstates', 'J main', 'bi target'], gpus)
+    grouped = lambda bufs: [concatenate([b[t*len(b)/ntemps:(t+1)*len(b)/ntemps]
+                                         for b in bufs]) for t in range(ntemps)]
+    seqs, rngs = grouped(res[0]), grouped(res[1])
+    J, bimarg = res[2][0].copy(), res[3][0].copy()
+    releaseGPUbufs(res, gpus)
+    for gpu in gpus:
+        gpu.wait()
+        gpu.logProfile()
+
+    newgpus, pos = [], 0
+    for gpu, nwalk in zip(gpus, gpuwalkers):
+        nlarge = nwalk*gpu.nseq['large']/gpu.nseq['small']
+        newgpu = initGPU(gpu.gpunum, (gpu.ctx, gpu.prg), gpu.device, nwalk,
+                         nlarge, param, log, appendlog=True)
+        nrep = nwalk/ntemps
+        newgpu.setBuf('seq small', 
+                      concatenate([s[pos:pos+nrep] for s in seqs]))
+        newgpu.setBuf('rngstates', 
+                      concatenate([r[pos:pos+nrep] for r in rngs]))
+        pos += nrep
+        newgpu.setBuf('J main', J)
+        newgpu.setBuf('bi target', bimarg)
+        if ntemps > 1:
+            newgpu.setTemperatures(gpu.betas)
+        if gpu.kernelstepsTuned:
+            newgpu.setKernelSteps(gpu.kernelsteps)
+        newgpus.append(newgpu)
+    return newgpus
+
+def initGPU(devnum, (cl_ctx, cl_prg), device, nwalkers, nlargebuf, param, log,
+            appendlog=False, walker0=None):
     outdir = param.outdir
     L, nB = param.L, param.nB
     nsteps  = param.nsteps
@@ -593,6 +1587,11 @@ def initGPU(devnum, (cl_ctx, cl_prg), device, nwalkers, nlargebuf, param, log):
     wgsize = param.wgsize
     gibbs = param.gibbs
 
+    # if adapting the kernel launch size to a target duration, allow up to
+    # maxmerge loops of nsteps to be merged into a single launch
+    maxmerge = 64
+    maxnsteps = nsteps*maxmerge if param.kerneltime else nsteps
+
     # wgsize = OpenCL work group size for MCMC kernel. 
     # (also for other kernels, although would be nice to uncouple them)
     if wgsize not in [1<<n for n in range(32)]:
@@ -613,6 +1612,13 @@ def initGPU(devnum, (cl_ctx, cl_prg), device, nwalkers, nlargebuf, param, log):
     log("Starting GPU {}".format(devnum))
     gpu = MCMCGPU((device, devnum, cl_ctx, cl_prg), (L, nB), outdir,
                   nwalkers, nlargebuf, wgsize, vsize, 
-                  nhist, rngPeriod, nsteps, gibbs=gibbs, profile=profile)
+                  nhist, rngPeriod, nsteps, gibbs=gibbs, profile=profile,
+                  maxnsteps=maxnsteps, spill=bool(param.spill), 
+                  appendlog=appendlog, walker0=walker0)
+    if param.proposal is not None:
+        gpu.setProposal(param.proposal)
+    if param.ntemps > 1:
+        #geometric ladder from 1 to betamin, later tuned from swap rates
+        gpu.setTemperatures(param.betamin**linspace(0, 1, param.ntemps))
     return gpu
 
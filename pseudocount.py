@@ -23,25 +23,13 @@ import argparse, sys
 
 nrmlz = lambda x: x/sum(x,axis=1)[:,newaxis]
 
-def main():
-    parser = argparse.ArgumentParser(description='Add pseudocount')
-    parser.add_argument('margfile')
-    parser.add_argument('pc', type=float)
-    parser.add_argument('-mode', choices=['constant', 'prior', 'onuchic'], 
-                        default='prior')
-    parser.add_argument('-o', default='outpc', help="Output file")
-
-    args = parser.parse_args(sys.argv[1:])
-    ff = load(args.margfile)
+def pseudocount(ff, pc, mode='prior'):
     L = int(((1+sqrt(1+8*ff.shape[0]))/2) + 0.5) 
     nB = int(sqrt(ff.shape[1]) + 0.5)
 
-    pc = args.pc
-    if args.mode == 'constant':
-        print >>sys.stderr, "Using the simple pseudocount"
-        ff = nrmlz(ff + pc)
-    elif args.mode == 'prior':
-        print >>sys.stderr, "Using Priors pseudocount"
+    if mode == 'constant':
+        return nrmlz(ff + pc)
+    elif mode == 'prior':
         mu = float(pc)
 
         ffs = ff.reshape(ff.shape[0], nB, nB)
@@ -53,13 +41,32 @@ def main():
                        for i in range(L-1) for j in range(i+1,L)])
         
         # nrmlz only needed to correct fp error
-        ff = nrmlz((1-mu)**2*ff + (1-mu)*mu*sf/nB + (mu/nB)**2)
-    elif args.mode == 'onuchic':
-        print >>sys.stderr, "Using Onuchic pseudocount"
+        return nrmlz((1-mu)**2*ff + (1-mu)*mu*sf/nB + (mu/nB)**2)
+    elif mode == 'onuchic':
         if pc < 0 or pc > 1:
             raise Exception("pc must be between 0 and 1")
         pc = pc/(1-pc) #to make it the same as in reference impl.
-        ff = nrmlz(ff + pc/(nBases*nBases))
+        return nrmlz(ff + pc/(nB*nB))
+    raise Exception("Unknown pseudocount mode {}".format(mode))
+
+def main():
+    parser = argparse.ArgumentParser(description='Add pseudocount')
+    parser.add_argument('margfile')
+    parser.add_argument('pc', type=float)
+    parser.add_argument('-mode', choices=['constant', 'prior', 'onuchic'], 
+                        default='prior')
+    parser.add_argument('-o', default='outpc', help="Output file")
+
+    args = parser.parse_args(sys.argv[1:])
+    ff = load(args.margfile)
+
+    if args.mode == 'constant':
+        print >>sys.stderr, "Using the simple pseudocount"
+    elif args.mode == 'prior':
+        print >>sys.stderr, "Using Priors pseudocount"
+    elif args.mode == 'onuchic':
+        print >>sys.stderr, "Using Onuchic pseudocount"
+    ff = pseudocount(ff, args.pc, args.mode)
 
     save(args.o, ff.astype('<f4'))
 
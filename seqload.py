@@ -91,6 +91,22 @@ def parseHeader(hd):
             
     return param, headers
 
+#counts sequences without reading them, using the fact that all lines after
+#the header have the same length. Requires a seekable file.
+def countSeqs(fn):
+    with Opener(fn) as f:
+        pos = f.tell()
+        l = f.readline()
+        while l.startswith('#'):
+            pos = f.tell()
+            l = f.readline()
+        L = len(l.rstrip('\n'))
+        f.seek(0, 2)
+        size = f.tell()
+    if L == 0:
+        return 0
+    return (size - pos + 1)//(L+1) #last newline is optional
+
 #optimized for fast loading, assumes ASCII
 def loadSeqsChunked(f, names=None, chunksize=None): 
     #read header
@@ -0,0 +1,270 @@
+#!/usr/bin/env python2
+#
+#Copyright 2016 Allan Haldane.
+
+#This file is part of IvoGPU.
+
+#IvoGPU is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, version 3 of the License.
+
+#IvoGPU is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with IvoGPU.  If not, see <http://www.gnu.org/licenses/>.
+
+#Contact: allan.haldane _AT_ gmail.com
+from __future__ import print_function
+import time, json, atexit
+from collections import deque
+import numpy as np
+
+################################################################################
+
+#Low overhead tracing of host phases and OpenCL events. Events are kept in an
+#in-memory ring buffer (so only the most recent ones are kept in long runs),
+#and are written in Chrome trace JSON format, which can be viewed in
+#chrome://tracing or https://ui.perfetto.dev.
+
+#Tracing is off by default, in which case the module-level 'tracer' is a
+#NullTracer whose methods do nothing. Call enable() to turn it on. Code should
+#always access the tracer as 'tracing.tracer' since enable() replaces it.
+
+#Times are recorded in seconds since the epoch (time.time()). Host phases get
+#pid 0, and GPU n gets pid n+1 with one tid per command queue.
+
+#Separately, a Report (enabled by enableReport) aggregates the same host phases
+#and OpenCL events into per-round summaries: wall time per phase, and call
+#counts, mean/p95 durations and achieved bandwidth per kernel or transfer.
+#Like the tracer, the module-level 'report' is a no-op NullReport by default.
+
+class NullPhase:
+    def __enter__(self):
+        return self
+    def __exit__(self, e, v, t):
+        return False
+
+class NullTracer:
+    enabled = False
+
+    def instant(self, name, pid=0, tid=0, **args):
+        pass
+    def span(self, name, start, end, pid=0, tid=0, args=None):
+        pass
+    def setName(self, pid, name, tid=None):
+        pass
+
+class Phase:
+    depth = 0 #current nesting depth of host phases
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.depth = Phase.depth
+        Phase.depth += 1
+        self.start = time.time()
+        return self
+
+    def __exit__(self, e, v, t):
+        end = time.time()
+        Phase.depth -= 1
+        tracer.span(self.name, self.start, end, args=self.args)
+        report.addPhase(self.name, end - self.start, self.depth)
+        return False
+
+class Tracer:
+    enabled = True
+
+    def __init__(self, size=1<<20):
+        self.events = deque(maxlen=size)
+        self.names = {}
+
+    def instant(self, name, pid=0, tid=0, **args):
+        self.events.append(('i', name, time.time(), 0, pid, tid, args))
+
+    def span(self, name, start, end, pid=0, tid=0, args=None):
+        self.events.append(('X', name, start, end - start, pid, tid, args))
+
+    def setName(self, pid, name, tid=None):
+        # label a process (a GPU) or a thread (a queue) in the trace viewer
+        self.names[(pid, tid)] = name
+
+    def write(self, fn):
+        us = 1e6
+        evts = []
+        for (pid, tid), name in self.names.iteritems():
+            if tid is None:
+                evts.append({'ph': 'M', 'name': 'process_name', 'pid': pid,
+                             'args': {'name': name}})
+            else:
+                evts.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                             'tid': tid, 'args': {'name': name}})
+        for ph, name, ts, dur, pid, tid, args in self.events:
+            e = {'ph': ph, 'name': name, 'ts': ts*us, 'pid': pid, 'tid': tid}
+            if ph == 'X':
+                e['dur'] = dur*us
+            else:
+                e['s'] = 't'
+            if args:
+                e['args'] = args
+            evts.append(e)
+        with open(fn, 'wt') as f:
+            json.dump({'traceEvents': evts, 'displayTimeUnit': 'ms'}, f,
+                      default=str)
+
+################################################################################
+
+class NullReport:
+    enabled = False
+
+    def addPhase(self, name, dur, depth=0):
+        pass
+    def addEvent(self, name, dur, nbytes=0, queue='compute'):
+        pass
+
+class Stats:
+    # raw durations collected over one round (or a whole run)
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {} # name -> (depth, [durations])
+        self.events = {} # name -> (queue, [durations], total bytes)
+
+    def merge(self, other):
+        for name, (depth, durs) in other.phases.iteritems():
+            d, cur = self.phases.setdefault(name, (depth, []))
+            self.phases[name] = (min(d, depth), cur + durs)
+        for name, (queue, durs, nbytes) in other.events.iteritems():
+            q, cur, b = self.events.get(name, (queue, [], 0))
+            self.events[name] = (q, cur + durs, b + nbytes)
+
+    def summary(self, label, wall):
+        phases = {}
+        for name, (depth, durs) in self.phases.iteritems():
+            tot = float(sum(durs))
+            phases[name] = {'depth': depth, 'count': len(durs), 'total': tot,
+                            'mean': tot/len(durs), 'fraction': tot/wall}
+        toplevel = sum([p['total'] for p in phases.values() if p['depth']==0])
+
+        events, queues = {}, {}
+        for name, (queue, durs, nbytes) in self.events.iteritems():
+            tot = float(sum(durs))
+            events[name] = {'queue': queue, 'count': len(durs), 'total': tot,
+                            'mean': tot/len(durs), 
+                            'p95': float(np.percentile(durs, 95)),
+                            'bytes': nbytes,
+                            'bandwidth': nbytes/tot if tot > 0 else 0.0}
+            q = queues.setdefault(queue, {'busy': 0.0, 'bytes': 0})
+            q['busy'] += tot
+            q['bytes'] += nbytes
+        for q in queues.values():
+            q['bandwidth'] = q['bytes']/q['busy'] if q['busy'] > 0 else 0.0
+
+        return {'label': label, 'wall': wall, 'other': wall - toplevel,
+                'phases': phases, 'events': events, 'queues': queues}
+
+def formatReport(summary):
+    # human readable table of a summary dict (see Stats.summary)
+    lines = ["Performance report: {}   wall time {:.3f}s".format(
+                                           summary['label'], summary['wall']),
+             "  {:<28} {:>7} {:>11} {:>11} {:>6}".format(
+                                   'host phase', 'count', 'total(s)', 
+                                   'mean(s)', '%wall')]
+    fmt = "  {:<28} {:>7d} {:>11.4f} {:>11.4f} {:>6.1f}"
+    phases = sorted(summary['phases'].items(), 
+                    key=lambda (n, p): (p['depth'], -p['total']))
+    for name, p in phases:
+        lines.append(fmt.format('  '*p['depth'] + name, p['count'], 
+                     p['total'], p['mean'], 100*p['fraction']))
+    lines.append("  {:<28} {:>7} {:>11.4f} {:>11} {:>6.1f}".format('(other)', 
+                 '', summary['other'], '', 100*summary['other']/summary['wall']))
+
+    lines.append("  {:<28} {:>7} {:>11} {:>11} {:>11} {:>9}".format(
+                 'OpenCL event', 'count', 'total(s)', 'mean(ms)', 'p95(ms)', 
+                 'GB/s'))
+    fmt = "  {:<28} {:>7d} {:>11.4f} {:>11.4f} {:>11.4f} {:>9.3f}"
+    for name, e in sorted(summary['events'].items(), 
+                          key=lambda (n, e): -e['total']):
+        lines.append(fmt.format('{} [{}]'.format(name, e['queue']), 
+                     e['count'], e['total'], 1e3*e['mean'], 1e3*e['p95'], 
+                     1e-9*e['bandwidth']))
+    for name, q in sorted(summary['queues'].items()):
+        lines.append("  {:<28} {:>7} {:>11.4f} {:>11} {:>11} {:>9.3f}".format(
+                     '(all {})'.format(name), '', q['busy'], '', '', 
+                     1e-9*q['bandwidth']))
+    return "\n".join(lines)
+
+class Report:
+    enabled = True
+
+    def __init__(self):
+        self.total = Stats()
+        self.round = Stats()
+        self.rounds = []
+
+    def addPhase(self, name, dur, depth=0):
+        d, durs = self.round.phases.get(name, (depth, []))
+        durs.append(dur)
+        self.round.phases[name] = (min(d, depth), durs)
+
+    def addEvent(self, name, dur, nbytes=0, queue='compute'):
+        # nbytes is the number of bytes the event moved (or touched, for
+        # kernels), used to compute the achieved bandwidth
+        q, durs, b = self.round.events.get(name, (queue, [], 0))
+        durs.append(dur)
+        self.round.events[name] = (q, durs, b + nbytes)
+
+    def endRound(self, label, fn, log):
+        # summarize the stats collected since the last round, log them as a
+        # table and write them as JSON to file fn (if given)
+        rnd = self.round
+        summary = rnd.summary(label, time.time() - rnd.start)
+        self.total.merge(rnd)
+        self.round = Stats()
+        self.rounds.append(summary)
+        log(formatReport(summary))
+        if fn is not None:
+            with open(fn, 'wt') as f:
+                json.dump(summary, f, indent=1)
+        return summary
+
+    def endRun(self, fn, log):
+        # summarize the whole run, including any unfinished round
+        self.total.merge(self.round)
+        self.round = Stats()
+        summary = self.total.summary('total', time.time() - self.total.start)
+        log(formatReport(summary))
+        if fn is not None:
+            with open(fn, 'wt') as f:
+                json.dump({'total': summary, 'rounds': self.rounds}, f, 
+                          indent=1)
+        return summary
+
+################################################################################
+
+tracer = NullTracer()
+report = NullReport()
+nullphase = NullPhase()
+
+def enable(fn, size=1<<20):
+    # start recording, and write the trace to file fn when the program exits
+    global tracer
+    tracer = Tracer(size)
+    tracer.setName(0, 'host')
+    atexit.register(tracer.write, fn)
+    return tracer
+
+def enableReport():
+    global report
+    report = Report()
+    return report
+
+def phase(name, **args):
+    # context manager which records the duration of a host phase
+    if not (tracer.enabled or report.enabled):
+        return nullphase
+    return Phase(name, args)